@@ -1,24 +1,117 @@
+import time
+# Startup timing starts before anything else is imported
+IMPORT_STARTED = time.perf_counter()
 import os
 import json
-from flask import Flask,request, redirect, url_for, flash,get_flashed_messages
-import subprocess
-from importjson import extract_layoutlm_data
-from importjson import predict_document
-from importjson import extract_key_value_pairs
-from importjson import extract_tables_from_textract
-
-UPLOAD_FOLDER = "/app/uploads"
+import hashlib
+import importlib.util
+import multiprocessing
+import threading
+import uuid
+from flask import Flask,request, redirect, url_for, flash,get_flashed_messages, jsonify, g, Response
+from werkzeug.utils import secure_filename
+from textract_tables import ExtractedTable, CellWriter, tables_to_cells
+from model_holder import checkpoint_version, get_model_holder
+from model_registry import ModelRegistry
+from textract_document import TextractDocument
+from batcher import MicroBatcher
+from result_cache import get_result_cache, file_sha256
+from corpus import LABELS
+from metrics import span, REGISTRY, DOCUMENTS, ERRORS, PROFILING_ENABLED, PROFILE_MODES, RequestProfiler, STAGE_SECONDS
+
+# torch, transformers, pandas and sklearn are only imported by importjson (prediction)
+# and jobs (training), both imported on first use or by the warm-up thread below, so
+# the server answers /healthz as soon as Flask is up.
+
+UPLOAD_FOLDER = os.environ.get("UPLOAD_FOLDER", "/app/uploads")
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+# Extracted fields and tables, one directory per request
+OUTPUT_FOLDER = os.environ.get("OUTPUT_FOLDER", "/app/output")
+os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+# Every extracted table cell in one file per request: Parquet when pyarrow is installed, else CSV
+TABLE_CELLS_FORMAT = os.environ.get("TABLE_CELLS_FORMAT") or ("parquet" if importlib.util.find_spec("pyarrow") else "csv")
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['OUTPUT_FOLDER'] = OUTPUT_FOLDER
 #app = Flask(__name__)
 app.secret_key = "supersecretkey"
 
+def warm_up_in_background():
+    # Import the prediction stack, then load the fine-tuned model once (with a warm-up
+    # inference) and keep watching for checkpoints published by train_layoutlm.train().
+    # /readyz reports 503 until the model has been warmed up.
+    def warm_up():
+        start = time.perf_counter()
+        import importjson  # noqa: F401
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage="import")
+        print(f"🔹 Prediction modules imported in {elapsed:.1f}s")
+        get_model_holder().start()
+    threading.Thread(target=warm_up, name="model-warm-up", daemon=True).start()
+
+# Skipped in the training job's child process, which re-imports this module when
+# spawned, and under gunicorn.conf.py, where the master loads the model before forking
+# and every worker warms up and starts its own watcher.
+if multiprocessing.parent_process() is None and os.environ.get("MODEL_PRELOADED_BY_SERVER") != "1":
+    warm_up_in_background()
+
+# Requests to /predict-batch from different clients share batched forward passes
+PREDICT_MAX_BATCH_SIZE = int(os.environ.get("PREDICT_MAX_BATCH_SIZE", "8"))
+PREDICT_MAX_WAIT_MS = float(os.environ.get("PREDICT_MAX_WAIT_MS", "10"))
+PREDICT_TIMEOUT_SECONDS = float(os.environ.get("PREDICT_TIMEOUT_SECONDS", "120"))
+def predict_items(items):
+    # Imported here: importjson pulls in torch and transformers
+    from importjson import predict_batch
+    return predict_batch(items)
+
+batcher = MicroBatcher(predict_items, max_batch_size=PREDICT_MAX_BATCH_SIZE, max_wait_ms=PREDICT_MAX_WAIT_MS)
+
 #UPLOAD_FOLDER = "uploaded_jsons"
 #os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+@app.before_request
+def start_profiler():
+    # ?profile=cprofile|torch dumps a profile of this one request (needs PROFILING_ENABLED=1)
+    mode = request.args.get("profile")
+    if not mode or not PROFILING_ENABLED:
+        return None
+    if mode not in PROFILE_MODES:
+        return jsonify({"error": f"Unknown profile mode '{mode}', expected one of {PROFILE_MODES}."}), 400
+    g.profiler = RequestProfiler(mode, name=request.endpoint or "request").start()
+    return None
+
+@app.after_request
+def stop_profiler(response):
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        response.headers["X-Profile-Path"] = profiler.stop()
+    return response
+
+def run_predictions(items):
+    # A profiled request runs its forward pass in its own thread, so the profile captures it
+    if g.get("profiler") is not None:
+        return predict_items(items)
+    futures = batcher.submit_many(items)
+    return [future.result(timeout=PREDICT_TIMEOUT_SECONDS) for future in futures]
+
+@app.route("/metrics")
+def metrics():
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
 
+@app.route("/healthz")
+def healthz():
+    # Liveness: the process is up and serving, whether or not a model is loaded yet
+    return jsonify({"status": "ok", "uptime_seconds": time.perf_counter() - IMPORT_STARTED})
+
+@app.route("/readyz")
+def readyz():
+    # Readiness: a model is loaded and warmed up, so predictions won't wait on a load
+    holder = get_model_holder()
+    if holder.is_ready():
+        return jsonify({"status": "ready", "model_version": holder.version, "backend": holder.loaded_backend})
+    status = "warming" if holder.is_loaded() or checkpoint_version(holder.model_dir) else "no_model"
+    return jsonify({"status": status, "model_version": holder.version}), 503
 
 @app.route("/")
 def index():
@@ -36,6 +129,8 @@ def index():
 
         message_html += f"<div style='color:{color}; margin:10px 0;'><strong>{msg}</strong></div>"
 
+    label_options = "".join(f'<option value="{label}">{label}</option>' for label in LABELS)
+
     return f"""
         <h1>LayoutLM Trainer & Predictor</h1>
         {message_html}
@@ -57,8 +152,7 @@ def index():
             <div id="labelSelect">
                 <label for="label">Select Label for Training:</label>
                 <select name="label">
-                    <option value="Invoice">Invoice</option>
-                    <option value="Not Invoice">Not Invoice</option>
+                    {label_options}
                 </select><br><br>
             </div>
 
@@ -82,77 +176,340 @@ def index():
 
 #UPLOAD_FOLDER = "uploaded_jsons"
 #os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+def process_upload(digest, load_document, action, label):
+    """
+    Run the upload pipeline for one Textract analysis, touching no shared files.
+
+    Parameters:
+        digest (str): SHA-256 of the uploaded file, the result cache key.
+        load_document (callable): Returns the parsed TextractDocument; only called when something has to be computed.
+        action (str): "predict", or anything else to add the document to the training corpus with `label`.
+
+    Returns:
+        dict: "fields", "tables" (ExtractedTable list), "corpus" (path or None), "prediction" (dict or None) and "cached".
+    """
+    # Imported here: importjson pulls in torch and transformers
+    from importjson import extract_key_value_pairs, extract_layoutlm_data, prepare_predict_data
+    from textract_tables import extract_tables
+
+    # Resent uploads are answered from the result cache; the Textract JSON is only parsed (once) when needed
+    cache = get_result_cache()
+    textract_doc = None
+
+    def parsed():
+        nonlocal textract_doc
+        if textract_doc is None:
+            with span("parse"):
+                textract_doc = load_document()
+        return textract_doc
+
+    result = {"corpus": None, "prediction": None, "cached": []}
+
+    # 🔍 Step 0: Extract key-value pairs from Textract JSON
+    kv_result = cache.get(digest, "fields")
+    if kv_result is None:
+        with span("kv_extraction"):
+            kv_result = extract_key_value_pairs(parsed())
+        cache.put(digest, "fields", kv_result)
+    else:
+        result["cached"].append("fields")
+    result["fields"] = kv_result
+
+    # Step 1: Add to the training corpus (only when training, predictions are not labeled)
+    if action != "predict":
+        with span("corpus_append"):
+            result["corpus"] = extract_layoutlm_data(parsed(), label)
+
+    # Extract every table
+    tables = cache.get(digest, "tables")
+    if tables is None:
+        with span("table_extraction"):
+            result["tables"] = extract_tables(parsed())
+        cache.put(digest, "tables", [table.to_json() for table in result["tables"]])
+    else:
+        result["tables"] = [ExtractedTable.from_json(table) for table in tables]
+        result["cached"].append("tables")
+
+    # Step 2: If 'predict' option is selected, run prediction
+    if action == "predict":
+        # Cached predictions are per model version and backend (int8/onnx outputs differ
+        # slightly from fp32) and dropped when another one is served
+        holder = get_model_holder()
+        served = served_model(holder)
+        prediction = cache.get(digest, "prediction", version=served) if served else None
+        if prediction is None:
+            with span("predict"):
+                prediction = run_predictions([prepare_predict_data(parsed())])[0]
+            if served in (None, served_model(holder)):
+                cache.put(digest, "prediction", prediction, version=served_model(holder))
+        else:
+            result["cached"].append("prediction")
+        result["prediction"] = prediction
+    return result
+
+def served_model(holder):
+    """The "<version>/<backend>" the holder serves, the result cache key of predictions, or None."""
+    return f"{holder.version}/{holder.loaded_backend}" if holder.version else None
+
+def wants_inline_response():
+    # ?inline=1 (or asking for JSON) returns every output in the response and writes nothing to disk
+    return request.args.get("inline") == "1" or request.accept_mimetypes.best == "application/json"
+
 @app.route("/upload-json", methods=["POST"])
 def upload_json():
+    inline = wants_inline_response()
     if 'json_file' not in request.files:
+        if inline:
+            return jsonify({"error": "No file part in the request."}), 400
         flash("No file part in the request.", "danger")
         print("No file part in the request.", "danger")
         return redirect(url_for("index"))
 
     file = request.files['json_file']
     if file.filename == '':
+        if inline:
+            return jsonify({"error": "No selected file."}), 400
         flash("No selected file.", "danger")
         return redirect(url_for("index"))
 
-    if file and file.filename.endswith('.json'):
-        save_path = os.path.join(app.config['UPLOAD_FOLDER'], file.filename)
-        print(f"Saving file to {save_path}")    
-        file.save(save_path)
-        flash(f"✅ File uploaded successfully: {save_path}", "success")
+    if not file.filename.endswith('.json'):
+        if inline:
+            return jsonify({"error": "Only .json files are allowed."}), 400
+        flash("❌ Only .json files are allowed.", "danger")
+        return redirect(url_for("index"))
 
-        try:
-            # 🔍 Step 0: Extract key-value pairs from Textract JSON
-            with open(save_path, 'r') as f:
-                textract_data = json.load(f)
-            kv_result = extract_key_value_pairs(textract_data)
-
-            # Optional: show results in console or flash summary
-            print("🧾 Extracted Fields:")
-            for k, v in kv_result.items():
-                print(f"{k}: {v}")
-            flash(f"✅ Extracted {len(kv_result)} field-value pairs.", "success")
-            # Save key-value pairs as JSON
-            output_json_path = os.path.join(app.config['UPLOAD_FOLDER'], "extracted_fields.json")
-            with open(output_json_path, "w", encoding="utf-8") as outfile:
-                json.dump(kv_result, outfile, indent=2, ensure_ascii=False)
-            flash(f"📁 Saved extracted fields to: {output_json_path}", "info")
-            # Store it if needed for display in template or session
-            # session["extracted_fields"] = kv_result
-
-            # Step 1: Process file for LayoutLM
-            label = request.form.get("label", "Invoice")
-            jsonl_path = extract_layoutlm_data(save_path, label)
-            flash(f"Processed and saved for training: {jsonl_path}", "success")
-            # Extract table
-            df_table = extract_tables_from_textract(textract_data)
-
-            # Save as CSV (optional)
-            df_table.to_csv("extracted_invoice_table.csv", index=False)
-            # Step 2: If 'predict' option is selected, run prediction
-            if request.form.get("action") == "predict":
-                predicted_label, confidence = predict_document(jsonl_path)
-                flash(f"🔎 Prediction: {predicted_label} ({confidence:.8%} confidence)", "info")
+    # Every request gets its own id, and its files (if any) their own directories,
+    # so concurrent requests and workers never overwrite each other's outputs
+    request_id = uuid.uuid4().hex[:12]
+    action = request.form.get("action")
+    label = request.form.get("label", "Invoice")
+    if action != "predict" and label not in LABELS:
+        # load_corpus() would silently leave the sample out of training
+        if inline:
+            return jsonify({"error": f"Unknown label '{label}', expected one of {LABELS}."}), 400
+        flash(f"❌ Unknown label '{label}', expected one of {LABELS}.", "danger")
+        return redirect(url_for("index"))
+    DOCUMENTS.inc(operation="upload")
 
+    if inline:
+        raw = file.read()
+        try:
+            with span("hash"):
+                digest = hashlib.sha256(raw).hexdigest()
+            result = process_upload(digest, lambda: TextractDocument.from_json(raw), action, label)
         except Exception as e:
-            flash(f"❌ Error during processing: {str(e)}", "danger")
+            ERRORS.inc(endpoint="upload_json")
+            return jsonify({"request_id": request_id, "error": f"Error during processing: {str(e)}"}), 500
+        return jsonify({
+            "request_id": request_id,
+            "file": file.filename,
+            "fields": result["fields"],
+            "tables": [table.to_json() for table in result["tables"]],
+            "corpus": result["corpus"],
+            "prediction": result["prediction"],
+            "cached": result["cached"]
+        })
 
-        return redirect(url_for("index"))
+    upload_dir = os.path.join(app.config['UPLOAD_FOLDER'], request_id)
+    output_dir = os.path.join(app.config['OUTPUT_FOLDER'], request_id)
+    os.makedirs(upload_dir)
+    save_path = os.path.join(upload_dir, secure_filename(file.filename) or "upload.json")
+    print(f"Saving file to {save_path}")
+    with span("save"):
+        file.save(save_path)
+    flash(f"✅ File uploaded successfully: {save_path}", "success")
 
-    else:
-        flash("❌ Only .json files are allowed.", "danger")
-        return redirect(url_for("index"))
+    try:
+        with span("hash"):
+            digest = file_sha256(save_path)
+        result = process_upload(digest, lambda: TextractDocument.from_path(save_path), action, label)
+        kv_result = result["fields"]
+
+        # Optional: show results in console or flash summary
+        print("🧾 Extracted Fields:")
+        for k, v in kv_result.items():
+            print(f"{k}: {v}")
+        flash(f"✅ Extracted {len(kv_result)} field-value pairs.", "success")
+        # Save key-value pairs as JSON
+        os.makedirs(output_dir)
+        output_json_path = os.path.join(output_dir, "extracted_fields.json")
+        with span("kv_write"), open(output_json_path, "w", encoding="utf-8") as outfile:
+            json.dump(kv_result, outfile, indent=2, ensure_ascii=False)
+        flash(f"📁 Saved extracted fields to: {output_json_path}", "info")
+
+        if result["corpus"] is not None:
+            flash(f"Processed and saved for training: {result['corpus']}", "success")
+
+        # One CSV per table, plus every cell in one queryable file (Parquet when pyarrow is installed)
+        with span("csv_write"):
+            for table in result["tables"]:
+                output_csv_path = os.path.join(output_dir, f"extracted_table_{table.index + 1}_page_{table.page}.csv")
+                table.to_dataframe().to_csv(output_csv_path, index=False)
+            output_cells_path = os.path.join(output_dir, f"extracted_tables.{TABLE_CELLS_FORMAT}")
+            with CellWriter(output_cells_path) as writer:
+                writer.write(tables_to_cells(result["tables"], document=file.filename))
+        flash(f"📁 Saved {len(result['tables'])} extracted tables to: {output_dir}", "info")
+
+        prediction = result["prediction"]
+        if prediction is not None:
+            cached = " (cached)" if "prediction" in result["cached"] else ""
+            stage = " (cascade)" if prediction.get("stage") == "cascade" else ""
+            flash(f"🔎 Prediction: {prediction['label']} ({prediction['confidence']:.8%} confidence){stage}{cached}", "info")
+
+    except Exception as e:
+        ERRORS.inc(endpoint="upload_json")
+        flash(f"❌ Error during processing: {str(e)}", "danger")
+
+    return redirect(url_for("index"))
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def document_error(item):
+    """Why a words/boxes document can't be classified, or None if it can."""
+    words, boxes = item["words"], item["boxes"]
+    if not words:
+        return "has no words."
+    if len(words) != len(boxes):
+        return f"has {len(words)} words but {len(boxes)} boxes."
+    for j, word in enumerate(words):
+        if not isinstance(word, str):
+            return f"word {j} is not a string."
+    for j, box in enumerate(boxes):
+        if not isinstance(box, list) or len(box) != 4 or not all(is_number(v) for v in box):
+            return f"box {j} is not a list of 4 numbers."
+    pages = item.get("pages")
+    if pages is not None and (len(pages) != len(words) or not all(isinstance(p, int) and not isinstance(p, bool) for p in pages)):
+        return "needs one integer page number per word."
+    return None
+
+@app.route("/predict-batch", methods=["POST"])
+def predict_batch_route():
+    """
+    Classify many documents in one call.
+
+    Body: {"documents": [...]} (or a bare list), where each document is either
+    {"words": [...], "boxes": [...]} or a Textract analysis with "Blocks". An
+    optional "id" on each document is echoed back in its result.
+    """
+    payload = request.get_json(silent=True)
+    documents = payload.get("documents") if isinstance(payload, dict) else payload
+    if not isinstance(documents, list) or not documents:
+        return jsonify({"error": "Expected a non-empty JSON list of documents."}), 400
 
-@app.route("/train-model")
+    items = []
+    for i, doc in enumerate(documents):
+        if not isinstance(doc, dict):
+            return jsonify({"error": f"Document {i} is not a JSON object."}), 400
+        if "Blocks" in doc:
+            item = TextractDocument.load(doc).layoutlm_data()
+        elif isinstance(doc.get("words"), list) and isinstance(doc.get("boxes"), list):
+            item = {"words": doc["words"], "boxes": doc["boxes"]}
+            if isinstance(doc.get("pages"), list):
+                item["pages"] = doc["pages"]
+        else:
+            return jsonify({"error": f"Document {i} needs 'words' and 'boxes' or Textract 'Blocks'."}), 400
+        # Rejected here, before the document shares a batched forward pass with other requests
+        error = document_error(item)
+        if error:
+            return jsonify({"error": f"Document {i} {error}"}), 400
+        items.append(item)
+
+    try:
+        with span("predict"):
+            results = run_predictions(items)
+    except FileNotFoundError as e:
+        ERRORS.inc(endpoint="predict_batch")
+        return jsonify({"error": str(e)}), 503
+    except Exception as e:
+        ERRORS.inc(endpoint="predict_batch")
+        return jsonify({"error": f"Error during prediction: {str(e)}"}), 500
+
+    return jsonify({"results": [
+        dict(result, id=doc["id"]) if "id" in doc else result
+        for doc, result in zip(documents, results)
+    ]})
+
+def training_queue():
+    # Imported here: jobs pulls in transformers for its Trainer callback
+    from jobs import get_training_queue
+    return get_training_queue()
+
+@app.route("/train-model", methods=["GET", "POST"])
 def train_model():
+    # Training runs in the background; a second request while one is waiting joins it.
+    # ?mode=head retrains only the classification head (seconds), ?mode=incremental fine-tunes
+    # on the new uploads plus a replay of older ones (minutes), ?mode=full everything.
     try:
-        subprocess.run(["python", "train_layoutlm.py"], check=True)
-        flash("✅ Modelo entrenado exitosamente.", "success")
-    except subprocess.CalledProcessError as e:
-        flash(f"❌ Error al entrenar el modelo: {str(e)}", "danger")
+        job = training_queue().submit(request.values.get("mode") or None)
+    except ValueError as e:
+        if request.method == "POST":
+            return jsonify({"error": str(e)}), 400
+        flash(f"❌ {e}", "danger")
+        return redirect(url_for("index"))
+
+    if request.method == "POST":
+        return jsonify(job.to_dict()), 202
 
+    flash(f"🤖 Entrenamiento en cola (job {job.id}). Estado: /train-status/{job.id}", "info")
     return redirect(url_for("index"))
 
+@app.route("/train-status/<job_id>")
+def train_status(job_id):
+    job = training_queue().get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown training job '{job_id}'."}), 404
+    return jsonify(job.to_dict())
+
+@app.route("/train-cancel/<job_id>", methods=["POST"])
+def train_cancel(job_id):
+    queue = training_queue()
+    job = queue.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown training job '{job_id}'."}), 404
+    if not queue.cancel(job_id):
+        return jsonify({"error": f"Training job '{job_id}' already finished.", **job.to_dict()}), 409
+    return jsonify(job.to_dict())
+
+def reload_model_in_background():
+    # This worker switches right away; other workers follow on their next poll
+    def reload():
+        try:
+            get_model_holder().load()
+        except Exception as e:
+            print(f"❌ Model reload after activation failed: {e}")
+    threading.Thread(target=reload, name="model-activate", daemon=True).start()
+
+@app.route("/models")
+def list_models():
+    registry = ModelRegistry()
+    return jsonify({
+        "active": registry.active_version(),
+        "loaded": get_model_holder().version,
+        "versions": registry.versions()
+    })
+
+@app.route("/models/<version>/activate", methods=["POST"])
+def activate_model(version):
+    try:
+        ModelRegistry().activate(version)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 404
+    reload_model_in_background()
+    return jsonify({"active": version})
+
+@app.route("/models/rollback", methods=["POST"])
+def rollback_model():
+    try:
+        version = ModelRegistry().rollback()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 409
+    reload_model_in_background()
+    return jsonify({"active": version})
+
 
+STAGE_SECONDS.observe(time.perf_counter() - IMPORT_STARTED, stage="app_import")
+print(f"🔹 App imported in {time.perf_counter() - IMPORT_STARTED:.2f}s")
 
 if __name__ == "__main__":
     app.run(debug=True, host="0.0.0.0")
@@ -0,0 +1,88 @@
+# batcher.py
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    """
+    Groups single-item requests arriving from different threads into batches.
+
+    A worker thread takes the first waiting item, then keeps collecting until either
+    `max_batch_size` items are queued or `max_wait_ms` has passed, and hands the
+    whole batch to `batch_fn`, which must return one result per item. When a batch
+    fails, its items are retried one at a time, so an error only reaches the
+    request whose item caused it.
+    """
+
+    def __init__(self, batch_fn, max_batch_size=8, max_wait_ms=10):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1.")
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+
+    def submit(self, item):
+        """Queue one item and return a Future for its result."""
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def submit_many(self, items):
+        return [self.submit(item) for item in items]
+
+    def _ensure_worker(self):
+        # Started lazily so the thread belongs to the process that serves requests
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._worker_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+                self._worker.start()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            batch = [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                results = self._call([item for item, _ in batch])
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0][1].set_exception(e)
+                    continue
+                # One bad item must not fail the other requests it was batched with:
+                # retry every item on its own so only the culprit gets the error
+                for item, future in batch:
+                    try:
+                        future.set_result(self._call([item])[0])
+                    except Exception as item_error:
+                        future.set_exception(item_error)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+    def _call(self, items):
+        results = self.batch_fn(items)
+        if len(results) != len(items):
+            raise RuntimeError(f"Batch function returned {len(results)} results for {len(items)} items.")
+        return results
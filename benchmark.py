@@ -0,0 +1,357 @@
+# benchmark.py
+"""
+Benchmark the pipeline stages over the Textract analyses in uploads/.
+
+Every stage runs in its own fresh process, so its peak RSS is its own. By default
+predictions use a tiny randomly initialized LayoutLMv3 built on the fly, which needs
+no download and keeps the numbers comparable between machines and CI runs.
+
+    python benchmark.py --output bench.json
+    python benchmark.py --output new.json --baseline bench.json --fail-on-regression
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+STAGES = [
+    "parse",
+    "extract_layoutlm_data",
+    "extract_key_value_pairs",
+    "extract_tables_from_textract",
+    "cascade",
+    "encode",
+    "predict_single",
+    "predict_batched"
+]
+PREDICT_STAGES = ("encode", "predict_single", "predict_batched")
+
+
+def build_tiny_model(output_dir, seed=0):
+    """
+    Save a tiny randomly initialized LayoutLMv3 classifier and its processor to
+    `output_dir`, laid out like a published fine_tuned_layoutlmv3 checkpoint.
+
+    The tokenizer is byte-level BPE without merges (one token per byte), so it
+    needs no vocabulary download while still exercising the real tokenization path.
+    """
+    import torch
+    from transformers import (
+        LayoutLMv3Config,
+        LayoutLMv3ForSequenceClassification,
+        LayoutLMv3ImageProcessor,
+        LayoutLMv3Processor,
+        LayoutLMv3Tokenizer
+    )
+    from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+    from model_holder import write_ready_marker
+    from train_layoutlm import LABELS, id2label, label2id
+
+    os.makedirs(output_dir, exist_ok=True)
+    vocab = {token: i for i, token in enumerate(["<s>", "<pad>", "</s>", "<unk>"])}
+    for char in bytes_to_unicode().values():
+        vocab.setdefault(char, len(vocab))
+    vocab["<mask>"] = len(vocab)
+
+    vocab_file = os.path.join(output_dir, "vocab.json")
+    merges_file = os.path.join(output_dir, "merges.txt")
+    with open(vocab_file, "w") as f:
+        json.dump(vocab, f)
+    with open(merges_file, "w") as f:
+        f.write("#version: 0.2\n")
+
+    tokenizer = LayoutLMv3Tokenizer(vocab_file, merges_file)
+    LayoutLMv3Processor(LayoutLMv3ImageProcessor(apply_ocr=False), tokenizer).save_pretrained(output_dir)
+
+    torch.manual_seed(seed)
+    config = LayoutLMv3Config(
+        vocab_size=len(vocab),
+        hidden_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=64,
+        coordinate_size=6,
+        shape_size=4,
+        max_position_embeddings=600,
+        num_labels=len(LABELS),
+        id2label=id2label,
+        label2id=label2id
+    )
+    LayoutLMv3ForSequenceClassification(config).save_pretrained(output_dir)
+    write_ready_marker(output_dir, "benchmark-tiny")
+    return output_dir
+
+
+def textract_files(directory):
+    """Textract analyses in `directory`; other JSON files (e.g. extracted fields) are skipped."""
+    files = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.json"))):
+        with open(path) as f:
+            data = json.load(f)
+        if isinstance(data, dict) and data.get("Blocks"):
+            files.append(path)
+    return files
+
+
+def percentile_stats(latencies, items, total_seconds):
+    ms = np.asarray(latencies) * 1000.0
+    return {
+        "calls": len(latencies),
+        "items": items,
+        "total_seconds": total_seconds,
+        "throughput_per_second": items / total_seconds if total_seconds > 0 else None,
+        "mean_ms": float(ms.mean()),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "p99_ms": float(np.percentile(ms, 99))
+    }
+
+
+def _peak_rss_mb():
+    # On Linux, VmHWM is this process image's own peak; ru_maxrss carries over the
+    # parent's peak through fork and exec, i.e. the parent's torch and model
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _stage_calls(stage, files, options):
+    """
+    Set up `stage` and return (list of (callable, items)), outside of the timed region.
+
+    Every stage imports only the modules it uses, so their memory counts towards its
+    own peak RSS delta (parse and cascade never load torch).
+    """
+    from textract_document import TextractDocument
+
+    if stage == "parse":
+        return [(lambda path=path: TextractDocument.from_path(path), 1) for path in files]
+
+    if stage == "extract_layoutlm_data":
+        import importjson
+
+        # A fresh corpus per round, so every call really appends
+        def extract(path):
+            with tempfile.TemporaryDirectory() as output_dir:
+                importjson.extract_layoutlm_data(path, "Invoice", output_dir=output_dir)
+        return [(lambda path=path: extract(path), 1) for path in files]
+
+    documents = [TextractDocument.from_path(path) for path in files]
+    if stage == "cascade":
+        from cascade import CascadeClassifier
+        from corpus import LABELS
+
+        data = [doc.layoutlm_data() for doc in documents]
+        cascade = CascadeClassifier.load(options["model_dir"]) if options["model_dir"] else None
+        if cascade is None:
+            # No trained cascade: fit one on the benchmark documents that always decides,
+            # which costs the same per document as a trained one
+            cascade = CascadeClassifier(LABELS, threshold=0.0)
+            cascade.fit(cascade.features(data), [LABELS[i % 2] for i in range(len(data))])
+        return [(lambda item=item: cascade.decide([item]), 1) for item in data]
+
+    import torch
+    import importjson
+
+    torch.set_num_threads(options["threads"])
+    if stage == "extract_key_value_pairs":
+        return [(lambda doc=doc: importjson.extract_key_value_pairs(doc), 1) for doc in documents]
+    if stage == "extract_tables_from_textract":
+        return [(lambda doc=doc: importjson.extract_tables_from_textract(doc), 1) for doc in documents]
+
+    from model_holder import ModelHolder
+
+    torch.manual_seed(0)
+    holder = ModelHolder(model_dir=options["model_dir"], poll_interval=0, backend=options["backend"])
+    processor, model, _, selection = holder.get_pipeline()
+    data = [doc.layoutlm_data() for doc in documents]
+
+    if stage == "encode":
+        def encode(item):
+            processor.tokenizer(item["words"], boxes=item["boxes"], truncation=True, max_length=512, return_tensors="pt")
+        return [(lambda item=item: encode(item), 1) for item in data]
+
+    def predict(batch):
+        importjson.predict_batch(batch, processor=processor, model=model, selection=selection)
+
+    if stage == "predict_single":
+        return [(lambda item=item: predict([item]), 1) for item in data]
+
+    batch_size = options["batch_size"]
+    batches = [data[i:i + batch_size] for i in range(0, len(data), batch_size)]
+    return [(lambda batch=batch: predict(batch), len(batch)) for batch in batches]
+
+
+def run_stage(stage, files, options):
+    """Run one stage in the current process: a warm-up round, then `repeat` timed rounds."""
+    start_rss = _peak_rss_mb()
+    calls = _stage_calls(stage, files, options)
+
+    for call, _ in calls:
+        call()
+
+    latencies = []
+    items = 0
+    start = time.perf_counter()
+    for _ in range(options["repeat"]):
+        for call, n in calls:
+            t0 = time.perf_counter()
+            call()
+            latencies.append(time.perf_counter() - t0)
+            items += n
+    total_seconds = time.perf_counter() - start
+
+    stats = percentile_stats(latencies, items, total_seconds)
+    stats["peak_rss_mb"] = _peak_rss_mb()
+    stats["start_rss_mb"] = start_rss  # interpreter only, before the stage's imports and set up
+    stats["peak_rss_delta_mb"] = stats["peak_rss_mb"] - start_rss
+    return stats
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(files, options, stages=STAGES):
+    import torch
+    import transformers
+
+    results = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "transformers": transformers.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "files": [os.path.basename(path) for path in files],
+            **options
+        },
+        "stages": {}
+    }
+
+    ctx = multiprocessing.get_context("spawn")
+    for stage in stages:
+        print(f"🔹 Benchmarking {stage}...")
+        with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+            stats = pool.submit(run_stage, stage, files, options).result()
+        results["stages"][stage] = stats
+        print(
+            f"   p50 {stats['p50_ms']:.1f} ms, p95 {stats['p95_ms']:.1f} ms, p99 {stats['p99_ms']:.1f} ms, "
+            f"{stats['throughput_per_second']:.1f}/s, peak RSS +{stats['peak_rss_delta_mb']:.0f} MB"
+        )
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare p50 latency, throughput and the peak RSS the stage added (over the bare
+    interpreter) of every stage against a baseline run.
+
+    Returns:
+        list: (stage, metric, baseline, current, ratio) for every metric worse than `tolerance`.
+    """
+    regressions = []
+    print(f"\n{'stage':<30} {'p50 ms':>20} {'per second':>20} {'peak RSS +MB':>20}")
+    for stage, current in results["stages"].items():
+        base = baseline.get("stages", {}).get(stage)
+        if base is None:
+            continue
+        cells = []
+        for metric, higher_is_better in (("p50_ms", False), ("throughput_per_second", True), ("peak_rss_delta_mb", False)):
+            old, new = base.get(metric), current.get(metric)
+            if not old or new is None:
+                cells.append("n/a")
+                continue
+            ratio = new / old
+            worse = ratio < 1 - tolerance if higher_is_better else ratio > 1 + tolerance
+            if worse:
+                regressions.append((stage, metric, old, new, ratio))
+            cells.append(f"{old:.1f} -> {new:.1f}{' ⚠️' if worse else ''}")
+        print(f"{stage:<30} " + " ".join(f"{c:>20}" for c in cells))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Textract -> LayoutLMv3 pipeline stages.")
+    parser.add_argument("--uploads", default="uploads", help="Directory of Textract JSON analyses.")
+    parser.add_argument("--output", default="benchmark_results.json", help="Where to write the results.")
+    parser.add_argument("--baseline", help="Results of an earlier run to compare against.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Relative change counted as a regression.")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    parser.add_argument("--stages", default=",".join(STAGES), help="Comma-separated stages to run.")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed rounds over all files per stage.")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--threads", type=int, default=1, help="torch threads; fixed for reproducible numbers.")
+    parser.add_argument("--model-dir", help="Benchmark a real checkpoint instead of the tiny random model.")
+    parser.add_argument("--backend", default="fp32", help="fp32, int8 or onnx (needs its exported artifact).")
+    args = parser.parse_args(argv)
+
+    files = textract_files(args.uploads)
+    if not files:
+        print(f"❌ No Textract analyses found in '{args.uploads}'.")
+        return 1
+    stages = [s for s in args.stages.split(",") if s]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        print(f"❌ Unknown stages {sorted(unknown)}, expected some of {STAGES}.")
+        return 1
+
+    with tempfile.TemporaryDirectory() as tmp:
+        model_dir = args.model_dir
+        if model_dir is None and any(s in PREDICT_STAGES for s in stages):
+            model_dir = build_tiny_model(os.path.join(tmp, "fine_tuned_layoutlmv3"))
+        options = {
+            "repeat": args.repeat,
+            "batch_size": args.batch_size,
+            "threads": args.threads,
+            "backend": args.backend,
+            "model_dir": model_dir,
+            "model": args.model_dir or "tiny-random-layoutlmv3"
+        }
+        results = benchmark(files, options, stages)
+    results["meta"].pop("model_dir")
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"✅ Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for stage, metric, old, new, ratio in regressions:
+            print(f"⚠️ {stage} {metric}: {old:.2f} -> {new:.2f} ({ratio:.2f}x)")
+        if regressions and args.fail_on_regression:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,70 @@
+# blank_page.py
+import json
+import threading
+
+import torch
+from PIL import Image
+
+# Textract input has no page image, so LayoutLMv3 is always given the same white page
+BLANK_PAGE_SIZE = (1000, 1000)
+
+_pixel_values = {}
+_lock = threading.Lock()
+
+
+def blank_image():
+    return Image.new("RGB", BLANK_PAGE_SIZE, color=(255, 255, 255))
+
+
+def blank_pixel_values(processor):
+    """pixel_values (3 x H x W) of the blank page, computed once per image processor configuration."""
+    key = json.dumps(processor.image_processor.to_dict(), sort_keys=True, default=str)
+    pixel_values = _pixel_values.get(key)
+    if pixel_values is None:
+        with _lock:
+            pixel_values = _pixel_values.get(key)
+            if pixel_values is None:
+                pixel_values = processor.image_processor(blank_image(), return_tensors="pt")["pixel_values"][0]
+                _pixel_values[key] = pixel_values
+    return pixel_values
+
+
+def uses_visual_tokens(model):
+    """False for checkpoints trained in text+layout-only mode (config.visual_embed=False)."""
+    return getattr(model.config, "visual_embed", True)
+
+
+def add_blank_pixel_values(batch, processor, model):
+    """Add the blank page to a collated batch, unless the model is text+layout-only."""
+    if uses_visual_tokens(model):
+        batch_size = batch["input_ids"].shape[0]
+        batch["pixel_values"] = blank_pixel_values(processor).expand(batch_size, -1, -1, -1)
+    return batch
+
+
+def cache_blank_page_embedding(model, processor):
+    """
+    Memoize LayoutLMv3's visual embedding of the blank page on `model`.
+
+    In eval mode (no grad) the patch embedding of the blank page is the same for
+    every document, so it is computed on first use and expanded to each batch
+    after that. Any other image, and training, go through the original code.
+    """
+    backbone = getattr(model, "layoutlmv3", None)
+    if backbone is None or not uses_visual_tokens(model):
+        return model
+
+    blank = blank_pixel_values(processor)
+    original_forward_image = backbone.forward_image
+    cached = {}
+
+    def forward_image(pixel_values):
+        is_blank = pixel_values.shape[1:] == blank.shape and bool((pixel_values == blank).all())
+        if backbone.training or torch.is_grad_enabled() or not is_blank:
+            return original_forward_image(pixel_values)
+        if "embedding" not in cached:
+            cached["embedding"] = original_forward_image(blank.unsqueeze(0))
+        return cached["embedding"].expand(pixel_values.shape[0], -1, -1)
+
+    backbone.forward_image = forward_image
+    return model
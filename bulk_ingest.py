@@ -0,0 +1,195 @@
+# bulk_ingest.py
+"""
+Add a directory (or glob) of Textract analyses to the training corpus.
+
+    python bulk_ingest.py uploads/
+    python bulk_ingest.py "batches/2025-04/*_async_analysis.json" --manifest labels.csv
+
+Files are parsed in a process pool with the streaming parser and written to the
+corpus in large batches. Labels come from the manifest (file,label) or, failing
+that, from the document type in the file name (e.g. 511932_factura-comercial_1_...).
+"""
+import argparse
+import csv
+import glob
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from corpus import CorpusStore, CORPUS_DIR, sample_hash
+from textract_stream import stream_layoutlm_data
+
+ANALYSIS_PATTERN = "*_async_analysis.json"
+
+# Document type in the upload file names -> training label
+FILENAME_LABELS = {
+    "factura-comercial": "Invoice",
+    "otro": "Other"
+}
+
+
+def label_from_filename(path):
+    """'511932_factura-comercial_1_2025-04-17_104648.pdf_async_analysis.json' -> 'Invoice'."""
+    parts = os.path.basename(path).split("_")
+    if len(parts) < 2:
+        return None
+    return FILENAME_LABELS.get(parts[1].lower())
+
+
+def load_manifest(path):
+    """
+    Read file -> label from a CSV with "file" and "label" columns, or from a JSON object.
+    Files are matched by path or by base name.
+    """
+    if path.endswith(".json"):
+        with open(path) as f:
+            labels = json.load(f)
+    else:
+        with open(path, newline="") as f:
+            labels = {row["file"]: row["label"] for row in csv.DictReader(f)}
+    manifest = {}
+    for name, label in labels.items():
+        manifest[name] = label
+        manifest.setdefault(os.path.basename(name), label)
+    return manifest
+
+
+def find_files(sources):
+    files = []
+    for source in sources:
+        if os.path.isdir(source):
+            files.extend(glob.glob(os.path.join(source, ANALYSIS_PATTERN)))
+        else:
+            files.extend(glob.glob(source))
+    return sorted(set(files))
+
+
+def _extract(task):
+    # Runs in a worker: parse, extract words/boxes/pages and hash, so the
+    # writer only has to append
+    path, label = task
+    try:
+        data = stream_layoutlm_data(path)
+        if not data["words"]:
+            return path, None, "No WORD blocks found."
+        data["label"] = label
+        data["hash"] = sample_hash(data["words"], data["boxes"])
+        return path, data, None
+    except Exception as e:
+        return path, None, f"{type(e).__name__}: {e}"
+
+
+class IngestReport:
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.added = 0
+        self.duplicates = 0
+        self.errors = []  # {"file", "error"}
+        self.start = time.monotonic()
+
+    def progress(self):
+        elapsed = time.monotonic() - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        return (
+            f"🔹 {self.done}/{self.total} files ({rate:.1f}/s): "
+            f"{self.added} added, {self.duplicates} duplicates, {len(self.errors)} errors"
+        )
+
+    def to_dict(self):
+        return {
+            "files": self.total,
+            "added": self.added,
+            "duplicates": self.duplicates,
+            "errors": len(self.errors),
+            "seconds": time.monotonic() - self.start
+        }
+
+
+def ingest(files, corpus, manifest=None, workers=None, write_batch_size=500, progress_every=2.0):
+    """
+    Parse `files` in a process pool and append them to `corpus` in batches.
+
+    Returns:
+        IngestReport: Counts, plus one {"file", "error"} per file that was not ingested.
+    """
+    manifest = manifest or {}
+    report = IngestReport(len(files))
+
+    tasks = []
+    for path in files:
+        label = manifest.get(path) or manifest.get(os.path.basename(path)) or label_from_filename(path)
+        if label is None:
+            report.errors.append({"file": path, "error": "No label in the manifest or file name."})
+            report.done += 1
+        else:
+            tasks.append((path, label))
+
+    pending = []
+
+    def flush():
+        for _, added in corpus.append_many(pending):
+            if added:
+                report.added += 1
+            else:
+                report.duplicates += 1
+        pending.clear()
+
+    last_report = time.monotonic()
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(workers or os.cpu_count()) as pool:
+        for path, data, error in pool.imap_unordered(_extract, tasks, chunksize=4):
+            report.done += 1
+            if error is not None:
+                report.errors.append({"file": path, "error": error})
+            else:
+                pending.append(data)
+                if len(pending) >= write_batch_size:
+                    flush()
+            if time.monotonic() - last_report >= progress_every:
+                print(report.progress())
+                last_report = time.monotonic()
+    if pending:
+        flush()
+    print(report.progress())
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Add Textract analyses to the training corpus in bulk.")
+    parser.add_argument("sources", nargs="+", help=f"Directories (searched for {ANALYSIS_PATTERN}) or globs.")
+    parser.add_argument("--manifest", help="CSV (file,label) or JSON {file: label}; overrides file-name labels.")
+    parser.add_argument("--corpus", default=CORPUS_DIR, help="Corpus directory.")
+    parser.add_argument("--workers", type=int, default=None, help="Parser processes (default: CPU count).")
+    parser.add_argument("--write-batch-size", type=int, default=500, help="Samples per corpus write.")
+    parser.add_argument("--errors", default="bulk_ingest_errors.jsonl", help="Where to write the per-file error report.")
+    args = parser.parse_args(argv)
+
+    files = find_files(args.sources)
+    if not files:
+        print(f"❌ No Textract analyses found in {args.sources}.")
+        return 1
+    manifest = load_manifest(args.manifest) if args.manifest else None
+
+    print(f"🚀 Ingesting {len(files)} files into {args.corpus}")
+    report = ingest(
+        files,
+        CorpusStore(args.corpus),
+        manifest=manifest,
+        workers=args.workers,
+        write_batch_size=args.write_batch_size
+    )
+
+    if report.errors:
+        with open(args.errors, "w") as f:
+            for error in report.errors:
+                f.write(json.dumps(error, ensure_ascii=False) + "\n")
+        print(f"⚠️ {len(report.errors)} files were not ingested, see {args.errors}")
+    print(f"✅ Done: {json.dumps(report.to_dict())}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,219 @@
+# bulk_predict.py
+"""
+Classify a directory (or glob) of Textract analyses into a JSONL file.
+
+    python bulk_predict.py archive/ --output predictions.jsonl
+
+The work flows through three stages that run at the same time: parse workers
+(processes, streaming parser) -> tokenization (a thread) -> batched forward passes.
+Each finished file is appended to the output as
+{"file", "label", "confidence", "all_probs", "stage"} (or {"file", "error"}); rerunning the
+same command skips every file already in the output, so an interrupted run
+resumes where it stopped.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+
+from bulk_ingest import find_files
+from model_holder import MODEL_DIR, ModelHolder
+from inference_backends import PREDICT_BACKEND
+from textract_stream import stream_layoutlm_data
+
+_DONE = object()
+
+
+def completed_files(output_path):
+    """
+    Files that already have a record in `output_path`. A partly written last line
+    (from a run that was killed mid-write) is cut off so appending continues cleanly.
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, "rb+") as f:
+        good = 0
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                done.add(json.loads(line)["file"])
+            except (ValueError, KeyError):
+                break
+            good += len(line)
+        f.truncate(good)
+    return done
+
+
+def _parse(path):
+    try:
+        data = stream_layoutlm_data(path)
+        if not data["words"]:
+            return path, None, "No WORD blocks found."
+        return path, data, None
+    except Exception as e:
+        return path, None, f"{type(e).__name__}: {e}"
+
+
+def parsed_documents(files, workers):
+    """
+    Stage 1: (path, data, error) per file, parsed in a process pool, in completion order.
+
+    Spawned workers re-import this module (and the script run as __main__), so
+    its top level only imports the streaming parser and other light modules;
+    torch and importjson are imported where the model runs.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(workers) as pool:
+        yield from pool.imap_unordered(_parse, files, chunksize=4)
+
+
+def tokenized_batches(parsed, processor, batch_size, window_config, cascade=None, selection=None):
+    """
+    Stage 2: (paths, encoded, errors, decided) per batch of up to `batch_size` parsed
+    documents. Documents the cascade is confident about are not tokenized; they come
+    back in `decided` as (path, result) pairs.
+    """
+    # Imported here: importjson pulls in torch and transformers, which the parse workers must not load
+    from importjson import cascade_decisions, encode_for_prediction
+
+    def batch(paths, documents, errors):
+        results = cascade_decisions(cascade, documents)
+        decided = [(path, result) for path, result in zip(paths, results) if result is not None]
+        keep = [i for i, result in enumerate(results) if result is None]
+        encoded = encode_for_prediction([documents[i] for i in keep], processor, window_config, selection)
+        return [paths[i] for i in keep], encoded, errors, decided
+
+    paths, documents, errors = [], [], []
+    for path, data, error in parsed:
+        if error is not None:
+            errors.append((path, error))
+        else:
+            paths.append(path)
+            documents.append(data)
+        if len(documents) >= batch_size or len(errors) >= batch_size:
+            yield batch(paths, documents, errors)
+            paths, documents, errors = [], [], []
+    if documents or errors:
+        yield batch(paths, documents, errors)
+
+
+def prefetch(iterable, depth):
+    """Run `iterable` in a background thread, at most `depth` items ahead of the consumer."""
+    items = queue.Queue(maxsize=depth)
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put(item)
+        except Exception as e:
+            items.put(e)
+        items.put(_DONE)
+
+    threading.Thread(target=produce, name="bulk-predict-tokenize", daemon=True).start()
+    while True:
+        item = items.get()
+        if item is _DONE:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+def predict_files(files, processor, model, batch_size=32, workers=None, window_config=None, prefetch_batches=2, cascade=None,
+                  selection=None):
+    """
+    Classify `files`, yielding one record per file as batches finish. With a
+    `cascade`, the documents it is confident about skip LayoutLMv3. `selection` is
+    the word selection the model was trained with.
+
+    Returns:
+        generator: {"file", "label", "confidence", "all_probs", "stage"} or {"file", "error"} dicts.
+    """
+    # Imported here: importjson pulls in torch and transformers, which the parse workers must not load
+    from importjson import PREDICT_WINDOWS, classify_encoded
+
+    window_config = window_config or PREDICT_WINDOWS
+    parsed = parsed_documents(files, workers or os.cpu_count())
+    batches = prefetch(tokenized_batches(parsed, processor, batch_size, window_config, cascade, selection), prefetch_batches)
+
+    for paths, encoded, errors, decided in batches:
+        for path, error in errors:
+            yield {"file": path, "error": error}
+        results = list(decided)
+        if paths:
+            results.extend(zip(paths, classify_encoded(encoded, processor, model, window_config)))
+        for path, result in results:
+            yield {
+                "file": path,
+                "label": result["label"],
+                "confidence": result["confidence"],
+                "all_probs": result["probabilities"],
+                "stage": result["stage"]
+            }
+
+
+def run(sources, output_path, model_dir=MODEL_DIR, backend=None, batch_size=32, workers=None, threads=None, progress_every=10.0):
+    files = find_files(sources)
+    done = completed_files(output_path)
+    todo = [path for path in files if path not in done]
+    print(f"🚀 {len(files)} files, {len(files) - len(todo)} already in {output_path}, {len(todo)} to predict")
+    if not todo:
+        return 0
+
+    if threads:
+        # Imported here: keeps torch out of the spawned parse workers
+        import torch
+        torch.set_num_threads(threads)
+    holder = ModelHolder(model_dir=model_dir, backend=backend or PREDICT_BACKEND)
+    processor, model, cascade, selection = holder.get_pipeline()
+
+    start = last_report = time.monotonic()
+    count = errors = 0
+    with open(output_path, "a", encoding="utf-8") as out:
+        for record in predict_files(todo, processor, model, batch_size=batch_size, workers=workers, cascade=cascade,
+                                    selection=selection):
+            # One flushed line per file: a killed run loses at most the batch in flight
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+            count += 1
+            errors += "error" in record
+            if time.monotonic() - last_report >= progress_every:
+                rate = count / (time.monotonic() - start)
+                print(f"🔹 {count}/{len(todo)} files ({rate:.1f}/s), {errors} errors")
+                last_report = time.monotonic()
+
+    print(f"✅ Predicted {count} files in {time.monotonic() - start:.1f}s ({errors} errors) -> {output_path}")
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Classify Textract analyses in bulk into a resumable JSONL file.")
+    parser.add_argument("sources", nargs="+", help="Directories (searched for *_async_analysis.json) or globs.")
+    parser.add_argument("--output", default="predictions.jsonl")
+    parser.add_argument("--model-dir", default=MODEL_DIR)
+    parser.add_argument("--backend", default=None, help="fp32, int8 or onnx (default: PREDICT_BACKEND).")
+    parser.add_argument("--batch-size", type=int, default=32, help="Documents per forward-pass batch.")
+    parser.add_argument("--workers", type=int, default=None, help="Parser processes (default: CPU count).")
+    parser.add_argument("--threads", type=int, default=None, help="torch threads for the forward passes.")
+    args = parser.parse_args(argv)
+
+    run(
+        args.sources,
+        args.output,
+        model_dir=args.model_dir,
+        backend=args.backend,
+        batch_size=args.batch_size,
+        workers=args.workers,
+        threads=args.threads
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
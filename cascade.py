@@ -0,0 +1,195 @@
+# cascade.py
+import os
+
+import joblib
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import StratifiedKFold
+
+from metrics import Counter, REGISTRY
+
+# CASCADE_ENABLED=0 skips both training and serving the cascade stage
+CASCADE_ENABLED = os.environ.get("CASCADE_ENABLED", "1") == "1"
+CASCADE_FILE = "cascade.joblib"
+# Documents at or above the calibrated confidence must be at least this accurate on held-out data
+CASCADE_TARGET_ACCURACY = float(os.environ.get("CASCADE_TARGET_ACCURACY", "0.99"))
+# Calibrating on fewer out-of-fold predictions than this is noise: the cascade then never decides
+CASCADE_MIN_CALIBRATION_SAMPLES = int(os.environ.get("CASCADE_MIN_CALIBRATION_SAMPLES", "50"))
+# Overrides the calibrated threshold at serving time when set (e.g. 1.01 to send everything to LayoutLMv3)
+CASCADE_THRESHOLD = os.environ.get("CASCADE_THRESHOLD")
+CASCADE_HASH_FEATURES = 2 ** 18
+CASCADE_GRID = 4
+
+PREDICTION_STAGES = REGISTRY.register(Counter(
+    "layoutlm_prediction_stage_total",
+    "Classified documents, by the stage that decided (cascade or layoutlm).",
+    labelnames=("stage",)
+))
+
+
+def layout_features(doc, grid=CASCADE_GRID):
+    """
+    Coarse layout of a document: the share of words whose box center falls in each
+    cell of a `grid` x `grid` page grid, mean box width and height, and the
+    (log-scaled) word and page counts.
+    """
+    boxes = np.asarray(doc["boxes"], dtype=np.float32).reshape(-1, 4)
+    features = np.zeros(grid * grid + 4, dtype=np.float32)
+    if len(boxes):
+        boxes = np.clip(boxes, 0, 1000) / 1000.0
+        cx = np.minimum(((boxes[:, 0] + boxes[:, 2]) / 2 * grid).astype(int), grid - 1)
+        cy = np.minimum(((boxes[:, 1] + boxes[:, 3]) / 2 * grid).astype(int), grid - 1)
+        features[:grid * grid] = np.bincount(cy * grid + cx, minlength=grid * grid) / len(boxes)
+        features[grid * grid] = float(np.mean(boxes[:, 2] - boxes[:, 0]))
+        features[grid * grid + 1] = float(np.mean(boxes[:, 3] - boxes[:, 1]))
+    features[grid * grid + 2] = np.log1p(len(boxes)) / 10.0
+    features[grid * grid + 3] = np.log1p(len(set(doc.get("pages") or [1]))) / 5.0
+    return features
+
+
+class CascadeClassifier:
+    """
+    Cheap pre-classifier in front of LayoutLMv3: a linear model over hashed word and
+    bigram counts plus coarse layout features (layout_features).
+
+    decide() only answers for documents whose top probability reaches `threshold`,
+    calibrated on out-of-fold predictions so that those answers meet
+    CASCADE_TARGET_ACCURACY; every other document goes to the transformer. A
+    threshold of None means the cascade never decides.
+    """
+
+    def __init__(self, labels, threshold=None, n_features=CASCADE_HASH_FEATURES, grid=CASCADE_GRID):
+        self.labels = list(labels)
+        self.threshold = threshold
+        self.n_features = n_features
+        self.grid = grid
+        self.model = None
+        self._vectorizer = HashingVectorizer(
+            n_features=n_features,
+            ngram_range=(1, 2),
+            strip_accents="unicode",
+            alternate_sign=False,
+            norm="l2"
+        )
+
+    def features(self, documents):
+        texts, layouts = [], []
+        for doc in documents:
+            texts.append(" ".join(str(word) for word in doc["words"]))
+            layouts.append(layout_features(doc, self.grid))
+        return sparse.hstack([self._vectorizer.transform(texts), sparse.csr_matrix(np.vstack(layouts))]).tocsr()
+
+    def fit(self, x, labels):
+        self.model = LogisticRegression(max_iter=1000)
+        self.model.fit(x, labels)
+        return self
+
+    def predict_proba(self, x):
+        """Probabilities over self.labels (labels never seen in training get 0)."""
+        probs = np.zeros((x.shape[0], len(self.labels)), dtype=np.float64)
+        columns = [self.labels.index(label) for label in self.model.classes_]
+        probs[:, columns] = self.model.predict_proba(x)
+        return probs
+
+    def decide(self, documents):
+        """
+        Returns:
+            list: Per document, a predict_batch-style result when the cascade is
+            confident enough, else None.
+        """
+        threshold = float(CASCADE_THRESHOLD) if CASCADE_THRESHOLD else self.threshold
+        if threshold is None or self.model is None or not documents:
+            return [None] * len(documents)
+        results = []
+        for row in self.predict_proba(self.features(documents)):
+            best = int(np.argmax(row))
+            if row[best] < threshold:
+                results.append(None)
+                continue
+            results.append({
+                "label": self.labels[best],
+                "confidence": float(row[best]),
+                "probabilities": {label: float(p) for label, p in zip(self.labels, row)},
+                "windows": 0,
+                "stage": "cascade"
+            })
+        return results
+
+    def save(self, model_dir):
+        joblib.dump({
+            "labels": self.labels,
+            "threshold": self.threshold,
+            "n_features": self.n_features,
+            "grid": self.grid,
+            "model": self.model
+        }, os.path.join(model_dir, CASCADE_FILE))
+
+    @classmethod
+    def load(cls, model_dir):
+        """The cascade saved with a model version, or None."""
+        path = os.path.join(model_dir, CASCADE_FILE)
+        if not CASCADE_ENABLED or not os.path.exists(path):
+            return None
+        state = joblib.load(path)
+        cascade = cls(state["labels"], state["threshold"], n_features=state["n_features"], grid=state["grid"])
+        cascade.model = state["model"]
+        return cascade
+
+
+def calibrate_threshold(confidences, correct, target_accuracy=CASCADE_TARGET_ACCURACY):
+    """
+    Lowest confidence threshold whose accepted predictions (confidence >= threshold)
+    are at least `target_accuracy` accurate, or None if no threshold is.
+    """
+    order = np.argsort(-confidences, kind="stable")
+    accuracy = np.cumsum(correct[order]) / np.arange(1, len(order) + 1)
+    meets = np.nonzero(accuracy >= target_accuracy)[0]
+    if not len(meets):
+        return None
+    return float(confidences[order][meets[-1]])
+
+
+def train_cascade(documents, labels, all_labels, target_accuracy=CASCADE_TARGET_ACCURACY, seed=42):
+    """
+    Fit the cascade on labeled documents and calibrate its threshold on out-of-fold
+    predictions (stratified k-fold), so every calibration prediction is held out.
+
+    Returns:
+        tuple: (CascadeClassifier, metrics dict with the threshold, held-out coverage and accuracy)
+    """
+    cascade = CascadeClassifier(all_labels)
+    x = cascade.features(documents)
+    y = np.asarray(labels)
+    _, counts = np.unique(y, return_counts=True)
+    metrics = {"samples": len(y), "target_accuracy": target_accuracy, "threshold": None}
+
+    folds = min(5, int(counts.min())) if len(counts) > 1 else 0
+    if folds >= 2:
+        confidences = np.zeros(len(y))
+        correct = np.zeros(len(y))
+        for train_idx, test_idx in StratifiedKFold(folds, shuffle=True, random_state=seed).split(x, y):
+            fold = CascadeClassifier(all_labels).fit(x[train_idx], y[train_idx])
+            probs = fold.predict_proba(x[test_idx])
+            confidences[test_idx] = probs.max(axis=1)
+            correct[test_idx] = np.asarray(all_labels)[probs.argmax(axis=1)] == y[test_idx]
+        metrics["heldout_accuracy"] = float(correct.mean())
+
+        if len(y) >= CASCADE_MIN_CALIBRATION_SAMPLES:
+            threshold = calibrate_threshold(confidences, correct, target_accuracy)
+            if threshold is not None:
+                accepted = confidences >= threshold
+                metrics.update(
+                    threshold=threshold,
+                    heldout_coverage=float(accepted.mean()),
+                    heldout_accepted_accuracy=float(correct[accepted].mean())
+                )
+        else:
+            print(f"⚠️ Only {len(y)} samples to calibrate the cascade (need {CASCADE_MIN_CALIBRATION_SAMPLES}), it will defer every document")
+
+    if len(counts) > 1:
+        cascade.fit(x, y)
+        cascade.threshold = metrics["threshold"]
+    print(f"🔹 Cascade trained: {metrics}")
+    return cascade, metrics
@@ -0,0 +1,120 @@
+# collate.py
+import random
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+class DocumentCollator:
+    """
+    Pads a list of unpadded processor encodings to the longest sequence in the batch.
+
+    input_ids are padded with the tokenizer's pad id, bbox with [0, 0, 0, 0] (the
+    processor's own pad box) and attention_mask with 0. pixel_values and labels are
+    stacked as they are.
+    """
+
+    def __init__(self, pad_token_id, pad_to_multiple_of=None):
+        self.pad_token_id = pad_token_id
+        self.pad_to_multiple_of = pad_to_multiple_of
+
+    def __call__(self, features):
+        max_len = max(len(f["input_ids"]) for f in features)
+        if self.pad_to_multiple_of:
+            max_len = -(-max_len // self.pad_to_multiple_of) * self.pad_to_multiple_of
+
+        batch_size = len(features)
+        input_ids = torch.full((batch_size, max_len), self.pad_token_id, dtype=torch.long)
+        bbox = torch.zeros((batch_size, max_len, 4), dtype=torch.long)
+        attention_mask = torch.zeros((batch_size, max_len), dtype=torch.long)
+
+        for i, f in enumerate(features):
+            n = len(f["input_ids"])
+            _fill(input_ids[i, :n], f["input_ids"])
+            _fill(bbox[i, :n], f["bbox"])
+            if "attention_mask" in f:
+                _fill(attention_mask[i, :n], f["attention_mask"])
+            else:
+                attention_mask[i, :n] = 1
+
+        batch = {"input_ids": input_ids, "bbox": bbox, "attention_mask": attention_mask}
+        if "pixel_values" in features[0]:
+            batch["pixel_values"] = torch.stack([torch.as_tensor(f["pixel_values"]) for f in features])
+        if "labels" in features[0]:
+            batch["labels"] = torch.stack([torch.as_tensor(f["labels"]) for f in features])
+        return batch
+
+
+def _fill(dst, src):
+    # Cached features arrive as read-only memmap slices; copy them straight into the batch
+    if isinstance(src, np.ndarray):
+        dst.numpy()[...] = src
+    else:
+        dst.copy_(torch.as_tensor(src))
+
+
+def bucket_batches(lengths, batch_size, bucket_size_multiplier=50, shuffle=False, seed=0):
+    """
+    Split indices into batches of similar length.
+
+    Indices are (optionally) shuffled, cut into buckets of `batch_size *
+    bucket_size_multiplier`, sorted by length inside each bucket and chunked into
+    batches, so each batch pads to a length close to its own members'.
+
+    Returns:
+        list: Lists of indices, one per batch.
+    """
+    indices = list(range(len(lengths)))
+    rng = random.Random(seed)
+    if shuffle:
+        rng.shuffle(indices)
+
+    bucket_size = batch_size * bucket_size_multiplier
+    batches = []
+    for start in range(0, len(indices), bucket_size):
+        bucket = sorted(indices[start:start + bucket_size], key=lambda i: lengths[i], reverse=True)
+        batches.extend(bucket[i:i + batch_size] for i in range(0, len(bucket), batch_size))
+
+    if shuffle:
+        rng.shuffle(batches)
+    return batches
+
+
+class LengthBucketSampler(Sampler):
+    """
+    Index sampler for a DataLoader with `batch_size` that yields similar-length
+    documents next to each other, reshuffled every epoch. The batches of
+    bucket_batches stay intact: the (at most one) short batch is always yielded last.
+
+    Like DistributedSampler, the shuffle only changes through set_epoch (the
+    Trainer calls it at the start of every epoch); iterating twice without it
+    yields the same order.
+    """
+
+    def __init__(self, lengths, batch_size, bucket_size_multiplier=50, seed=0):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.bucket_size_multiplier = bucket_size_multiplier
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __iter__(self):
+        batches = bucket_batches(
+            self.lengths,
+            self.batch_size,
+            bucket_size_multiplier=self.bucket_size_multiplier,
+            shuffle=True,
+            seed=self.seed + self.epoch
+        )
+        # The DataLoader re-chunks this flat index stream into batch_size pieces; a short
+        # batch anywhere but last would shift every later chunk across batch boundaries
+        batches.sort(key=lambda batch: len(batch) < self.batch_size)
+        for batch in batches:
+            yield from batch
@@ -0,0 +1,383 @@
+# corpus.py
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import struct
+from array import array
+from collections import Counter
+import threading
+from contextlib import contextmanager
+
+CORPUS_DIR = os.path.join("train_data", "corpus")
+# Document types the classifier is trained on; samples with other labels are never trained on
+LABELS = ["Invoice", "Poliza", "Packing List", "Other"]
+SHARD_SIZE = 1000  # samples per shard file
+
+# Record layout (little endian):
+#   magic "LMS1", uint32 body size
+#   body: 32-byte sha256, uint16 label size, uint32 word count, label (utf-8),
+#         uint32 byte size per word, word bytes (utf-8), int16 boxes (4 per word),
+#         int16 page per word, then optionally uint8 key-value flag per word
+#         (records written before the flag existed end after the pages)
+_MAGIC = b"LMS1"
+_HEADER = struct.Struct("<4sI")
+_BODY_HEAD = struct.Struct("<32sHI")
+
+
+@contextmanager
+def locked(directory):
+    """Exclusive inter-process lock on `directory` (held through a .lock file inside it)."""
+    with open(os.path.join(directory, ".lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def sample_hash(words, boxes):
+    """Content hash of a sample (label excluded, so relabelled duplicates are caught)."""
+    h = hashlib.sha256()
+    h.update(json.dumps(words, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+    h.update(array("h", [int(v) for box in boxes for v in box]).tobytes())
+    return h.hexdigest()
+
+
+def encode_record(digest, words, boxes, label, pages=None, key_value=None):
+    label_bytes = label.encode("utf-8")
+    word_bytes = [w.encode("utf-8") for w in words]
+    n = len(words)
+    if len(boxes) != n:
+        raise ValueError(f"Sample has {n} words but {len(boxes)} boxes.")
+    if pages is None:
+        pages = [1] * n
+    if key_value is not None and len(key_value) != n:
+        raise ValueError(f"Sample has {n} words but {len(key_value)} key-value flags.")
+
+    body = b"".join([
+        _BODY_HEAD.pack(bytes.fromhex(digest), len(label_bytes), n),
+        label_bytes,
+        array("I", [len(b) for b in word_bytes]).tobytes(),
+        b"".join(word_bytes),
+        array("h", [int(v) for box in boxes for v in box]).tobytes(),
+        array("h", pages).tobytes(),
+        bytes(bool(flag) for flag in key_value) if key_value is not None else b"",
+    ])
+    return _HEADER.pack(_MAGIC, len(body)) + body
+
+
+def decode_record(buf, offset=0):
+    magic, size = _HEADER.unpack_from(buf, offset)
+    if magic != _MAGIC:
+        raise ValueError(f"Corrupt corpus record at offset {offset}.")
+    pos = offset + _HEADER.size
+    digest, label_len, n = _BODY_HEAD.unpack_from(buf, pos)
+    pos += _BODY_HEAD.size
+    label = bytes(buf[pos:pos + label_len]).decode("utf-8")
+    pos += label_len
+
+    word_lens = array("I")
+    word_lens.frombytes(buf[pos:pos + 4 * n])
+    pos += 4 * n
+    words = []
+    for length in word_lens:
+        words.append(bytes(buf[pos:pos + length]).decode("utf-8"))
+        pos += length
+
+    boxes = array("h")
+    boxes.frombytes(buf[pos:pos + 8 * n])
+    pos += 8 * n
+    pages = array("h")
+    pages.frombytes(buf[pos:pos + 2 * n])
+    pos += 2 * n
+
+    sample = {
+        "hash": digest.hex(),
+        "words": words,
+        "boxes": [list(boxes[i:i + 4]) for i in range(0, len(boxes), 4)],
+        "pages": list(pages),
+        "label": label
+    }
+    if pos < offset + _HEADER.size + size:
+        sample["key_value"] = [flag == 1 for flag in buf[pos:pos + n]]
+    return sample
+
+
+class CorpusStore:
+    """
+    Append-only, deduplicated training corpus split into fixed-size shard files.
+
+    Samples are stored in a compact binary form (a per-sample word string table
+    plus int16 box and page arrays and, when known, the Textract key-value flag of
+    every word). `samples.idx` holds one JSON line per sample
+    (hash, shard, offset, size, label, word count) and `index.json` a summary with
+    label counts and shard sizes. Relabelling a stored sample appends a
+    {"hash", "relabel"} line to `samples.idx`; the latest label wins, the record
+    itself is never rewritten. Appends take an exclusive file lock, so several
+    workers or processes can add samples concurrently. Reads go through mmap and
+    never load the whole corpus.
+    """
+
+    def __init__(self, root=CORPUS_DIR, shard_size=SHARD_SIZE):
+        self.root = root
+        self.shard_size = shard_size
+        os.makedirs(root, exist_ok=True)
+        self._entries = None
+        self._hashes = None
+        self._index_size = 0
+        self._maps = {}
+        # The file lock only excludes other processes; threads sharing this store
+        # (see get_corpus_store) also serialise on this one
+        self._thread_lock = threading.RLock()
+        # Running totals kept by _refresh, so appends never rescan the index
+        self._label_counts = Counter()
+        self._shard_counts = Counter()
+        self._total_words = 0
+
+    # ----- paths -----
+    @property
+    def index_path(self):
+        return os.path.join(self.root, "samples.idx")
+
+    @property
+    def summary_path(self):
+        return os.path.join(self.root, "index.json")
+
+    def shard_path(self, shard):
+        return os.path.join(self.root, f"shard-{shard:05d}.bin")
+
+    def _locked(self):
+        return locked(self.root)
+
+    # ----- index -----
+    def _refresh(self):
+        """Pick up entries appended (by this or another process) since the last read."""
+        with self._thread_lock:
+            self._refresh_locked()
+
+    def _refresh_locked(self):
+        if self._entries is None:
+            self._entries = []
+            self._hashes = {}
+            self._index_size = 0
+            self._label_counts = Counter()
+            self._shard_counts = Counter()
+            self._total_words = 0
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, "rb") as f:
+            f.seek(self._index_size)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # partially written line, picked up next time
+                self._index_size += len(line)
+                entry = json.loads(line)
+                if "relabel" in entry:
+                    existing = self._entries[self._hashes[entry["hash"]]]
+                    self._label_counts[existing["label"]] -= 1
+                    self._label_counts[entry["relabel"]] += 1
+                    existing["label"] = entry["relabel"]
+                    continue
+                self._hashes[entry["hash"]] = len(self._entries)
+                self._entries.append(entry)
+                self._label_counts[entry["label"]] += 1
+                self._shard_counts[entry["shard"]] += 1
+                self._total_words += entry["n_words"]
+
+    @property
+    def entries(self):
+        self._refresh()
+        return self._entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, digest):
+        self._refresh()
+        return digest in self._hashes
+
+    def summary(self):
+        with self._thread_lock:
+            self._refresh()
+            return {
+                "samples": len(self._entries),
+                "label_counts": {label: count for label, count in self._label_counts.items() if count},
+                "total_words": self._total_words,
+                "shards": {self.shard_path(s): count for s, count in sorted(self._shard_counts.items())}
+            }
+
+    def _write_summary(self):
+        tmp_path = f"{self.summary_path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump(self.summary(), f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, self.summary_path)
+
+    # ----- writes -----
+    def append(self, words, boxes, label, pages=None, key_value=None):
+        """Add one sample. Returns (hash, added); added is False for duplicates."""
+        return self.append_many([{"words": words, "boxes": boxes, "label": label, "pages": pages, "key_value": key_value}])[0]
+
+    def append_many(self, samples):
+        """
+        Add many samples under one lock and one write per shard.
+
+        A sample already stored under another label is relabelled (the latest
+        upload's label wins) and reported as not added.
+
+        Returns:
+            list: (hash, added) per sample, in order.
+        """
+        results = []
+        relabels = {}
+        with self._thread_lock, self._locked():
+            self._refresh()
+            current_shard = self._entries[-1]["shard"] if self._entries else 0
+            in_shard = self._shard_counts[current_shard]
+
+            pending = {}  # shard -> list of (record bytes, entry)
+            batch_hashes = set()
+            for sample in samples:
+                # Callers may hash in their own workers to keep it out of the lock
+                digest = sample.get("hash") or sample_hash(sample["words"], sample["boxes"])
+                if digest in batch_hashes:
+                    results.append((digest, False))
+                    continue
+                if digest in self._hashes:
+                    existing = self._entries[self._hashes[digest]]
+                    if relabels.get(digest, existing["label"]) != sample["label"]:
+                        print(f"🔹 Sample {digest[:12]} relabelled from '{relabels.get(digest, existing['label'])}' to '{sample['label']}'.")
+                        relabels[digest] = sample["label"]
+                    results.append((digest, False))
+                    continue
+
+                if in_shard >= self.shard_size:
+                    current_shard += 1
+                    in_shard = 0
+                record = encode_record(digest, sample["words"], sample["boxes"], sample["label"], sample.get("pages"),
+                                       sample.get("key_value"))
+                entry = {
+                    "hash": digest,
+                    "shard": current_shard,
+                    "size": len(record),
+                    "label": sample["label"],
+                    "n_words": len(sample["words"])
+                }
+                pending.setdefault(current_shard, []).append((record, entry))
+                batch_hashes.add(digest)
+                in_shard += 1
+                results.append((digest, True))
+
+            new_entries = []
+            for shard, records in pending.items():
+                fd = os.open(self.shard_path(shard), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    offset = os.fstat(fd).st_size
+                    for record, entry in records:
+                        entry["offset"] = offset
+                        offset += len(record)
+                        new_entries.append(entry)
+                    os.write(fd, b"".join(record for record, _ in records))
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                self._maps.pop(shard, None)
+
+            index_lines = [json.dumps(e, ensure_ascii=False) + "\n" for e in new_entries]
+            index_lines += [json.dumps({"hash": d, "relabel": label}, ensure_ascii=False) + "\n" for d, label in relabels.items()]
+            if index_lines:
+                # Index lines are only written once the records are on disk
+                with open(self.index_path, "a") as f:
+                    f.write("".join(index_lines))
+                    f.flush()
+                    os.fsync(f.fileno())
+            self._refresh()
+            if index_lines:
+                self._write_summary()
+        return results
+
+    def import_jsonl(self, jsonl_path):
+        """Import a legacy train.jsonl file. Returns the number of new samples."""
+        with open(jsonl_path, "r") as f:
+            samples = [json.loads(line) for line in f if line.strip()]
+        return sum(added for _, added in self.append_many(samples))
+
+    # ----- reads -----
+    def _map(self, shard):
+        m = self._maps.get(shard)
+        if m is None:
+            with open(self.shard_path(shard), "rb") as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[shard] = m
+        return m
+
+    def read(self, entry):
+        m = self._map(entry["shard"])
+        if entry["offset"] + entry["size"] > len(m):
+            # The shard grew since it was mapped
+            self._maps.pop(entry["shard"], None)
+            m = self._map(entry["shard"])
+        sample = decode_record(m, entry["offset"])
+        # The index holds the current label, which differs from the record's after a relabel
+        sample["label"] = entry["label"]
+        return sample
+
+    def __getitem__(self, idx):
+        return self.read(self.entries[idx])
+
+    def get(self, digest):
+        self._refresh()
+        idx = self._hashes.get(digest)
+        return None if idx is None else self.read(self._entries[idx])
+
+    def __iter__(self):
+        """Stream every sample, shard by shard."""
+        for entry in list(self.entries):
+            yield self.read(entry)
+
+    def view(self, predicate=None):
+        """A read-only, indexable subset of the corpus selected by its index entries."""
+        return CorpusView(self, [e for e in self.entries if predicate is None or predicate(e)])
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_corpus_store(root=CORPUS_DIR):
+    """
+    Process-wide CorpusStore for `root`, so repeated appends (one per upload)
+    reuse the index already read instead of re-reading samples.idx each time.
+    """
+    key = os.path.abspath(root)
+    store = _stores.get(key)
+    if store is None:
+        with _stores_lock:
+            store = _stores.get(key)
+            if store is None:
+                store = _stores[key] = CorpusStore(root)
+    return store
+
+
+class CorpusView:
+    def __init__(self, store, entries):
+        self.store = store
+        self.entries = entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, idx):
+        return self.store.read(self.entries[idx])
+
+    def __iter__(self):
+        for entry in self.entries:
+            yield self.store.read(entry)
+
+    def fingerprint(self):
+        """SHA-256 over the (sample hash, label) pairs, independent of their order."""
+        h = hashlib.sha256()
+        for digest, label in sorted((e["hash"], e["label"]) for e in self.entries):
+            h.update(f"{digest}\t{label}\n".encode("utf-8"))
+        return h.hexdigest()
@@ -0,0 +1,115 @@
+# embedding_cache.py
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from corpus import locked
+from feature_cache import processor_fingerprint
+
+EMBEDDING_CACHE_DIR = os.path.join("train_data", "embedding_cache")
+
+
+def backbone_fingerprint(model):
+    """
+    Identify the encoder weights of a sequence classification model (everything but
+    the classification head), so embeddings computed by one backbone are never
+    reused with another. A model trained in head-only mode keeps its backbone's
+    fingerprint.
+    """
+    h = hashlib.sha1()
+    for name, tensor in sorted(model.base_model.state_dict().items()):
+        h.update(name.encode())
+        h.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()[:16]
+
+
+class EmbeddingCache:
+    """
+    Persistent cache of pooled ([CLS]) encoder embeddings, one float32 vector per
+    training item.
+
+    Vectors are stored as rows of one flat binary file read back through np.memmap,
+    with an append-only `index.jsonl` mapping each item key (sample hash, plus the
+    window for windowed items) to its row, like FeatureCache. One cache directory
+    exists per (backbone fingerprint, processor fingerprint, max_length).
+    """
+
+    def __init__(self, backbone, processor, dim, max_length=512, root=EMBEDDING_CACHE_DIR):
+        self.dim = dim
+        self.dir = os.path.join(root, f"{backbone}-{processor_fingerprint(processor)}-{max_length}")
+        os.makedirs(self.dir, exist_ok=True)
+        self._index = {}
+        self._index_size = 0
+        self._map = None
+
+    @property
+    def data_path(self):
+        return os.path.join(self.dir, "embeddings.f32")
+
+    @property
+    def index_path(self):
+        return os.path.join(self.dir, "index.jsonl")
+
+    def _refresh(self):
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, "rb") as f:
+            f.seek(self._index_size)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                self._index_size += len(line)
+                entry = json.loads(line)
+                self._index[entry["key"]] = entry["row"]
+
+    def _rows(self, needed_rows):
+        if self._map is None or len(self._map) < needed_rows:
+            rows = os.path.getsize(self.data_path) // (4 * self.dim)
+            self._map = np.memmap(self.data_path, dtype=np.float32, mode="r", shape=(rows, self.dim))
+        return self._map
+
+    def __len__(self):
+        self._refresh()
+        return len(self._index)
+
+    def __contains__(self, key):
+        if key not in self._index:
+            self._refresh()
+        return key in self._index
+
+    def get_many(self, keys):
+        """
+        Returns:
+            np.ndarray: len(keys) x dim embeddings. Raises KeyError if one is missing.
+        """
+        self._refresh()
+        rows = [self._index[key] for key in keys]
+        if not rows:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.asarray(self._rows(max(rows) + 1)[rows])
+
+    def put_many(self, items):
+        """Store (key, vector) pairs; keys already in the cache are skipped."""
+        with locked(self.dir):
+            self._refresh()
+            items = [(key, vector) for key, vector in items if key not in self._index]
+            if not items:
+                return
+
+            start = os.path.getsize(self.data_path) // (4 * self.dim) if os.path.exists(self.data_path) else 0
+            data = np.stack([np.asarray(vector, dtype=np.float32).reshape(self.dim) for _, vector in items])
+            # Written at the row recorded in the index, so an interrupted write can't shift later rows
+            fd = os.open(self.data_path, os.O_WRONLY | os.O_CREAT, 0o644)
+            try:
+                os.pwrite(fd, data.tobytes(), start * 4 * self.dim)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+            with open(self.index_path, "a") as f:
+                f.write("".join(json.dumps({"key": key, "row": start + i}) + "\n" for i, (key, _) in enumerate(items)))
+                f.flush()
+                os.fsync(f.fileno())
+            self._refresh()
@@ -0,0 +1,247 @@
+# export_backends.py
+import inspect
+import json
+import os
+import shutil
+
+import torch
+from transformers import AutoProcessor, AutoModelForSequenceClassification
+
+from model_holder import MODEL_DIR, MODEL_VOLUME_PATH, READY_MARKER, checkpoint_version, replace_dir, write_ready_marker
+from inference_backends import INT8_WEIGHTS, ONNX_MODEL, backend_dir, load_backend_model, quantize_int8
+from blank_page import blank_pixel_values, uses_visual_tokens
+from corpus import locked
+from word_selection import WordSelection
+from model_registry import METADATA_FILE, ModelRegistry
+
+# Artifacts built after every training run (EXPORT_BACKENDS="" turns the step off)
+EXPORT_BACKENDS = [b for b in os.environ.get("EXPORT_BACKENDS", "int8,onnx").split(",") if b]
+ONNX_OPSET = 14
+
+# An artifact is only accepted if, on the parity set, it predicts the same label as
+# fp32 for at least PARITY_MIN_AGREEMENT of the documents and no confidence moves by
+# more than PARITY_MAX_CONFIDENCE_DELTA
+PARITY_SAMPLES = int(os.environ.get("PARITY_SAMPLES", "200"))
+PARITY_MIN_AGREEMENT = float(os.environ.get("PARITY_MIN_AGREEMENT", "0.99"))
+PARITY_MAX_CONFIDENCE_DELTA = float(os.environ.get("PARITY_MAX_CONFIDENCE_DELTA", "0.05"))
+PARITY_REPORT = "parity.json"
+BACKENDS_REPORT = "backends.json"
+
+
+def export_int8(model, processor, output_dir):
+    os.makedirs(output_dir, exist_ok=True)
+    quantized = quantize_int8(model)
+    torch.save(quantized.state_dict(), os.path.join(output_dir, INT8_WEIGHTS))
+    model.config.save_pretrained(output_dir)
+
+
+class _LogitsOnly(torch.nn.Module):
+    # torch.onnx traces positional tensors and a single tensor output
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, bbox, attention_mask, pixel_values=None):
+        return self.model(
+            input_ids=input_ids,
+            bbox=bbox,
+            attention_mask=attention_mask,
+            pixel_values=pixel_values
+        ).logits
+
+
+def export_onnx(model, processor, output_dir):
+    os.makedirs(output_dir, exist_ok=True)
+    encoding = processor.tokenizer(
+        [["export", "sample"], ["export"]],
+        boxes=[[[0, 0, 10, 10], [20, 0, 40, 10]], [[0, 0, 10, 10]]],
+        padding=True,
+        return_tensors="pt"
+    )
+    names = ["input_ids", "bbox", "attention_mask"]
+    args = [encoding[name] for name in names]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in names}
+    if uses_visual_tokens(model):
+        names.append("pixel_values")
+        args.append(blank_pixel_values(processor).expand(len(args[0]), -1, -1, -1).contiguous())
+        dynamic_axes["pixel_values"] = {0: "batch"}
+    dynamic_axes["logits"] = {0: "batch"}
+
+    kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        kwargs["dynamo"] = False  # newer torch defaults to the dynamo exporter
+    with torch.no_grad():
+        torch.onnx.export(
+            _LogitsOnly(model.eval()),
+            tuple(args),
+            os.path.join(output_dir, ONNX_MODEL),
+            input_names=names,
+            output_names=["logits"],
+            dynamic_axes=dynamic_axes,
+            opset_version=ONNX_OPSET,
+            **kwargs
+        )
+    model.config.save_pretrained(output_dir)
+
+
+EXPORTERS = {"int8": export_int8, "onnx": export_onnx}
+
+
+def parity_documents(data, limit=PARITY_SAMPLES):
+    """
+    Pick up to `limit` samples of a corpus view for the parity check. Samples are
+    taken in hash order, which is stable across runs and independent of the label.
+    """
+    if data is None:
+        return []
+    order = sorted(range(len(data)), key=lambda i: data.entries[i]["hash"])[:limit]
+    return [data[i] for i in order]
+
+
+def check_parity(reference, candidate):
+    """
+    Compare two lists of predict_batch results over the same documents.
+
+    Returns:
+        dict: Label agreement, confidence deltas and whether the candidate is accepted.
+    """
+    n = len(reference)
+    if n == 0:
+        return {"documents": 0, "accepted": False, "error": "No documents to check parity on."}
+    agree = sum(r["label"] == c["label"] for r, c in zip(reference, candidate))
+    deltas = [
+        abs(r["probabilities"][label] - c["probabilities"][label])
+        for r, c in zip(reference, candidate)
+        for label in r["probabilities"]
+    ]
+    report = {
+        "documents": n,
+        "label_agreement": agree / n,
+        "max_confidence_delta": max(deltas),
+        "mean_confidence_delta": sum(deltas) / len(deltas)
+    }
+    report["accepted"] = (
+        report["label_agreement"] >= PARITY_MIN_AGREEMENT
+        and report["max_confidence_delta"] <= PARITY_MAX_CONFIDENCE_DELTA
+    )
+    return report
+
+
+def build_backends(source_dir, model_dir, version, documents, backends=None):
+    """
+    Export the fp32 checkpoint in `source_dir` to each backend, check it against fp32 on
+    `documents` and install the accepted ones under `model_dir`/backends, stamped with `version`.
+    Both are fed the words as served: with the word selection saved in `source_dir`.
+
+    A rejected or failed export never replaces an existing artifact. The per-backend
+    reports are written to backends.json in `source_dir`.
+
+    Returns:
+        dict: Parity report per backend.
+    """
+    # Imported here: importjson pulls in the serving-side modules this script doesn't otherwise need
+    from importjson import predict_batch
+
+    backends = EXPORT_BACKENDS if backends is None else backends
+    processor = AutoProcessor.from_pretrained(source_dir, apply_ocr=False)
+    reference_model = AutoModelForSequenceClassification.from_pretrained(source_dir).eval()
+    selection = WordSelection.load(source_dir)
+    reference = predict_batch(documents, processor=processor, model=reference_model, selection=selection)
+
+    reports = {}
+    for backend in backends:
+        if backend not in EXPORTERS:
+            print(f"⚠️ Unknown export backend '{backend}', skipping.")
+            continue
+        target_dir = backend_dir(model_dir, backend)
+        os.makedirs(os.path.dirname(target_dir), exist_ok=True)
+        staging_dir = f"{target_dir}.tmp-{os.getpid()}"
+        if os.path.exists(staging_dir):
+            shutil.rmtree(staging_dir)
+
+        print(f"🔹 Exporting {backend} backend...")
+        try:
+            EXPORTERS[backend](reference_model, processor, staging_dir)
+            candidate = load_backend_model(staging_dir, backend)
+            report = check_parity(reference, predict_batch(documents, processor=processor, model=candidate, selection=selection))
+        except Exception as e:
+            report = {"accepted": False, "error": str(e)}
+        report["version"] = version
+        reports[backend] = report
+
+        if report["accepted"]:
+            with open(os.path.join(staging_dir, PARITY_REPORT), "w") as f:
+                json.dump(report, f, indent=2)
+            write_ready_marker(staging_dir, version)
+            replace_dir(staging_dir, target_dir)
+            print(f"✅ {backend} backend accepted: {report}")
+        else:
+            if os.path.exists(staging_dir):
+                shutil.rmtree(staging_dir)
+            print(f"⚠️ {backend} backend rejected: {report}")
+
+    with open(os.path.join(source_dir, BACKENDS_REPORT), "w") as f:
+        json.dump(reports, f, indent=2)
+    return reports
+
+
+def main():
+    """
+    Rebuild the backends of the active model version as a new registry version: the
+    checkpoint is copied, exported and checked against fp32 on held-out validation
+    samples, then activated. The active version itself is never modified.
+    """
+    import train_layoutlm
+
+    with locked(MODEL_VOLUME_PATH):
+        model_dir = os.path.realpath(MODEL_DIR)
+        base_version = checkpoint_version(model_dir)
+        if base_version is None:
+            print(f"❌ Trained model not found at '{MODEL_DIR}'. Please train the model first.")
+            return
+
+        registry = ModelRegistry()
+        data = train_layoutlm.load_corpus()
+        if data is None:
+            print("❌ No samples to check the exported backends against.")
+            return
+        # The version's own validation samples; never ones the checkpoint was trained on
+        _, validation = train_layoutlm.split_train_validation(
+            data,
+            trained=registry.seen_samples(base_version),
+            pinned=registry.validation_samples(base_version)
+        )
+        if not len(validation):
+            print("⚠️ No held-out validation samples, checking parity on the training corpus.")
+            validation = data
+        documents = parity_documents(validation)
+
+        staging_dir = registry.staging_dir()
+        version = registry.new_version()
+        try:
+            for name in os.listdir(model_dir):
+                if name in ("backends", READY_MARKER, METADATA_FILE, BACKENDS_REPORT):
+                    continue
+                source = os.path.join(model_dir, name)
+                if os.path.isdir(source):
+                    shutil.copytree(source, os.path.join(staging_dir, name))
+                else:
+                    shutil.copy2(source, staging_dir)
+            reports = build_backends(staging_dir, staging_dir, version, documents)
+            metadata = registry.metadata(base_version)
+            metadata.pop("created_at", None)
+            registry.commit(staging_dir, version, dict(
+                metadata,
+                backends={backend: report["accepted"] for backend, report in reports.items()},
+                backends_rebuilt_from=base_version,
+                parity_samples=len(documents)
+            ))
+        except Exception:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
+        registry.activate(version, reason="export")
+        registry.prune()
+
+
+if __name__ == "__main__":
+    main()
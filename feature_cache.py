@@ -0,0 +1,150 @@
+# feature_cache.py
+import hashlib
+import json
+import os
+
+import numpy as np
+import transformers
+
+from corpus import locked
+
+FEATURE_CACHE_DIR = os.path.join("train_data", "feature_cache")
+
+# Stored per token; boxes are 0-1000 so int16 is enough
+_FIELDS = {
+    "input_ids": (np.int32, 1),
+    "bbox": (np.int16, 4),
+    "attention_mask": (np.uint8, 1),
+}
+
+
+def processor_fingerprint(processor):
+    """
+    Identify everything that changes the tokenized output: tokenizer class and
+    vocabulary, special tokens and the transformers version.
+    """
+    tokenizer = processor.tokenizer
+    h = hashlib.sha1()
+    h.update(type(tokenizer).__name__.encode())
+    h.update(transformers.__version__.encode())
+    h.update(json.dumps(tokenizer.get_vocab(), sort_keys=True, ensure_ascii=False).encode("utf-8"))
+    h.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True).encode("utf-8"))
+    return h.hexdigest()[:16]
+
+
+class FeatureCache:
+    """
+    Persistent cache of tokenized features (input_ids, bbox, attention_mask).
+
+    Features of all samples are concatenated into one flat binary file per field
+    and read back through np.memmap, so hits are zero-copy slices. An append-only
+    `index.jsonl` maps each sample hash to its token offset and length. One cache
+    directory exists per (processor fingerprint, max_length), so a new tokenizer or
+    truncation length never reuses stale features.
+    """
+
+    def __init__(self, processor, max_length=512, root=FEATURE_CACHE_DIR):
+        self.max_length = max_length
+        self.dir = os.path.join(root, f"{processor_fingerprint(processor)}-{max_length}")
+        os.makedirs(self.dir, exist_ok=True)
+        self._index = {}
+        self._index_size = 0
+        self._maps = {}
+        self._mapped_tokens = 0
+
+    def _path(self, field):
+        return os.path.join(self.dir, f"{field}.bin")
+
+    @property
+    def index_path(self):
+        return os.path.join(self.dir, "index.jsonl")
+
+    def _refresh(self):
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, "rb") as f:
+            f.seek(self._index_size)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                self._index_size += len(line)
+                entry = json.loads(line)
+                self._index[entry["hash"]] = (entry["offset"], entry["length"])
+
+    def _remap(self, needed_tokens):
+        if needed_tokens <= self._mapped_tokens:
+            return
+        self._maps = {}
+        totals = []
+        for field, (dtype, width) in _FIELDS.items():
+            total = os.path.getsize(self._path(field)) // (np.dtype(dtype).itemsize * width)
+            self._maps[field] = np.memmap(self._path(field), dtype=dtype, mode="r", shape=(total, width) if width > 1 else (total,))
+            totals.append(total)
+        self._mapped_tokens = min(totals)
+
+    def __len__(self):
+        self._refresh()
+        return len(self._index)
+
+    def __contains__(self, digest):
+        if digest not in self._index:
+            self._refresh()
+        return digest in self._index
+
+    def length(self, digest):
+        """Token length of a cached sample, or None."""
+        if digest not in self:
+            return None
+        return self._index[digest][1]
+
+    def get(self, digest):
+        """Cached features as read-only memmap slices, or None on a miss."""
+        if digest not in self:
+            return None
+        offset, length = self._index[digest]
+        self._remap(offset + length)
+        return {field: self._maps[field][offset:offset + length] for field in _FIELDS}
+
+    def put(self, digest, encoding):
+        self.put_many([(digest, encoding)])
+
+    def put_many(self, items):
+        """
+        Store encodings (dicts of unpadded 1-D input_ids/attention_mask and Nx4 bbox,
+        as tensors, arrays or lists) for the given sample hashes.
+        """
+        with locked(self.dir):
+            self._refresh()
+            items = [(d, e) for d, e in items if d not in self._index]
+            if not items:
+                return
+
+            ids_path = self._path("input_ids")
+            offset = os.path.getsize(ids_path) // 4 if os.path.exists(ids_path) else 0
+            entries = []
+            chunks = {field: [] for field in _FIELDS}
+            for digest, encoding in items:
+                length = len(encoding["input_ids"])
+                for field, (dtype, width) in _FIELDS.items():
+                    chunks[field].append(np.asarray(encoding[field], dtype=dtype).reshape(length, width) if width > 1
+                                         else np.asarray(encoding[field], dtype=dtype).reshape(length))
+                entries.append({"hash": digest, "offset": offset, "length": length})
+                offset += length
+
+            # Every field is written at the token offset recorded in the index (not
+            # appended), so an earlier interrupted write can't misalign the fields
+            start = entries[0]["offset"]
+            for field, (dtype, width) in _FIELDS.items():
+                data = np.concatenate(chunks[field]).tobytes()
+                fd = os.open(self._path(field), os.O_WRONLY | os.O_CREAT, 0o644)
+                try:
+                    os.pwrite(fd, data, start * np.dtype(dtype).itemsize * width)
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+            with open(self.index_path, "a") as f:
+                f.write("".join(json.dumps(e) + "\n" for e in entries))
+                f.flush()
+                os.fsync(f.fileno())
+            self._refresh()
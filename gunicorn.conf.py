@@ -0,0 +1,45 @@
+# gunicorn.conf.py
+# Production serving: gunicorn -c gunicorn.conf.py app:app
+#
+# The app is imported and the model loaded once in the master, before the workers
+# are forked, so every worker shares the weights copy-on-write instead of loading
+# its own copy. Each worker then warms up, sizes its torch thread pool and starts
+# its own checkpoint watcher (threads don't survive a fork).
+import multiprocessing
+import os
+
+# Read by app.py: don't start the watcher thread in the master
+os.environ["MODEL_PRELOADED_BY_SERVER"] = "1"
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("GUNICORN_WORKERS", str(multiprocessing.cpu_count())))
+# Threads let the micro-batcher group concurrent requests inside a worker
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "4"))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "180"))
+preload_app = True
+
+# One core's worth of intra-op threads per worker by default, so workers don't oversubscribe the CPU
+torch_threads = int(os.environ.get("TORCH_THREADS_PER_WORKER", str(max(1, multiprocessing.cpu_count() // workers))))
+
+
+def when_ready(server):
+    # Runs in the master after the app is imported and before any worker is forked.
+    # No inference here: the worker processes run the first forward pass themselves.
+    from model_holder import get_model_holder
+
+    try:
+        get_model_holder().load(warm=False)
+    except FileNotFoundError as e:
+        server.log.warning(f"{e} Workers will load it once it is published.")
+
+
+def post_fork(server, worker):
+    import torch
+    from model_holder import get_model_holder
+
+    torch.set_num_threads(torch_threads)
+    holder = get_model_holder()
+    holder.warm()
+    holder.start()
+    server.log.info(f"Worker {worker.pid} ready (torch threads: {torch_threads}, model version: {holder.version})")
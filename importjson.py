@@ -1,158 +1,221 @@
-import json
 import pandas as pd
 import os
-from PIL import Image
 import torch
-from transformers import AutoProcessor, AutoModelForSequenceClassification
+from model_holder import get_model_holder
+from collate import DocumentCollator, bucket_batches
+from textract_document import TextractDocument
+from textract_stream import stream_layoutlm_data
+from textract_tables import extract_tables
+from corpus import get_corpus_store
+from windowing import WindowConfig, split_windows, pool_logits
+from blank_page import add_blank_pixel_values
+from cascade import PREDICTION_STAGES
+from metrics import span, BATCH_SIZE, DOCUMENTS, TOKENS, TRUNCATIONS, WORDS
+
+# Largest number of documents padded together in one forward pass of predict_batch
+PREDICT_BUCKET_SIZE = int(os.environ.get("PREDICT_BUCKET_SIZE", "8"))
+# Long-document handling (WINDOW_MODE=none|tokens|pages, WINDOW_POOLING=mean|max|first_page, ...),
+# shared with train_layoutlm so training and prediction split documents the same way
+PREDICT_WINDOWS = WindowConfig.from_env()
 
 def extract_layoutlm_data(json_path, label, output_dir="train_data"):
-    # Ensure output directory exists
-    os.makedirs(output_dir, exist_ok=True)
-
-    # Load Textract JSON
-    with open(json_path, 'r') as f:
-        data = json.load(f)
-
-    words = []
-    boxes = []
-
-    for block in data.get("Blocks", []):
-        if block.get("BlockType") == "WORD":
-            words.append(block["Text"])
-            bbox = block["Geometry"]["BoundingBox"]
-            x0 = int(bbox["Left"] * 1000)
-            y0 = int(bbox["Top"] * 1000)
-            x1 = int((bbox["Left"] + bbox["Width"]) * 1000)
-            y1 = int((bbox["Top"] + bbox["Height"]) * 1000)
-            boxes.append([x0, y0, x1, y1])
-
-    # Final JSONL structure
-    jsonl_data = {
-        "words": words,
-        "boxes": boxes,
-        "label": label
-    }
-
-    # Always save as train.jsonl
-    output_path = os.path.join(output_dir, "train.jsonl")
-    with open(output_path, 'w') as f_out:
-        f_out.write(json.dumps(jsonl_data) + "\n")
-
-    print(f"✅ Generated training file at: {output_path}")
-    return output_path
-
-def predict_document(jsonl_path):
-    MODEL_VOLUME_PATH = "/train_model_dsk"
-    MODEL_DIR = os.path.join(MODEL_VOLUME_PATH, "fine_tuned_layoutlmv3")
-
-    if not os.path.exists(MODEL_DIR):
-        raise FileNotFoundError(f"❌ Trained model not found at '{MODEL_DIR}'. Please train the model first.")
-
-    print(f"🔹 Loading model from: {MODEL_DIR}")
-
-    processor = AutoProcessor.from_pretrained(MODEL_DIR, apply_ocr=False)
-    model = AutoModelForSequenceClassification.from_pretrained(MODEL_DIR)
-    model.eval()
-
-        # 🔥 Prepare data dynamically from textract json
-    #data = prepare_predict_data(jsonl_path)
-    with open(jsonl_path) as f:
-        data = json.loads(f.readline())
-
-    dummy_image = Image.new("RGB", (1000, 1000), color=(255, 255, 255))
-
-    inputs = processor(
-        images=dummy_image,
-        text=data["words"],
-        boxes=data["boxes"],
-        truncation=True,
-        padding="max_length",
-        max_length=512,
-        return_tensors="pt"
-    )
+    # Load Textract JSON (json_path may also be an already parsed TextractDocument)
+    doc = TextractDocument.load(json_path)
 
-    with torch.no_grad():
-        outputs = model(**inputs)
-        probs = torch.softmax(outputs.logits, dim=-1)
-        predicted_class_id = torch.argmax(probs, dim=-1).item()
+    # Append to the deduplicated, sharded training corpus instead of overwriting train.jsonl
+    corpus = get_corpus_store(os.path.join(output_dir, "corpus"))
+    digest, added = corpus.append(list(doc.words), doc.boxes, label, pages=list(doc.word_pages), key_value=doc.key_value_words)
+
+    if added:
+        print(f"✅ Added training sample {digest[:12]} to corpus at: {corpus.root}")
+    else:
+        print(f"ℹ️ Sample {digest[:12]} is already in the corpus at: {corpus.root}")
+    return corpus.root
+
+def predict_batch(documents, window_config=None, processor=None, model=None, selection=None):
+    """
+    Classify several documents with a single batched forward pass.
+
+    The served model's cascade (see cascade.py) answers the documents it is
+    confident about first; only the rest go through LayoutLMv3.
+
+    Parameters:
+        documents (list): Dicts with "words" and "boxes" (and optionally "pages"), as produced by prepare_predict_data.
+        window_config (WindowConfig): How to split documents longer than 512 tokens; defaults to PREDICT_WINDOWS.
+        processor, model: Use these instead of the served model (e.g. to compare backends); skips the cascade.
+        selection (WordSelection): The word selection `model` was trained with; the served model uses its own.
+
+    Returns:
+        list: One dict per document with "label", "confidence", "probabilities", "windows" and
+        "stage" ("cascade" or "layoutlm", whichever decided).
+    """
+    if not documents:
+        return []
+    window_config = window_config or PREDICT_WINDOWS
+
+    # Processor and model stay resident; the holder reloads them when a new checkpoint is published
+    cascade = None
+    if model is None:
+        processor, model, cascade, selection = get_model_holder().get_pipeline()
+
+    results = cascade_decisions(cascade, documents)
+    remaining = [i for i, result in enumerate(results) if result is None]
+    if remaining:
+        encoded = encode_for_prediction([documents[i] for i in remaining], processor, window_config, selection)
+        for i, result in zip(remaining, classify_encoded(encoded, processor, model, window_config)):
+            results[i] = result
+    return results
+
+def cascade_decisions(cascade, documents):
+    """The cascade's result for each document it is confident about, else None."""
+    if cascade is None:
+        return [None] * len(documents)
+    with span("cascade"):
+        results = cascade.decide(documents)
+    decided = sum(result is not None for result in results)
+    if decided:
+        PREDICTION_STAGES.inc(decided, stage="cascade")
+    return results
+
+def encode_for_prediction(documents, processor, window_config=None, selection=None):
+    """
+    Tokenize every window of every document, without padding.
 
-    label = model.config.id2label[predicted_class_id]
-    confidence = probs[0][predicted_class_id].item()
+    With a `selection` (the one the model was trained with), each document's words
+    are first put in reading order and, without windowing, selected to fit one
+    forward pass (see word_selection.WordSelection). Without one they are used as given.
 
-    return label, confidence
+    Only the text is encoded per document: the blank page's pixel_values are shared
+    by every row and added per batch by classify_encoded.
+
+    Returns:
+        dict: "features" (one encoding per window), "owners" (document index of each
+        window), "window_pages" and "n_documents", the input of classify_encoded.
+    """
+    window_config = window_config or PREDICT_WINDOWS
+    budget = None if window_config.enabled else window_config.max_length - 2
+    features = []
+    owners = []
+    window_pages = []
+    truncated = 0
+    selected = documents
+    if selection is not None:
+        with span("select_words"):
+            selected = [selection.apply(doc, processor.tokenizer, budget) for doc in documents]
+    with span("tokenize"):
+        for doc_index, doc in enumerate(selected):
+            for start, end, page in split_windows(processor.tokenizer, doc["words"], doc["boxes"], doc.get("pages"), window_config):
+                encoding = processor.tokenizer(
+                    doc["words"][start:end],
+                    boxes=doc["boxes"][start:end],
+                    truncation=True,
+                    max_length=512,
+                    return_tensors="pt"
+                )
+                features.append({k: v.squeeze(0) for k, v in encoding.items()})
+                owners.append(doc_index)
+                window_pages.append(page)
+                # Words past max_length have no token left in the encoding
+                word_ids = [w for w in encoding.word_ids() if w is not None]
+                if end > start and (not word_ids or word_ids[-1] < end - start - 1):
+                    truncated += 1
+
+    DOCUMENTS.inc(len(documents), operation="predict")
+    WORDS.inc(sum(len(doc["words"]) for doc in documents))
+    TOKENS.inc(sum(len(f["input_ids"]) for f in features))
+    TRUNCATIONS.inc(truncated)
+    return {"features": features, "owners": owners, "window_pages": window_pages, "n_documents": len(documents)}
+
+def classify_encoded(encoded, processor, model, window_config=None):
+    """Run the forward pass over the output of encode_for_prediction and pool it per document."""
+    window_config = window_config or PREDICT_WINDOWS
+    features = encoded["features"]
+    owners = encoded["owners"]
+    window_pages = encoded["window_pages"]
+
+    # Pad per bucket of similar lengths so the forward pass only computes over real tokens
+    collator = DocumentCollator(processor.tokenizer.pad_token_id)
+    lengths = [len(f["input_ids"]) for f in features]
+    logits = [None] * len(features)
+
+    with torch.no_grad():
+        for batch_indices in bucket_batches(lengths, PREDICT_BUCKET_SIZE, bucket_size_multiplier=len(features)):
+            BATCH_SIZE.observe(len(batch_indices))
+            with span("forward"):
+                inputs = add_blank_pixel_values(collator([features[i] for i in batch_indices]), processor, model)
+                outputs = model(**inputs)
+            for i, row in zip(batch_indices, outputs.logits):
+                logits[i] = row
+
+    # Pool the windows of each document back into one prediction
+    rows_by_doc = [[] for _ in range(encoded["n_documents"])]
+    for i, owner in enumerate(owners):
+        rows_by_doc[owner].append(i)
+    doc_logits = [
+        pool_logits(torch.stack([logits[i] for i in rows]), [window_pages[i] for i in rows], window_config)
+        for rows in rows_by_doc
+    ]
+    window_counts = [len(rows) for rows in rows_by_doc]
+
+    probs = torch.softmax(torch.stack(doc_logits), dim=-1)
+    predicted_class_ids = torch.argmax(probs, dim=-1).tolist()
+
+    results = []
+    for row, predicted_class_id, n_windows in zip(probs.tolist(), predicted_class_ids, window_counts):
+        results.append({
+            "label": model.config.id2label[predicted_class_id],
+            "confidence": row[predicted_class_id],
+            "probabilities": {model.config.id2label[i]: p for i, p in enumerate(row)},
+            "windows": n_windows,
+            "stage": "layoutlm"
+        })
+    PREDICTION_STAGES.inc(len(results), stage="layoutlm")
+    return results
 
 def prepare_predict_data(textract_json_path):
-    # Load Textract JSON
-    with open(textract_json_path, 'r') as f:
-        data = json.load(f)
-
-    words = []
-    boxes = []
-
-    for block in data.get("Blocks", []):
-        if block.get("BlockType") == "WORD":
-            words.append(block["Text"])
-            bbox = block["Geometry"]["BoundingBox"]
-            x0 = int(bbox["Left"] * 1000)
-            y0 = int(bbox["Top"] * 1000)
-            x1 = int((bbox["Left"] + bbox["Width"]) * 1000)
-            y1 = int((bbox["Top"] + bbox["Height"]) * 1000)
-            boxes.append([x0, y0, x1, y1])
-
-    jsonl_data = {
-        "words": words,
-        "boxes": boxes
-    }
-
-    return jsonl_data
+    # Paths (including a directory of multi-part Textract output) are streamed with
+    # bounded memory; a parsed Textract dict or a TextractDocument is used as is
+    if isinstance(textract_json_path, (str, os.PathLike, list, tuple)):
+        return stream_layoutlm_data(textract_json_path)
+    return TextractDocument.load(textract_json_path).layoutlm_data()
 
 def extract_key_value_pairs(textract_result):
     """
     Extract key-value pairs from an Amazon Textract JSON response.
 
     Parameters:
-        textract_result (dict): Textract JSON output (as a Python dict).
+        textract_result (dict | TextractDocument): Textract JSON output (as a Python dict) or its parsed document.
 
     Returns:
         dict: Dictionary of extracted key-value text pairs.
     """
-    if not isinstance(textract_result, dict):
+    if not isinstance(textract_result, (dict, TextractDocument)):
         raise ValueError("Invalid input: Expected a dictionary from Textract JSON.")
 
-    blocks = textract_result.get('Blocks', [])
-    if not blocks:
+    doc = TextractDocument.load(textract_result)
+    if not doc.blocks:
         raise ValueError("Missing or empty 'Blocks' in Textract JSON.")
 
-    id_map = {}
     key_blocks = []
     value_blocks = {}
 
-    for block in blocks:
-        block_id = block.get('Id')
-        if block_id:
-            id_map[block_id] = block
-        if block.get('BlockType') == 'KEY_VALUE_SET':
-            entity_types = block.get('EntityTypes', [])
-            if 'KEY' in entity_types:
-                key_blocks.append(block)
-            elif 'VALUE' in entity_types:
-                value_blocks[block_id] = block
+    for block in doc.by_type.get('KEY_VALUE_SET', []):
+        entity_types = block.get('EntityTypes', [])
+        if 'KEY' in entity_types:
+            key_blocks.append(block)
+        elif 'VALUE' in entity_types:
+            value_blocks[block.get('Id')] = block
 
     def get_text_from_block(block):
         text_parts = []
         if not block:
             return ""
-        for rel in block.get('Relationships', []):
-            if rel.get('Type') == 'CHILD':
-                for child_id in rel.get('Ids', []):
-                    child = id_map.get(child_id)
-                    if not child:
-                        continue
-                    if child.get('BlockType') == 'WORD':
-                        text_parts.append(child.get('Text', ''))
-                    elif child.get('BlockType') == 'SELECTION_ELEMENT':
-                        if child.get('SelectionStatus') == 'SELECTED':
-                            text_parts.append("X")
+        for child in doc.related(block, 'CHILD'):
+            if child.get('BlockType') == 'WORD':
+                text_parts.append(child.get('Text', ''))
+            elif child.get('BlockType') == 'SELECTION_ELEMENT':
+                if child.get('SelectionStatus') == 'SELECTED':
+                    text_parts.append("X")
         return " ".join(text_parts).strip()
 
     kv_pairs = {}
@@ -161,66 +224,25 @@ def extract_key_value_pairs(textract_result):
         if not key_text:
             continue
         value_text = ""
-        for rel in key_block.get('Relationships', []):
-            if rel.get('Type') == 'VALUE':
-                for value_id in rel.get('Ids', []):
-                    value_block = value_blocks.get(value_id)
-                    if value_block:
-                        value_text = get_text_from_block(value_block)
-                        break
+        for value_id in doc.related_ids(key_block, 'VALUE'):
+            value_block = value_blocks.get(value_id)
+            if value_block:
+                value_text = get_text_from_block(value_block)
+                break
         kv_pairs[key_text] = value_text
 
     return kv_pairs
-#import json
-#import pandas as pd
 
 def extract_tables_from_textract(textract_data):
     """
-    Extract structured tables from Textract TABLE and CELL blocks.
+    Extract the first table of a Textract analysis (see textract_tables.extract_tables
+    for all of them, with pages, titles and merged cells).
 
     Parameters:
-        textract_data (dict): Textract JSON output.
+        textract_data (dict | TextractDocument): Textract JSON output or its parsed document.
 
     Returns:
         pd.DataFrame: A DataFrame representing the first detected table.
     """
-    blocks = textract_data.get("Blocks", [])
-    block_map = {block["Id"]: block for block in blocks}
-    tables_data = {}
-
-    for block in blocks:
-        if block["BlockType"] == "CELL":
-            row_index = block.get("RowIndex", -1)
-            col_index = block.get("ColumnIndex", -1)
-            table_id = block.get("TableId", "default")
-            key = (table_id, row_index)
-
-            # Extract text from CHILD relationships
-            text = ""
-            for rel in block.get("Relationships", []):
-                if rel["Type"] == "CHILD":
-                    for child_id in rel["Ids"]:
-                        word = block_map.get(child_id)
-                        if word and word["BlockType"] == "WORD":
-                            text += word.get("Text", "") + " "
-            text = text.strip()
-
-            # Organize cells into a row dictionary
-            if key not in tables_data:
-                tables_data[key] = {}
-            tables_data[key][col_index] = text
-
-    # Convert to list of rows
-    rows = []
-    for (table_id, row_index), cols in sorted(tables_data.items()):
-        max_cols = max(cols.keys())
-        row = [cols.get(i + 1, "") for i in range(max_cols)]
-        rows.append(row)
-
-    # Build DataFrame
-    if rows:
-        headers = rows[0]
-        data_rows = rows[1:]
-        return pd.DataFrame(data_rows, columns=headers)
-    else:
-        return pd.DataFrame()
+    tables = extract_tables(textract_data)
+    return tables[0].to_dataframe() if tables else pd.DataFrame()
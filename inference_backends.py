@@ -0,0 +1,93 @@
+# inference_backends.py
+import os
+
+# torch, transformers and onnxruntime are imported by the functions that use them, so
+# the serving process can import the settings below without paying for them
+
+# fp32 is the checkpoint train() publishes; int8 and onnx are derived from it by export_backends
+BACKENDS = ("fp32", "int8", "onnx")
+PREDICT_BACKEND = os.environ.get("PREDICT_BACKEND", "fp32")
+
+INT8_WEIGHTS = "quantized_state_dict.pt"
+ONNX_MODEL = "model.onnx"
+
+
+def backend_dir(model_dir, backend):
+    """Where the artifact of `backend` lives: inside the fp32 checkpoint's version directory, e.g. backends/int8."""
+    return model_dir if backend == "fp32" else os.path.join(model_dir, "backends", backend)
+
+
+def quantize_int8(model):
+    """Dynamically quantize the nn.Linear layers to int8 weights (activations stay fp32)."""
+    import torch
+
+    # LayoutLMv3's relative position biases are nn.Linear modules whose weight is read
+    # as a lookup table instead of being called, so they keep their fp32 weights
+    qconfig_spec = {
+        name: torch.quantization.default_dynamic_qconfig
+        for name, module in model.named_modules()
+        if isinstance(module, torch.nn.Linear) and "rel_pos" not in name
+    }
+    return torch.quantization.quantize_dynamic(model, qconfig_spec, dtype=torch.qint8)
+
+
+def load_int8(path):
+    import torch
+    from transformers import AutoConfig, AutoModelForSequenceClassification
+
+    config = AutoConfig.from_pretrained(path)
+    model = quantize_int8(AutoModelForSequenceClassification.from_config(config))
+    model.load_state_dict(torch.load(os.path.join(path, INT8_WEIGHTS), map_location="cpu"))
+    return model.eval()
+
+
+class OnnxSequenceClassifier:
+    """
+    ONNX Runtime session behind the call signature predict_batch uses:
+    model(**inputs).logits and model.config.
+    """
+
+    def __init__(self, path):
+        import onnxruntime as ort
+        import torch
+        from transformers import AutoConfig
+
+        self.config = AutoConfig.from_pretrained(path)
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = torch.get_num_threads()
+        self.session = ort.InferenceSession(
+            os.path.join(path, ONNX_MODEL),
+            options,
+            providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    def eval(self):
+        return self
+
+    def __call__(self, **inputs):
+        import numpy as np
+        import torch
+        from transformers.modeling_outputs import SequenceClassifierOutput
+
+        # pixel_values arrive as an expanded view of the blank page; ORT needs contiguous arrays
+        feed = {
+            name: np.ascontiguousarray(value.detach().cpu().numpy())
+            for name, value in inputs.items()
+            if name in self.input_names
+        }
+        logits = self.session.run(["logits"], feed)[0]
+        return SequenceClassifierOutput(logits=torch.from_numpy(logits))
+
+
+def load_backend_model(path, backend):
+    """Load the model artifact of `backend` stored at `path`."""
+    if backend == "fp32":
+        from transformers import AutoModelForSequenceClassification
+
+        return AutoModelForSequenceClassification.from_pretrained(path).eval()
+    if backend == "int8":
+        return load_int8(path)
+    if backend == "onnx":
+        return OnnxSequenceClassifier(path)
+    raise ValueError(f"Unknown backend '{backend}', expected one of {BACKENDS}.")
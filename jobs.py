@@ -0,0 +1,356 @@
+# jobs.py
+import fcntl
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from transformers import TrainerCallback
+
+from model_holder import MODEL_VOLUME_PATH
+
+MAX_JOB_HISTORY = 50
+TRAIN_NICENESS = int(os.environ.get("TRAIN_NICENESS", "10"))
+# Job state is mirrored to files so every server worker can report on (and cancel) a job
+# started by another one
+JOBS_DIR = os.environ.get("TRAIN_JOBS_DIR", os.path.join(MODEL_VOLUME_PATH, "jobs"))
+# Same as train_layoutlm.TRAIN_MODES and TRAIN_MODE, without importing the training stack into the server
+TRAIN_MODES = ("full", "head", "incremental")
+TRAIN_MODE = os.environ.get("TRAIN_MODE", "full")
+# A waiting job asked for again with a costlier mode is upgraded to it
+MODE_COST = {"head": 0, "incremental": 1, "full": 2}
+
+
+class TrainingCancelled(Exception):
+    pass
+
+
+class ProgressCallback(TrainerCallback):
+    """
+    Reports step, loss, throughput and ETA from the Trainer, and stops training
+    when the job is cancelled.
+    """
+
+    def __init__(self, report, cancel_event=None):
+        self.report = report
+        self.cancel_event = cancel_event
+        self.start_time = None
+        self.loss = None
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.start_time = time.monotonic()
+        self.report({"step": 0, "max_steps": state.max_steps, "epoch": 0.0})
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        if logs and "loss" in logs:
+            self.loss = logs["loss"]
+
+    def on_step_end(self, args, state, control, **kwargs):
+        elapsed = time.monotonic() - self.start_time
+        step = state.global_step
+        samples = step * args.train_batch_size * args.gradient_accumulation_steps
+        self.report({
+            "step": step,
+            "max_steps": state.max_steps,
+            "epoch": state.epoch,
+            "loss": self.loss,
+            "samples_per_second": samples / elapsed if elapsed > 0 else None,
+            "eta_seconds": elapsed / step * (state.max_steps - step) if step else None
+        })
+        self.check_cancelled()
+
+    def check_cancelled(self):
+        """Raise TrainingCancelled if the job was cancelled; also passed to train() as its cancel_check."""
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise TrainingCancelled()
+
+
+def _run_training(events, cancel_event, mode=None):
+    # Runs in a child process so training has its own GIL and torch thread pool and
+    # never stalls the threads serving requests
+    try:
+        os.nice(TRAIN_NICENESS)
+    except OSError:
+        pass
+    import train_layoutlm
+
+    callback = ProgressCallback(lambda progress: events.put(("progress", progress)), cancel_event)
+    try:
+        # Head training, the embedding pass and publishing run no Trainer callbacks,
+        # so train() also checks for cancellation between its phases
+        version = train_layoutlm.train(callbacks=[callback], mode=mode, cancel_check=callback.check_cancelled)
+        events.put(("succeeded", {"model_version": version}))
+    except TrainingCancelled:
+        events.put(("cancelled", {}))
+    except Exception as e:
+        events.put(("failed", {"error": str(e)}))
+
+
+class TrainingJob:
+    def __init__(self, mode=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.mode = mode
+        self.status = "queued"
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.progress = {}
+        self.result = {}
+        self.error = None
+        self.cancel_requested = False
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "mode": self.mode,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            **self.progress,
+            **self.result,
+            "error": self.error
+        }
+
+    @staticmethod
+    def path(job_id, suffix=".json"):
+        return os.path.join(JOBS_DIR, f"{job_id}{suffix}")
+
+    def save(self):
+        os.makedirs(JOBS_DIR, exist_ok=True)
+        state = {
+            "id": self.id,
+            "mode": self.mode,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "progress": self.progress,
+            "result": self.result,
+            "error": self.error
+        }
+        tmp_path = self.path(self.id, f".json.tmp-{os.getpid()}")
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path(self.id))
+
+    @classmethod
+    def load(cls, job_id):
+        """A job saved by any worker, or None."""
+        if not job_id.isalnum():
+            return None
+        try:
+            with open(cls.path(job_id)) as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        job = cls()
+        job.__dict__.update(state)
+        return job
+
+    def request_cancel(self):
+        # Picked up by the worker that runs the job
+        open(self.path(self.id, ".cancel"), "w").close()
+
+    def cancel_requested_elsewhere(self):
+        return os.path.exists(self.path(self.id, ".cancel"))
+
+
+class TrainingQueue:
+    """
+    Single-flight queue of training jobs.
+
+    At most one job runs at a time, across every server worker, and at most one
+    waits behind it per worker: submitting while a job is already queued returns
+    that job instead of adding another.
+    Each job runs train_layoutlm.train() in a child process and streams its
+    progress back.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+        self._pending = queue.Queue()
+        self._queued_job = None
+        self._running_job = None
+        self._cancel_event = None
+        self._worker = None
+        self._ctx = multiprocessing.get_context("spawn")
+
+    def submit(self, mode=None):
+        """
+        Queue a training run. `mode` is "full", "head", "incremental" or None for
+        TRAIN_MODE; a costlier run requested while a cheaper one is waiting (e.g. full
+        over incremental) upgrades the waiting job.
+        """
+        if mode is not None and mode not in TRAIN_MODES:
+            raise ValueError(f"Unknown training mode '{mode}', expected one of {TRAIN_MODES}.")
+        with self._lock:
+            if self._queued_job is not None:
+                if mode is not None and MODE_COST[mode] > MODE_COST.get(self._queued_job.mode or TRAIN_MODE, 2):
+                    self._queued_job.mode = mode
+                    self._queued_job.save()
+                return self._queued_job
+            job = TrainingJob(mode)
+            self._jobs[job.id] = job
+            while len(self._jobs) > MAX_JOB_HISTORY:
+                self._jobs.popitem(last=False)
+            self._queued_job = job
+            job.save()
+            self._prune_saved_jobs()
+            self._pending.put(job)
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="training-queue", daemon=True)
+                self._worker.start()
+            return job
+
+    def get(self, job_id):
+        return self._jobs.get(job_id) or TrainingJob.load(job_id)
+
+    def _prune_saved_jobs(self):
+        names = [n for n in os.listdir(JOBS_DIR) if n.endswith(".json")]
+        if len(names) <= MAX_JOB_HISTORY:
+            return
+        names.sort(key=lambda n: os.path.getmtime(os.path.join(JOBS_DIR, n)))
+        for name in names[:-MAX_JOB_HISTORY]:
+            for suffix in (".json", ".cancel"):
+                try:
+                    os.remove(TrainingJob.path(name[:-len(".json")], suffix))
+                except FileNotFoundError:
+                    pass
+
+    def jobs(self):
+        return list(self._jobs.values())
+
+    def cancel(self, job_id):
+        """Cancel a queued or running job. Returns False if it already finished."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                # Started by another worker: leave it a cancel request
+                job = TrainingJob.load(job_id)
+                if job is None or job.status not in ("queued", "running"):
+                    return False
+                job.request_cancel()
+                return True
+            if job.status not in ("queued", "running"):
+                return False
+            job.cancel_requested = True
+            if job is self._queued_job:
+                self._queued_job = None
+                job.finished_at = time.time()
+                job.status = "cancelled"
+                job.save()
+            elif job is self._running_job and self._cancel_event is not None:
+                self._cancel_event.set()
+            return True
+
+    def _wait_for_turn(self, job):
+        """
+        Take the training lock shared by every worker (a flock on JOBS_DIR/.lock, like
+        corpus.locked), so only one job runs per model volume. The job stays queued,
+        and can still be cancelled, while another worker's job runs.
+
+        Returns:
+            The open lock file, or None if the job was cancelled while waiting.
+        """
+        os.makedirs(JOBS_DIR, exist_ok=True)
+        lock = open(os.path.join(JOBS_DIR, ".lock"), "a")
+        while True:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return lock
+            except BlockingIOError:
+                if job.cancel_requested or job.cancel_requested_elsewhere():
+                    lock.close()
+                    return None
+                time.sleep(1)
+
+    def _run(self):
+        while True:
+            job = self._pending.get()
+            lock = self._wait_for_turn(job)
+            try:
+                self._start(job, lock)
+            finally:
+                if lock is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+                    lock.close()
+
+    def _start(self, job, lock):
+        with self._lock:
+            if job.cancel_requested:
+                return
+            if lock is None or job.cancel_requested_elsewhere():
+                self._queued_job = None
+                job.finished_at = time.time()
+                job.status = "cancelled"
+                job.save()
+                return
+            self._queued_job = None
+            self._running_job = job
+            self._cancel_event = self._ctx.Event()
+            job.started_at = time.time()
+            job.status = "running"
+            job.save()
+        try:
+            self._run_job(job, self._cancel_event)
+        except Exception as e:
+            job.error = str(e)
+            job.finished_at = time.time()
+            job.status = "failed"
+        finally:
+            job.save()
+            with self._lock:
+                self._running_job = None
+                self._cancel_event = None
+
+    def _run_job(self, job, cancel_event):
+        events = self._ctx.Queue()
+        process = self._ctx.Process(target=_run_training, args=(events, cancel_event, job.mode), daemon=True)
+        process.start()
+        print(f"🚀 Training job {job.id} started (pid {process.pid})")
+
+        while True:
+            try:
+                kind, payload = events.get(timeout=1)
+            except queue.Empty:
+                if job.cancel_requested_elsewhere():
+                    cancel_event.set()
+                if not process.is_alive():
+                    job.error = f"Training process exited with code {process.exitcode}."
+                    job.finished_at = time.time()
+                    job.status = "failed"
+                    break
+                continue
+            if kind == "progress":
+                job.progress = payload
+                job.save()
+                if job.cancel_requested_elsewhere():
+                    cancel_event.set()
+                continue
+            job.result = {k: v for k, v in payload.items() if k != "error"}
+            job.error = payload.get("error")
+            job.finished_at = time.time()
+            job.status = kind
+            break
+
+        process.join()
+        print(f"🔹 Training job {job.id} finished: {job.status}")
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_training_queue():
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = TrainingQueue()
+    return _queue
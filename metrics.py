@@ -0,0 +1,179 @@
+# metrics.py
+import cProfile
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+# Per-request profiling is opt-in twice: PROFILING_ENABLED=1 on the server, and
+# ?profile=cprofile|torch on the request
+PROFILING_ENABLED = os.environ.get("PROFILING_ENABLED", "0") == "1"
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+PROFILE_MODES = ("cprofile", "torch")
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    return repr(float(value)) if value != float("inf") else "+Inf"
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] += amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._counts = {}  # label values -> [count per bucket], not cumulative
+        self._sums = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        index = next(i for i, bound in enumerate(self.buckets) if value <= bound)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * len(self.buckets))
+            counts[index] += 1
+            self._sums[key] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, counts in sorted(self._counts.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    labels = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{labels} {_format_value(self._sums[key])}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "layoutlm_stage_duration_seconds",
+    "Time spent in each processing stage.",
+    labelnames=("stage",)
+))
+DOCUMENTS = REGISTRY.register(Counter(
+    "layoutlm_documents_total",
+    "Documents processed, by operation.",
+    labelnames=("operation",)
+))
+WORDS = REGISTRY.register(Counter("layoutlm_predict_words_total", "Textract words sent to the model."))
+TOKENS = REGISTRY.register(Counter("layoutlm_predict_tokens_total", "Tokens in the model's input, without padding."))
+TRUNCATIONS = REGISTRY.register(Counter(
+    "layoutlm_predict_truncated_windows_total",
+    "Document windows whose words did not all fit in max_length tokens."
+))
+BATCH_SIZE = REGISTRY.register(Histogram(
+    "layoutlm_predict_batch_size",
+    "Rows per forward pass.",
+    buckets=BATCH_SIZE_BUCKETS
+))
+ERRORS = REGISTRY.register(Counter("layoutlm_errors_total", "Failed requests, by endpoint.", labelnames=("endpoint",)))
+
+
+@contextmanager
+def span(stage):
+    """Time the enclosed block into layoutlm_stage_duration_seconds{stage=...}."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage)
+
+
+class RequestProfiler:
+    """
+    Profiles one request in the thread that serves it and dumps the result to
+    PROFILE_DIR: a .prof file for cProfile (open with snakeviz or pstats) or a
+    Chrome trace .json for the torch profiler (open in chrome://tracing or Perfetto).
+    """
+
+    def __init__(self, mode, name="request"):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode '{mode}', expected one of {PROFILE_MODES}.")
+        self.mode = mode
+        self.name = name
+        self.path = None
+        self._profiler = None
+
+    def start(self):
+        if self.mode == "cprofile":
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        else:
+            from torch.profiler import ProfilerActivity, profile
+
+            self._profiler = profile(activities=[ProfilerActivity.CPU], record_shapes=True)
+            self._profiler.__enter__()
+        return self
+
+    def stop(self):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        stem = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{self.name}-{uuid.uuid4().hex[:6]}")
+        if self.mode == "cprofile":
+            self._profiler.disable()
+            self.path = f"{stem}.prof"
+            self._profiler.dump_stats(self.path)
+        else:
+            self._profiler.__exit__(None, None, None)
+            self.path = f"{stem}.trace.json"
+            self._profiler.export_chrome_trace(self.path)
+        print(f"🔹 Profile written to {self.path}")
+        return self.path
@@ -0,0 +1,243 @@
+# model_holder.py
+import os
+import shutil
+import threading
+import time
+
+from metrics import STAGE_SECONDS
+from inference_backends import BACKENDS, PREDICT_BACKEND, backend_dir, load_backend_model
+
+MODEL_VOLUME_PATH = os.environ.get("MODEL_VOLUME_PATH", "/train_model_dsk")
+MODEL_DIR = os.path.join(MODEL_VOLUME_PATH, "fine_tuned_layoutlmv3")
+
+# train_layoutlm.train() writes this file last, once the checkpoint is complete.
+READY_MARKER = "READY"
+RELOAD_POLL_SECONDS = float(os.environ.get("MODEL_RELOAD_POLL_SECONDS", "30"))
+
+
+def checkpoint_version(model_dir):
+    """
+    Return the version stamp of the checkpoint in `model_dir`, or None if there is
+    no complete checkpoint there yet.
+    """
+    marker = os.path.join(model_dir, READY_MARKER)
+    try:
+        with open(marker) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        pass
+
+    # Checkpoints saved before the READY marker existed
+    config_path = os.path.join(model_dir, "config.json")
+    if os.path.exists(config_path):
+        return f"mtime-{int(os.path.getmtime(config_path))}"
+    return None
+
+
+def write_ready_marker(model_dir, version=None):
+    version = version or time.strftime("%Y%m%d-%H%M%S")
+    with open(os.path.join(model_dir, READY_MARKER), "w") as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    return version
+
+
+def replace_dir(staging_dir, target_dir):
+    """Swap a fully written `staging_dir` in for `target_dir` with renames."""
+    old_dir = f"{target_dir}.old-{os.getpid()}"
+    if os.path.exists(target_dir):
+        os.rename(target_dir, old_dir)
+    os.rename(staging_dir, target_dir)
+    if os.path.exists(old_dir):
+        shutil.rmtree(old_dir)
+
+
+class ModelHolder:
+    """
+    Process-wide holder for the fine-tuned processor and model.
+
+    The checkpoint is loaded once and kept in memory. A background watcher polls the
+    READY marker of the active version (MODEL_DIR points at it, see model_registry)
+    and, when train() publishes or someone activates another version, loads and warms
+    it up on the side before swapping it in, so requests never wait on a load.
+
+    `backend` (PREDICT_BACKEND=fp32|int8|onnx) selects which artifact serves
+    predictions. The int8/onnx artifact is only used when it was built from the
+    current checkpoint; otherwise the fp32 checkpoint is served.
+    """
+
+    def __init__(self, model_dir=MODEL_DIR, poll_interval=RELOAD_POLL_SECONDS, backend=PREDICT_BACKEND):
+        if backend not in BACKENDS:
+            print(f"⚠️ Unknown PREDICT_BACKEND '{backend}', using fp32. Expected one of {BACKENDS}.")
+            backend = "fp32"
+        self.model_dir = model_dir
+        self.poll_interval = poll_interval
+        self.backend = backend
+        self._state = None  # (processor, model, version, backend, cascade, selection), swapped as a whole
+        self._warm_version = None  # version whose warm-up inference has run, see is_ready()
+        self._load_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._watcher = None
+
+    @property
+    def version(self):
+        state = self._state
+        return state[2] if state else None
+
+    @property
+    def loaded_backend(self):
+        state = self._state
+        return state[3] if state else None
+
+    def is_loaded(self):
+        return self._state is not None
+
+    def get(self):
+        """Return (processor, model), loading the checkpoint on first use."""
+        return self.get_pipeline()[:2]
+
+    def get_pipeline(self):
+        """
+        Return (processor, model, cascade, selection) of one version; cascade and
+        selection (its word_selection.WordSelection) are None if that version has none.
+        """
+        state = self._state
+        if state is None:
+            self.load()
+            state = self._state
+        return state[0], state[1], state[4], state[5]
+
+    def load(self, warm=True):
+        """
+        Load the current checkpoint unless it is already loaded. With warm=False the
+        warm-up inference is skipped (see warm()), e.g. in a server process that forks
+        its workers afterwards.
+        """
+        with self._load_lock:
+            # MODEL_DIR is a symlink to the active registry version; resolve it once so
+            # every file comes from the same version even if it is switched meanwhile
+            model_dir = os.path.realpath(self.model_dir)
+            version = checkpoint_version(model_dir)
+            if version is None:
+                if self._state is not None:
+                    return self._state[2]
+                raise FileNotFoundError(f"❌ Trained model not found at '{self.model_dir}'. Please train the model first.")
+            backend = self._available_backend(model_dir, version)
+            if self._state is not None and self._state[2:4] == (version, backend):
+                return version
+
+            print(f"🔹 Loading model from: {model_dir} (version {version}, {backend} backend)")
+            start = time.perf_counter()
+            # Imported here: torch/transformers dominate startup, so importing this module stays cheap
+            from transformers import AutoProcessor
+            from blank_page import cache_blank_page_embedding
+            from cascade import CascadeClassifier
+            from word_selection import WordSelection
+            processor = AutoProcessor.from_pretrained(model_dir, apply_ocr=False)
+            model = load_backend_model(backend_dir(model_dir, backend), backend)
+            cascade = CascadeClassifier.load(model_dir)
+            selection = WordSelection.load(model_dir)
+
+            # A pre-registry checkpoint directory may have been replaced while we were reading it
+            if checkpoint_version(model_dir) != version:
+                print("⚠️ Checkpoint changed during load, will retry on next poll.")
+                if self._state is None:
+                    raise RuntimeError(f"Checkpoint at '{self.model_dir}' changed while loading.")
+                return self._state[2]
+
+            cache_blank_page_embedding(model, processor)
+            elapsed = time.perf_counter() - start
+            STAGE_SECONDS.observe(elapsed, stage="model_load")
+            print(f"✅ Model version {version} loaded in {elapsed:.1f}s")
+            if warm:
+                self._warm_up(processor, model, version)
+            self._state = (processor, model, version, backend, cascade, selection)
+            return version
+
+    def warm(self):
+        """Run the warm-up inference on the loaded model, if any."""
+        state = self._state
+        if state is not None:
+            self._warm_up(state[0], state[1], state[2])
+
+    def _warm_up(self, processor, model, version):
+        start = time.perf_counter()
+        warm_up(processor, model)
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage="warm_up")
+        self._warm_version = version
+        print(f"✅ Model version {version} warmed up in {elapsed:.1f}s")
+
+    def is_ready(self):
+        """Whether a model is loaded and has served its warm-up inference."""
+        state = self._state
+        return state is not None and self._warm_version == state[2]
+
+    def _available_backend(self, model_dir, version):
+        """The configured backend if its artifact matches checkpoint `version`, else fp32."""
+        if self.backend == "fp32":
+            return "fp32"
+        if checkpoint_version(backend_dir(model_dir, self.backend)) == version:
+            return self.backend
+        if self.loaded_backend != "fp32" or self.version != version:
+            print(f"⚠️ No {self.backend} artifact for model version {version}, serving fp32.")
+        return "fp32"
+
+    def start(self):
+        """Load in the background (if a checkpoint exists) and start watching for new ones."""
+        if self._watcher is not None:
+            return
+        self._stop.clear()
+        self._watcher = threading.Thread(target=self._watch, name="model-watcher", daemon=True)
+        self._watcher.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._watcher is not None:
+            self._watcher.join(timeout=5)
+            self._watcher = None
+
+    def _watch(self):
+        while not self._stop.is_set():
+            try:
+                model_dir = os.path.realpath(self.model_dir)
+                version = checkpoint_version(model_dir)
+                # Also picks up an int8/onnx artifact exported after its checkpoint was loaded
+                if version is not None and (version, self._available_backend(model_dir, version)) != (self.version, self.loaded_backend):
+                    self.load()
+            except Exception as e:
+                print(f"❌ Background model reload failed: {e}")
+            self._stop.wait(self.poll_interval)
+
+
+def warm_up(processor, model):
+    """
+    Run one dummy inference so the first real request doesn't pay for lazy init
+    (this also computes the cached blank-page embedding).
+    """
+    import torch
+    from blank_page import add_blank_pixel_values
+
+    inputs = processor.tokenizer(
+        ["warmup"],
+        boxes=[[0, 0, 0, 0]],
+        truncation=True,
+        max_length=512,
+        return_tensors="pt"
+    )
+    with torch.no_grad():
+        model(**add_blank_pixel_values(dict(inputs), processor, model))
+
+
+_holder = None
+_holder_lock = threading.Lock()
+
+
+def get_model_holder():
+    global _holder
+    if _holder is None:
+        with _holder_lock:
+            if _holder is None:
+                _holder = ModelHolder()
+    return _holder
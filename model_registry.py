@@ -0,0 +1,199 @@
+# model_registry.py
+import json
+import os
+import shutil
+import time
+import uuid
+
+from corpus import locked
+from model_holder import MODEL_DIR, MODEL_VOLUME_PATH, READY_MARKER, checkpoint_version, write_ready_marker
+
+METADATA_FILE = "metadata.json"
+# Hashes of the corpus samples a version was trained on, one per line
+SEEN_FILE = "seen_samples.txt"
+# Hashes of the corpus samples a version was validated on, one per line
+VALIDATION_FILE = "validation_samples.txt"
+HISTORY_FILE = "history.json"
+# Versions kept on disk by prune(), besides the active one and its rollback target
+MODEL_KEEP_VERSIONS = int(os.environ.get("MODEL_KEEP_VERSIONS", "5"))
+
+
+class ModelRegistry:
+    """
+    Immutable, versioned model directories with an atomically swapped pointer.
+
+    Layout under the model volume:
+
+        models/<version>/            checkpoint, processor, READY, metadata.json, seen_samples.txt,
+                                     validation_samples.txt
+        models/<version>/backends/   int8 / onnx artifacts of that checkpoint
+        models/history.json          activations, newest last
+        fine_tuned_layoutlmv3 -> models/<version>
+
+    fine_tuned_layoutlmv3 is a symlink replaced with a single rename, so readers
+    of MODEL_DIR always see one complete version and a failed training run never
+    touches the active one.
+    """
+
+    def __init__(self, root=MODEL_VOLUME_PATH, pointer=MODEL_DIR):
+        self.root = root
+        self.pointer = pointer
+        self.models_dir = os.path.join(root, "models")
+        os.makedirs(self.models_dir, exist_ok=True)
+
+    def _locked(self):
+        # Not the volume lock: that one is held by train() for the whole run
+        return locked(self.models_dir)
+
+    def version_dir(self, version):
+        return os.path.join(self.models_dir, version)
+
+    def staging_dir(self):
+        """A fresh directory to save a new version into before commit()."""
+        path = os.path.join(self.models_dir, f".staging-{os.getpid()}-{uuid.uuid4().hex[:6]}")
+        os.makedirs(path)
+        return path
+
+    def new_version(self):
+        return f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+
+    def commit(self, staging_dir, version, metadata, seen=None, validation=None):
+        """
+        Write the metadata, the `seen` and `validation` sample hashes (if given) and the
+        READY marker and move `staging_dir` into place as `version`.
+        """
+        metadata = dict(metadata, version=version, created_at=metadata.get("created_at") or time.time())
+        with open(os.path.join(staging_dir, METADATA_FILE), "w") as f:
+            json.dump(metadata, f, indent=2)
+        if seen is not None:
+            with open(os.path.join(staging_dir, SEEN_FILE), "w") as f:
+                f.write("".join(f"{digest}\n" for digest in sorted(seen)))
+        if validation is not None:
+            with open(os.path.join(staging_dir, VALIDATION_FILE), "w") as f:
+                f.write("".join(f"{digest}\n" for digest in sorted(validation)))
+        write_ready_marker(staging_dir, version)
+        os.rename(staging_dir, self.version_dir(version))
+        return version
+
+    def metadata(self, version):
+        try:
+            with open(os.path.join(self.version_dir(version), METADATA_FILE)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"version": version}
+
+    def seen_samples(self, version):
+        """Hashes of the samples `version` was trained on, or None if it didn't record them."""
+        return self._hashes(version, SEEN_FILE)
+
+    def validation_samples(self, version):
+        """Hashes of the samples `version` was validated on, or None if it didn't record them."""
+        return self._hashes(version, VALIDATION_FILE)
+
+    def _hashes(self, version, name):
+        try:
+            with open(os.path.join(self.version_dir(version), name)) as f:
+                return {line.strip() for line in f if line.strip()}
+        except FileNotFoundError:
+            return None
+
+    def versions(self):
+        """Metadata of every complete version, oldest first, with an "active" flag."""
+        active = self.active_version()
+        versions = []
+        for name in os.listdir(self.models_dir):
+            path = self.version_dir(name)
+            if name.startswith(".") or not os.path.isdir(path) or not os.path.exists(os.path.join(path, READY_MARKER)):
+                continue
+            metadata = self.metadata(name)
+            metadata["active"] = name == active
+            versions.append(metadata)
+        versions.sort(key=lambda m: (m.get("created_at") or 0, m["version"]))
+        return versions
+
+    def active_version(self):
+        if not os.path.islink(self.pointer):
+            return None
+        return os.path.basename(os.readlink(self.pointer).rstrip("/"))
+
+    def _history(self):
+        try:
+            with open(os.path.join(self.models_dir, HISTORY_FILE)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+
+    def _write_history(self, history):
+        path = os.path.join(self.models_dir, HISTORY_FILE)
+        with open(f"{path}.tmp-{os.getpid()}", "w") as f:
+            json.dump(history[-100:], f, indent=2)
+        os.replace(f"{path}.tmp-{os.getpid()}", path)
+
+    def _swap_pointer(self, version):
+        tmp_link = f"{self.pointer}.tmp-{os.getpid()}"
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        # Relative target, so the volume can be mounted anywhere
+        os.symlink(os.path.relpath(self.version_dir(version), os.path.dirname(self.pointer)), tmp_link)
+        os.replace(tmp_link, self.pointer)
+
+    def activate(self, version, reason="activate"):
+        """Point fine_tuned_layoutlmv3 at `version`. Predictors pick it up on their next poll."""
+        with self._locked():
+            self._migrate_legacy()
+            if checkpoint_version(self.version_dir(version)) != version:
+                raise ValueError(f"Unknown or incomplete model version '{version}'.")
+            previous = self.active_version()
+            if previous == version:
+                return version
+            self._swap_pointer(version)
+            history = self._history()
+            history.append({"version": version, "previous": previous, "reason": reason, "activated_at": time.time()})
+            self._write_history(history)
+        print(f"🔹 Active model version: {version} (was {previous})")
+        return version
+
+    def _rollback_target(self, active):
+        # The version that was replaced when `active` was last trained or activated;
+        # rollbacks are skipped, so repeated rollbacks keep walking back
+        for entry in reversed(self._history()):
+            if entry["version"] == active and entry["reason"] != "rollback":
+                return entry.get("previous")
+        return None
+
+    def rollback(self):
+        """Re-activate the version that was active before the current one."""
+        previous = self._rollback_target(self.active_version())
+        if previous is None or not os.path.isdir(self.version_dir(previous)):
+            raise ValueError("No earlier model version to roll back to.")
+        return self.activate(previous, reason="rollback")
+
+    def prune(self, keep=MODEL_KEEP_VERSIONS):
+        """Delete all but the newest `keep` versions, never the active one or its rollback target."""
+        with self._locked():
+            active = self.active_version()
+            protected = {active, self._rollback_target(active)}
+            candidates = [m["version"] for m in self.versions() if m["version"] not in protected]
+            for version in candidates[:max(len(candidates) - keep, 0)]:
+                shutil.rmtree(self.version_dir(version), ignore_errors=True)
+                print(f"🔹 Pruned model version {version}")
+
+    def _migrate_legacy(self):
+        # A fine_tuned_layoutlmv3 directory from before the registry becomes its first version
+        if os.path.islink(self.pointer) or not os.path.isdir(self.pointer):
+            return
+        version = checkpoint_version(self.pointer)
+        if version is None:
+            return
+        target = self.version_dir(version)
+        os.rename(self.pointer, target)
+        for backend in ("int8", "onnx"):
+            legacy_backend = f"{self.pointer}_{backend}"
+            if os.path.isdir(legacy_backend):
+                os.makedirs(os.path.join(target, "backends"), exist_ok=True)
+                os.rename(legacy_backend, os.path.join(target, "backends", backend))
+        with open(os.path.join(target, METADATA_FILE), "w") as f:
+            created_at = os.path.getmtime(os.path.join(target, "config.json"))
+            json.dump({"version": version, "created_at": created_at, "legacy": True}, f, indent=2)
+        self._swap_pointer(version)
+        print(f"🔹 Moved the existing model into the registry as version {version}")
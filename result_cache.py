@@ -0,0 +1,194 @@
+# result_cache.py
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import Counter, REGISTRY
+
+RESULT_CACHE_PATH = os.environ.get("RESULT_CACHE_PATH", os.path.join("train_data", "result_cache.sqlite3"))
+RESULT_CACHE_MEMORY_BYTES = int(os.environ.get("RESULT_CACHE_MEMORY_BYTES", str(64 * 1024 * 1024)))
+RESULT_CACHE_DISK_BYTES = int(os.environ.get("RESULT_CACHE_DISK_BYTES", str(1024 * 1024 * 1024)))
+# The disk size is tracked per process and re-read from SQLite (which other workers
+# also write to) every RESULT_CACHE_SYNC_WRITES writes and before trimming; a trim
+# frees down to RESULT_CACHE_TRIM_RATIO of the limit
+RESULT_CACHE_SYNC_WRITES = int(os.environ.get("RESULT_CACHE_SYNC_WRITES", "100"))
+RESULT_CACHE_TRIM_RATIO = float(os.environ.get("RESULT_CACHE_TRIM_RATIO", "0.9"))
+
+CACHE_LOOKUPS = REGISTRY.register(Counter(
+    "layoutlm_result_cache_lookups_total",
+    "Result cache lookups, by kind and outcome (memory, disk or miss).",
+    labelnames=("kind", "result")
+))
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ResultCache:
+    """
+    Results of processing an upload, keyed by the SHA-256 of the uploaded file.
+
+    Entries are (digest, kind, version): extracted fields and tables don't depend on
+    the model and use version "", predictions use the model version and backend that
+    produced them ("<version>/<backend>"). Values are JSON. Recently used entries are
+    kept in memory up to `max_memory_bytes` (LRU); every entry is also written to a
+    SQLite file that survives restarts and is trimmed to `max_disk_bytes`, least
+    recently used first.
+
+    Predictions are dropped from both tiers the first time a lookup sees a new
+    model version or backend, so a newly published model never serves old results.
+    """
+
+    def __init__(self, path=RESULT_CACHE_PATH, max_memory_bytes=RESULT_CACHE_MEMORY_BYTES, max_disk_bytes=RESULT_CACHE_DISK_BYTES):
+        self.path = path
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()  # key -> (serialized value, size)
+        self._memory_bytes = 0
+        self._model_version = None
+        self._disk_bytes = None  # estimate, None until read from SQLite
+        self._writes_since_sync = 0
+        self._lock = threading.Lock()
+        self._db = None
+
+    def _connect(self):
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # One connection shared under self._lock; WAL lets other processes read while one writes
+            db = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                " digest TEXT NOT NULL, kind TEXT NOT NULL, version TEXT NOT NULL,"
+                " value TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL,"
+                " PRIMARY KEY (digest, kind, version))"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)")
+            db.commit()
+            self._db = db
+        return self._db
+
+    def _observe_version(self, version):
+        # Called under self._lock whenever a model version is known
+        if version is None or version == self._model_version:
+            return
+        stale = [key for key in self._memory if key[1] == "prediction" and key[2] != version]
+        for key in stale:
+            self._memory_bytes -= self._memory.pop(key)[1]
+        db = self._connect()
+        db.execute("DELETE FROM results WHERE kind = 'prediction' AND version != ?", (version,))
+        db.commit()
+        self._disk_bytes = None
+        if self._model_version is not None:
+            print(f"🔹 Model version changed to {version}, dropped cached predictions")
+        self._model_version = version
+
+    def _remember(self, key, serialized):
+        size = len(serialized)
+        if size > self.max_memory_bytes:
+            return
+        if key in self._memory:
+            self._memory_bytes -= self._memory.pop(key)[1]
+        self._memory[key] = (serialized, size)
+        self._memory_bytes += size
+        while self._memory_bytes > self.max_memory_bytes:
+            _, (_, evicted) = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted
+
+    def get(self, digest, kind, version=None):
+        """Return the cached value, or None. `version` is the current model version for predictions."""
+        key = (digest, kind, version or "")
+        with self._lock:
+            self._observe_version(version)
+            hit = self._memory.get(key)
+            if hit is not None:
+                self._memory.move_to_end(key)
+                CACHE_LOOKUPS.inc(kind=kind, result="memory")
+                return json.loads(hit[0])
+
+            db = self._connect()
+            row = db.execute(
+                "SELECT value FROM results WHERE digest = ? AND kind = ? AND version = ?", key
+            ).fetchone()
+            if row is None:
+                CACHE_LOOKUPS.inc(kind=kind, result="miss")
+                return None
+            db.execute(
+                "UPDATE results SET accessed = ? WHERE digest = ? AND kind = ? AND version = ?",
+                (time.time(), *key)
+            )
+            db.commit()
+            self._remember(key, row[0])
+            CACHE_LOOKUPS.inc(kind=kind, result="disk")
+            return json.loads(row[0])
+
+    def put(self, digest, kind, value, version=None):
+        key = (digest, kind, version or "")
+        serialized = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            self._observe_version(version)
+            self._remember(key, serialized)
+            db = self._connect()
+            db.execute(
+                "INSERT OR REPLACE INTO results (digest, kind, version, value, size, accessed) VALUES (?, ?, ?, ?, ?, ?)",
+                (*key, serialized, len(serialized), time.time())
+            )
+            self._trim_disk(db, len(serialized))
+            db.commit()
+
+    def _trim_disk(self, db, added):
+        # A replaced entry is counted twice, which at worst makes the next sync come early
+        self._writes_since_sync += 1
+        if self._disk_bytes is not None and self._writes_since_sync < RESULT_CACHE_SYNC_WRITES:
+            self._disk_bytes += added
+            if self._disk_bytes <= self.max_disk_bytes:
+                return
+
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        self._disk_bytes = total
+        self._writes_since_sync = 0
+        if total <= self.max_disk_bytes:
+            return
+        excess = total - int(self.max_disk_bytes * RESULT_CACHE_TRIM_RATIO)
+        freed = 0
+        doomed = []
+        for digest, kind, version, size in db.execute("SELECT digest, kind, version, size FROM results ORDER BY accessed"):
+            doomed.append((digest, kind, version))
+            freed += size
+            if freed >= excess:
+                break
+        db.executemany("DELETE FROM results WHERE digest = ? AND kind = ? AND version = ?", doomed)
+        self._disk_bytes = total - freed
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+            db = self._connect()
+            db.execute("DELETE FROM results")
+            db.commit()
+            self._disk_bytes = 0
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_result_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResultCache()
+    return _cache
@@ -0,0 +1,112 @@
+# textract_document.py
+import json
+from array import array
+from collections import defaultdict
+
+
+def textract_bbox_to_layoutlm(box):
+    x0 = int(box["Left"] * 1000)
+    y0 = int(box["Top"] * 1000)
+    x1 = int((box["Left"] + box["Width"]) * 1000)
+    y1 = int((box["Top"] + box["Height"]) * 1000)
+    return [x0, y0, x1, y1]
+
+
+class TextractDocument:
+    """
+    A Textract analysis indexed in a single pass over its blocks.
+
+    Holds an Id -> block index, blocks grouped by BlockType and by page, and the
+    WORD blocks' text, LayoutLM boxes (0-1000 scale) and page numbers in compact
+    arrays, so every extractor can share one parse of the upload.
+    """
+
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.by_id = {}
+        self.by_type = defaultdict(list)
+        self.pages = defaultdict(list)
+
+        self.words = []
+        self.word_ids = []
+        self.word_boxes = array("h")  # x0, y0, x1, y1 per word, flattened
+        self.word_pages = array("h")
+
+        for block in blocks:
+            block_id = block.get("Id")
+            if block_id:
+                self.by_id[block_id] = block
+            block_type = block.get("BlockType")
+            self.by_type[block_type].append(block)
+            page = block.get("Page", 1)
+            self.pages[page].append(block)
+
+            if block_type == "WORD":
+                self.words.append(block["Text"])
+                self.word_ids.append(block_id)
+                self.word_boxes.extend(textract_bbox_to_layoutlm(block["Geometry"]["BoundingBox"]))
+                self.word_pages.append(page)
+
+    @classmethod
+    def from_dict(cls, textract_data):
+        return cls(textract_data.get("Blocks", []))
+
+    @classmethod
+    def from_json(cls, raw):
+        return cls.from_dict(json.loads(raw))
+
+    @classmethod
+    def from_path(cls, json_path):
+        with open(json_path, "r") as f:
+            return cls.from_dict(json.load(f))
+
+    @classmethod
+    def load(cls, source):
+        """Accept a TextractDocument, a Textract dict or a path to a Textract JSON file."""
+        if isinstance(source, cls):
+            return source
+        if isinstance(source, dict):
+            return cls.from_dict(source)
+        return cls.from_path(source)
+
+    def __len__(self):
+        return len(self.blocks)
+
+    @property
+    def page_numbers(self):
+        return sorted(self.pages)
+
+    @property
+    def key_value_words(self):
+        """Per word, whether it belongs to a KEY_VALUE_SET block (a form key or value)."""
+        ids = set()
+        for block in self.by_type.get("KEY_VALUE_SET", []):
+            ids.update(self.related_ids(block))
+        return [word_id in ids for word_id in self.word_ids]
+
+    @property
+    def boxes(self):
+        b = self.word_boxes
+        return [list(b[i:i + 4]) for i in range(0, len(b), 4)]
+
+    def get(self, block_id):
+        return self.by_id.get(block_id)
+
+    def related_ids(self, block, rel_type="CHILD"):
+        for rel in block.get("Relationships", []):
+            if rel.get("Type") == rel_type:
+                yield from rel.get("Ids", [])
+
+    def related(self, block, rel_type="CHILD"):
+        for block_id in self.related_ids(block, rel_type):
+            child = self.by_id.get(block_id)
+            if child is not None:
+                yield child
+
+    def layoutlm_data(self):
+        return {
+            "words": list(self.words),
+            "boxes": self.boxes,
+            "pages": list(self.word_pages),
+            "key_value": self.key_value_words
+        }
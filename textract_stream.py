@@ -0,0 +1,289 @@
+# textract_stream.py
+import glob
+import json
+import os
+import re
+from array import array
+
+from textract_document import textract_bbox_to_layoutlm
+
+CHUNK_SIZE = 1 << 16
+_WHITESPACE = " \t\n\r"
+_decoder = json.JSONDecoder()
+
+
+class _StreamReader:
+    """Minimal incremental reader for one top-level Textract JSON object."""
+
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        if self.eof:
+            return False
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        # Drop what has been consumed so the buffer stays around one block in size
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of Textract JSON.")
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Expected '{char}' at offset {self.pos} of Textract JSON, found '{self.buf[self.pos]}'.")
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+                # A number (or literal) that touches the end of the buffer may continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+
+def iter_blocks(json_path, chunk_size=CHUNK_SIZE):
+    """
+    Yield the Blocks of one Textract JSON file one at a time, without loading the
+    whole file. Other top-level keys (DocumentMetadata, NextToken, ...) are skipped.
+    """
+    with open(json_path, "r", encoding="utf-8") as f:
+        reader = _StreamReader(f, chunk_size)
+        reader.expect("{")
+        if reader.peek() == "}":
+            return
+        while True:
+            key = reader.value()
+            reader.expect(":")
+            if key == "Blocks":
+                reader.expect("[")
+                if reader.peek() == "]":
+                    reader.pos += 1
+                else:
+                    while True:
+                        yield reader.value()
+                        if reader.peek() == ",":
+                            reader.pos += 1
+                            continue
+                        reader.expect("]")
+                        break
+            else:
+                reader.value()
+            if reader.peek() == ",":
+                reader.pos += 1
+                continue
+            reader.expect("}")
+            return
+
+
+def _natural_key(path):
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", os.path.basename(path))]
+
+
+def textract_parts(source):
+    """
+    Resolve the JSON files of one Textract job, in page order.
+
+    `source` may be a single file, a directory holding the paginated output of an
+    async job (files "1", "2", ... or "*.json"), a glob pattern or a list of paths.
+    """
+    if isinstance(source, (list, tuple)):
+        return list(source)
+    if os.path.isdir(source):
+        parts = [
+            os.path.join(source, name) for name in os.listdir(source)
+            if not name.startswith(".") and os.path.isfile(os.path.join(source, name))
+        ]
+        return sorted(parts, key=_natural_key)
+    if any(ch in source for ch in "*?["):
+        return sorted(glob.glob(source), key=_natural_key)
+    return [source]
+
+
+class _PageState:
+    """Relationships of the current page, kept until the page is complete."""
+
+    def __init__(self, page):
+        self.page = page
+        self.word_text = {}
+        self.selected = set()
+        self.keys = []
+        self.values = {}
+        self.cells = []
+        self.cell_table = {}
+
+    def add(self, block):
+        block_type = block.get("BlockType")
+        if block_type == "WORD":
+            self.word_text[block["Id"]] = block.get("Text", "")
+        elif block_type == "SELECTION_ELEMENT":
+            if block.get("SelectionStatus") == "SELECTED":
+                self.selected.add(block["Id"])
+        elif block_type == "KEY_VALUE_SET":
+            entity_types = block.get("EntityTypes", [])
+            if "KEY" in entity_types:
+                self.keys.append((_related_ids(block, "CHILD"), _related_ids(block, "VALUE")))
+            elif "VALUE" in entity_types:
+                self.values[block.get("Id")] = _related_ids(block, "CHILD")
+        elif block_type == "CELL":
+            self.cells.append((
+                block.get("RowIndex", -1),
+                block.get("ColumnIndex", -1),
+                block.get("RowSpan", 1),
+                block.get("ColumnSpan", 1),
+                block.get("Id"),
+                _related_ids(block, "CHILD")
+            ))
+        elif block_type == "TABLE":
+            for cell_id in _related_ids(block, "CHILD"):
+                self.cell_table[cell_id] = block.get("Id")
+
+    def _text(self, child_ids, with_selection):
+        parts = []
+        for child_id in child_ids:
+            if child_id in self.word_text:
+                parts.append(self.word_text[child_id])
+            elif with_selection and child_id in self.selected:
+                parts.append("X")
+        return " ".join(parts).strip()
+
+    def records(self):
+        for child_ids, value_ids in self.keys:
+            key_text = self._text(child_ids, True)
+            if not key_text:
+                continue
+            value_text = ""
+            for value_id in value_ids:
+                if value_id in self.values:
+                    value_text = self._text(self.values[value_id], True)
+                    break
+            yield {"type": "kv", "page": self.page, "key": key_text, "value": value_text}
+
+        for row, column, row_span, column_span, cell_id, child_ids in self.cells:
+            yield {
+                "type": "cell",
+                "page": self.page,
+                "table": self.cell_table.get(cell_id),
+                "row": row,
+                "column": column,
+                "row_span": row_span,
+                "column_span": column_span,
+                "text": self._text(child_ids, False)
+            }
+
+
+def _related_ids(block, rel_type):
+    ids = []
+    for rel in block.get("Relationships", []):
+        if rel.get("Type") == rel_type:
+            ids.extend(rel.get("Ids", []))
+    return ids
+
+
+def iter_textract_records(source, chunk_size=CHUNK_SIZE):
+    """
+    Stream word, key-value and table-cell records out of a (possibly multi-part)
+    Textract analysis.
+
+    Words are emitted as soon as their block is read. KV pairs and cells reference
+    words by Id, so they are resolved and emitted when their page is complete;
+    Textract writes each page's blocks contiguously, so only one page of state is
+    ever held in memory.
+
+    Yields dicts with "type" set to "word" (text, box, page), "kv" (key, value,
+    page) or "cell" (table, row, column, row_span, column_span, text, page).
+    """
+    state = None
+    for part in textract_parts(source):
+        for block in iter_blocks(part, chunk_size):
+            page = block.get("Page", 1)
+            if state is None or page != state.page:
+                if state is not None:
+                    yield from state.records()
+                state = _PageState(page)
+            state.add(block)
+
+            if block.get("BlockType") == "WORD":
+                yield {
+                    "type": "word",
+                    "page": page,
+                    "text": block["Text"],
+                    "box": textract_bbox_to_layoutlm(block["Geometry"]["BoundingBox"])
+                }
+    if state is not None:
+        yield from state.records()
+
+
+def stream_layoutlm_data(source, chunk_size=CHUNK_SIZE):
+    """
+    Words and LayoutLM boxes of a Textract analysis, read with bounded memory.
+
+    Returns the same {"words", "boxes"} structure as prepare_predict_data, plus the
+    page of every word and whether it belongs to a KEY_VALUE_SET block ("key_value").
+    KEY_VALUE_SET blocks reference words by Id, so they are resolved per page, like
+    iter_textract_records does.
+    """
+    words = []
+    boxes = array("h")
+    pages = array("h")
+    key_value = bytearray()
+    page, page_words, key_value_ids = None, {}, set()
+    for part in textract_parts(source):
+        for block in iter_blocks(part, chunk_size):
+            if block.get("Page", 1) != page:
+                _mark_key_value(key_value, page_words, key_value_ids)
+                page, page_words, key_value_ids = block.get("Page", 1), {}, set()
+            block_type = block.get("BlockType")
+            if block_type == "WORD":
+                page_words[block.get("Id")] = len(words)
+                words.append(block["Text"])
+                boxes.extend(textract_bbox_to_layoutlm(block["Geometry"]["BoundingBox"]))
+                pages.append(block.get("Page", 1))
+                key_value.append(0)
+            elif block_type == "KEY_VALUE_SET":
+                key_value_ids.update(_related_ids(block, "CHILD"))
+    _mark_key_value(key_value, page_words, key_value_ids)
+
+    return {
+        "words": words,
+        "boxes": [list(boxes[i:i + 4]) for i in range(0, len(boxes), 4)],
+        "pages": list(pages),
+        "key_value": [flag == 1 for flag in key_value]
+    }
+
+
+def _mark_key_value(key_value, page_words, key_value_ids):
+    for word_id in key_value_ids:
+        index = page_words.get(word_id)
+        if index is not None:
+            key_value[index] = 1
+
+
+def stream_key_value_pairs(source, chunk_size=CHUNK_SIZE):
+    """Streaming counterpart of importjson.extract_key_value_pairs."""
+    kv_pairs = {}
+    for record in iter_textract_records(source, chunk_size):
+        if record["type"] == "kv":
+            kv_pairs[record["key"]] = record["value"]
+    return kv_pairs
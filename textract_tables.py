@@ -0,0 +1,346 @@
+# textract_tables.py
+"""
+Tables of Textract analyses, one per TABLE block.
+
+    python textract_tables.py uploads/ --output line_items.parquet
+
+Every table keeps its page, title and footer; merged cells are resolved into
+every position they span, and header rows (COLUMN_HEADER cells) become the
+column names. Cells are collected straight into columns. From the command line
+the cells of many analyses are written, in a long format (one row per cell), to
+a single Parquet, Arrow or CSV file that can be queried across documents.
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+from bulk_ingest import find_files
+from textract_document import TextractDocument
+
+# Cell EntityTypes -> row type, most specific first
+ROW_TYPES = [
+    ("COLUMN_HEADER", "header"),
+    ("TABLE_TITLE", "title"),
+    ("TABLE_SECTION_TITLE", "section_title"),
+    ("TABLE_SUMMARY", "summary"),
+    ("TABLE_FOOTER", "footer")
+]
+# Columns of the long (one row per cell) format
+CELL_COLUMNS = ["document", "table", "page", "row", "column", "column_name", "row_type", "text"]
+
+
+def block_text(doc, block):
+    """Text of the WORD children of a block, space separated."""
+    return " ".join(child.get("Text", "") for child in doc.related(block, "CHILD") if child["BlockType"] == "WORD")
+
+
+class ExtractedTable:
+    """
+    One Textract TABLE block.
+
+    `columns[c][r]` holds the text of row r, column c (0-based); `row_types[r]` is
+    "header", "title", "section_title", "summary", "footer" or "body". `merged`
+    lists the merged spans as (row, column, row_span, column_span), 0-based.
+    """
+
+    def __init__(self, index, n_rows, n_cols, page=1, table_id=None, kind=None, title="", footer="", confidence=None):
+        self.index = index
+        self.table_id = table_id
+        self.page = page
+        self.kind = kind
+        self.title = title
+        self.footer = footer
+        self.confidence = confidence
+        self.columns = [[""] * n_rows for _ in range(n_cols)]
+        self.row_types = ["body"] * n_rows
+        self.merged = []
+
+    @property
+    def n_rows(self):
+        return len(self.row_types)
+
+    @property
+    def n_cols(self):
+        return len(self.columns)
+
+    @property
+    def header_rows(self):
+        return [r for r, row_type in enumerate(self.row_types) if row_type == "header"]
+
+    @property
+    def data_rows(self):
+        return [r for r, row_type in enumerate(self.row_types) if row_type not in ("header", "title")]
+
+    @property
+    def column_names(self):
+        """
+        One unique name per column, from the header rows (a multi-row header is joined
+        with " / "). Columns without a header are named column_<n>.
+        """
+        names, seen = [], {}
+        for c, column in enumerate(self.columns):
+            parts = []
+            for r in self.header_rows:
+                if column[r] and column[r] not in parts:
+                    parts.append(column[r])
+            name = " / ".join(parts) or f"column_{c + 1}"
+            seen[name] = seen.get(name, 0) + 1
+            names.append(name if seen[name] == 1 else f"{name}_{seen[name]}")
+        return names
+
+    def to_dataframe(self):
+        """The data rows under the header's column names (summary and section rows included)."""
+        # Imported here: pandas is slow to import and the server only needs it when writing CSVs
+        import pandas as pd
+
+        rows = self.data_rows
+        return pd.DataFrame({name: [column[r] for r in rows] for name, column in zip(self.column_names, self.columns)},
+                            columns=self.column_names)
+
+    def cell_columns(self, document=None):
+        """The table in the long format: a dict of CELL_COLUMNS lists, one entry per cell."""
+        names = self.column_names
+        n = self.n_rows * self.n_cols
+        cells = {
+            "document": [document] * n,
+            "table": [self.index] * n,
+            "page": [self.page] * n,
+            "row": [r for _ in range(self.n_cols) for r in range(self.n_rows)],
+            "column": [c for c in range(self.n_cols) for _ in range(self.n_rows)],
+            "column_name": [name for name in names for _ in range(self.n_rows)],
+            "row_type": self.row_types * self.n_cols,
+            "text": [text for column in self.columns for text in column]
+        }
+        return cells
+
+    def to_json(self):
+        """JSON-serializable form (e.g. for the result cache and API responses)."""
+        return {
+            "index": self.index,
+            "table_id": self.table_id,
+            "page": self.page,
+            "kind": self.kind,
+            "title": self.title,
+            "footer": self.footer,
+            "confidence": self.confidence,
+            "columns": self.column_names,
+            "row_types": self.row_types,
+            "cells": self.columns,
+            "merged": self.merged
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        table = cls(
+            data["index"], len(data["row_types"]), len(data["cells"]),
+            page=data["page"], table_id=data["table_id"], kind=data["kind"],
+            title=data["title"], footer=data["footer"], confidence=data["confidence"]
+        )
+        table.columns = [list(column) for column in data["cells"]]
+        table.row_types = list(data["row_types"])
+        table.merged = [tuple(span) for span in data["merged"]]
+        return table
+
+
+def _row_type(block):
+    entity_types = block.get("EntityTypes") or []
+    for entity_type, row_type in ROW_TYPES:
+        if entity_type in entity_types:
+            return row_type
+    return None
+
+
+def _apply_row_type(table, row, row_type):
+    if row_type is None:
+        return
+    current = table.row_types[row]
+    order = [name for _, name in ROW_TYPES]
+    if current == "body" or order.index(row_type) < order.index(current):
+        table.row_types[row] = row_type
+
+
+def extract_tables(textract_data):
+    """
+    Extract every table of a Textract analysis.
+
+    Parameters:
+        textract_data (dict | TextractDocument | str): Textract JSON output, its parsed document or a path.
+
+    Returns:
+        list: ExtractedTable per TABLE block, in page order.
+    """
+    doc = TextractDocument.load(textract_data)
+    tables = []
+    for table_block in sorted(doc.by_type.get("TABLE", []), key=lambda b: b.get("Page", 1)):
+        cells = [cell for cell in doc.related(table_block, "CHILD") if cell["BlockType"] == "CELL"]
+        if not cells:
+            continue
+        n_rows = max(cell["RowIndex"] + cell.get("RowSpan", 1) - 1 for cell in cells)
+        n_cols = max(cell["ColumnIndex"] + cell.get("ColumnSpan", 1) - 1 for cell in cells)
+        entity_types = table_block.get("EntityTypes") or []
+        table = ExtractedTable(
+            len(tables), n_rows, n_cols,
+            page=table_block.get("Page", 1),
+            table_id=table_block.get("Id"),
+            kind="semi_structured" if "SEMI_STRUCTURED_TABLE" in entity_types else "structured",
+            title=" ".join(block_text(doc, b) for b in doc.related(table_block, "TABLE_TITLE")),
+            footer=" ".join(block_text(doc, b) for b in doc.related(table_block, "TABLE_FOOTER")),
+            confidence=table_block.get("Confidence")
+        )
+
+        for cell in cells:
+            row, col = cell["RowIndex"] - 1, cell["ColumnIndex"] - 1
+            table.columns[col][row] = block_text(doc, cell)
+            _apply_row_type(table, row, _row_type(cell))
+
+        # A merged cell's text is its cells' text in reading order, repeated in every
+        # position it spans (like pandas.read_html does with rowspan/colspan)
+        for merged in doc.related(table_block, "MERGED_CELL"):
+            row, col = merged["RowIndex"] - 1, merged["ColumnIndex"] - 1
+            row_span, col_span = merged.get("RowSpan", 1), merged.get("ColumnSpan", 1)
+            children = sorted(doc.related(merged, "CHILD"), key=lambda c: (c["RowIndex"], c["ColumnIndex"]))
+            text = " ".join(t for t in (table.columns[c["ColumnIndex"] - 1][c["RowIndex"] - 1] for c in children) if t)
+            for r in range(row, row + row_span):
+                for c in range(col, col + col_span):
+                    table.columns[c][r] = text
+                _apply_row_type(table, r, _row_type(merged))
+            table.merged.append((row, col, row_span, col_span))
+
+        if not table.title:
+            table.title = " ".join(table.columns[0][r] for r in range(n_rows) if table.row_types[r] == "title")
+        tables.append(table)
+    return tables
+
+
+def tables_to_cells(tables, document=None):
+    """Concatenate the long format of several tables into one dict of CELL_COLUMNS lists."""
+    cells = {name: [] for name in CELL_COLUMNS}
+    for table in tables:
+        for name, values in table.cell_columns(document).items():
+            cells[name].extend(values)
+    return cells
+
+
+class CellWriter:
+    """
+    Append long-format cells to one .parquet, .arrow/.feather or .csv file.
+
+    Parquet and Arrow need pyarrow; each write() becomes one row group / record
+    batch, so any number of documents can be written with bounded memory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.format = os.path.splitext(path)[1].lower().lstrip(".")
+        self._writer = None
+        self._schema = None
+        self._csv_header = True
+        if self.format in ("parquet", "arrow", "feather"):
+            try:
+                import pyarrow  # noqa: F401
+            except ImportError:
+                raise RuntimeError(f"Writing .{self.format} files needs pyarrow (pip install pyarrow), or use a .csv output.")
+        elif self.format != "csv":
+            raise ValueError(f"Unsupported table output '{path}', expected .parquet, .arrow, .feather or .csv.")
+
+    def write(self, cells):
+        if not cells["text"]:
+            return
+        if self.format == "csv":
+            import pandas as pd
+
+            pd.DataFrame(cells, columns=CELL_COLUMNS).to_csv(self.path, mode="w" if self._csv_header else "a",
+                                                             header=self._csv_header, index=False)
+            self._csv_header = False
+            return
+
+        import pyarrow as pa
+
+        if self._schema is None:
+            self._schema = pa.schema([
+                ("document", pa.string()), ("table", pa.int32()), ("page", pa.int32()), ("row", pa.int32()),
+                ("column", pa.int32()), ("column_name", pa.string()), ("row_type", pa.string()), ("text", pa.string())
+            ])
+        batch = pa.record_batch([pa.array(cells[name], type=self._schema.field(name).type) for name in CELL_COLUMNS],
+                                schema=self._schema)
+        if self._writer is None:
+            if self.format == "parquet":
+                import pyarrow.parquet as pq
+                self._writer = pq.ParquetWriter(self.path, self._schema)
+            else:
+                self._writer = pa.ipc.new_file(self.path, self._schema)
+        if self.format == "parquet":
+            self._writer.write_table(pa.Table.from_batches([batch]))
+        else:
+            self._writer.write_batch(batch)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _extract_file(path):
+    try:
+        tables = extract_tables(path)
+        return path, len(tables), tables_to_cells(tables, document=os.path.basename(path)), None
+    except Exception as e:
+        return path, 0, None, f"{type(e).__name__}: {e}"
+
+
+def extract_many(files, output_path, workers=None, batch_files=200):
+    """
+    Extract the tables of many analyses in a process pool into `output_path`.
+
+    Returns:
+        tuple: (number of tables, list of (path, error))
+    """
+    ctx = multiprocessing.get_context("spawn")
+    n_tables, errors = 0, []
+    pending = {name: [] for name in CELL_COLUMNS}
+    pending_files = 0
+    with CellWriter(output_path) as writer, ctx.Pool(workers or os.cpu_count()) as pool:
+        for path, count, cells, error in pool.imap_unordered(_extract_file, files, chunksize=4):
+            if error is not None:
+                errors.append((path, error))
+                continue
+            n_tables += count
+            for name in CELL_COLUMNS:
+                pending[name].extend(cells[name])
+            pending_files += 1
+            if pending_files >= batch_files:
+                writer.write(pending)
+                pending = {name: [] for name in CELL_COLUMNS}
+                pending_files = 0
+        writer.write(pending)
+    return n_tables, errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extract the tables of Textract analyses into one Parquet/Arrow/CSV file.")
+    parser.add_argument("sources", nargs="+", help="Directories (searched for *_async_analysis.json) or globs.")
+    parser.add_argument("--output", default="tables.parquet", help=".parquet, .arrow/.feather (need pyarrow) or .csv")
+    parser.add_argument("--workers", type=int, default=None, help="Parser processes (default: CPU count).")
+    parser.add_argument("--batch-files", type=int, default=200, help="Documents per Parquet row group.")
+    args = parser.parse_args(argv)
+
+    files = find_files(args.sources)
+    print(f"🚀 Extracting tables from {len(files)} files into {args.output}")
+    start = time.monotonic()
+    n_tables, errors = extract_many(files, args.output, workers=args.workers, batch_files=args.batch_files)
+    for path, error in errors:
+        print(f"⚠️ {path}: {error}")
+    print(f"✅ {n_tables} tables from {len(files) - len(errors)} files in {time.monotonic() - start:.1f}s ({len(errors)} errors)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,69 +1,671 @@
 # train_layoutlm.py
 import os
-import json
+import math
+import random
+import time
 import torch
 import shutil
-from PIL import Image
+import torch.nn.functional as F
 from torch.utils.data import Dataset
 from transformers import (
     AutoProcessor,
     AutoModelForSequenceClassification,
     TrainingArguments,
-    Trainer
+    Trainer,
+    EarlyStoppingCallback
 )
 from sklearn.metrics import accuracy_score, f1_score
-dummy_image = Image.new("RGB", (1000, 1000), color=(255, 255, 255))
-# ----- Labels -----
-LABELS = ["Invoice", "Poliza", "Packing List", "Other"]
+from model_holder import MODEL_DIR, MODEL_VOLUME_PATH
+from model_registry import ModelRegistry
+from collate import DocumentCollator, LengthBucketSampler, bucket_batches
+from corpus import LABELS, CorpusStore, CorpusView, locked, sample_hash
+from feature_cache import FeatureCache
+from embedding_cache import EmbeddingCache, backbone_fingerprint
+from cascade import CASCADE_ENABLED, CascadeClassifier, train_cascade
+from windowing import WindowConfig, split_windows
+from word_selection import WordSelection
+from blank_page import add_blank_pixel_values, blank_pixel_values, cache_blank_page_embedding, uses_visual_tokens
+from export_backends import EXPORT_BACKENDS, build_backends, parity_documents
+# ----- Labels (corpus.LABELS) -----
 label2id = {label: i for i, label in enumerate(LABELS)}
 id2label = {i: label for label, i in label2id.items()}
 
+# Long-document windowing, read from the same WINDOW_* settings as prediction
+TRAIN_WINDOWS = WindowConfig.from_env()
+# Reading order, header/footer dedup and token-budget policy (SELECTION_POLICY=first|per_page|
+# informative|key_value, SELECTION_READING_ORDER=1, ...); saved with the checkpoint, which is
+# served with it
+TRAIN_SELECTION = WordSelection.from_env()
+# TEXT_ONLY=1 trains (and therefore serves) a model without the blank-page visual tokens
+TEXT_ONLY = os.environ.get("TEXT_ONLY", "0") == "1"
+# TRAIN_MODE=head freezes the encoder and trains only the classification head on cached
+# embeddings (seconds); "full" fine-tunes the whole model (hours on CPU); "incremental"
+# fine-tunes the active model on the samples it hasn't seen plus a replay of ones it has
+TRAIN_MODE = os.environ.get("TRAIN_MODE", "full")
+TRAIN_MODES = ("full", "head", "incremental")
+HEAD_EPOCHS = int(os.environ.get("HEAD_EPOCHS", "50"))
+HEAD_LEARNING_RATE = float(os.environ.get("HEAD_LEARNING_RATE", "1e-3"))
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", "8"))
+
+# Held-out validation split (stratified per label) used for early stopping
+VALIDATION_FRACTION = float(os.environ.get("VALIDATION_FRACTION", "0.15"))
+# Without a validation split training runs TRAIN_EPOCHS; with one it stops early, after at most MAX_TRAIN_EPOCHS
+TRAIN_EPOCHS = int(os.environ.get("TRAIN_EPOCHS", "3"))
+MAX_TRAIN_EPOCHS = int(os.environ.get("MAX_TRAIN_EPOCHS", "10"))
+EARLY_STOPPING_PATIENCE = int(os.environ.get("EARLY_STOPPING_PATIENCE", "2"))
+
+# Incremental runs: replayed (already seen) samples per new one, balanced across labels and
+# capped, and a fixed step budget, so a run costs about the same however large the corpus is
+REPLAY_RATIO = float(os.environ.get("REPLAY_RATIO", "2"))
+REPLAY_MAX_SAMPLES = int(os.environ.get("REPLAY_MAX_SAMPLES", "200"))
+INCREMENTAL_EPOCHS = int(os.environ.get("INCREMENTAL_EPOCHS", "2"))
+INCREMENTAL_MAX_STEPS = int(os.environ.get("INCREMENTAL_MAX_STEPS", "200"))
+INCREMENTAL_LEARNING_RATE = float(os.environ.get("INCREMENTAL_LEARNING_RATE", "2e-5"))
+# An incremental run retrains fully instead when the active model's validation F1 has dropped
+# by more than this since the last full (or head) training
+DRIFT_THRESHOLD = float(os.environ.get("DRIFT_THRESHOLD", "0.05"))
+# The drift check and final evaluation of an incremental run use a stratified sample of
+# this many validation samples instead of the whole split
+INCREMENTAL_EVAL_SAMPLES = int(os.environ.get("INCREMENTAL_EVAL_SAMPLES", "200"))
+
 # ----- Dataset Class -----
 class DocumentDataset(Dataset):
-    def __init__(self, data, processor):
+    """
+    Training items built from corpus samples.
+
+    Without windowing there is one item per sample, truncated to 512 tokens. With a
+    WindowConfig every window of every sample is its own item carrying the
+    document's label, split exactly as predict_batch splits it. A WordSelection
+    orders and selects each sample's words first, as encode_for_prediction does.
+    """
+
+    def __init__(self, data, processor, feature_cache=None, window_config=None, include_pixel_values=True, selection=None):
         self.data = data
         self.processor = processor
+        self.feature_cache = feature_cache
+        self.window_config = window_config or WindowConfig()
+        self.selection = selection
+        self.include_pixel_values = include_pixel_values
+        self._items = None
+        self._lengths = None
+        self._pixel_values = None
 
     def __len__(self):
-        return len(self.data)
+        return len(self.items)
+
+    @property
+    def items(self):
+        """(sample index, window index) pairs; the window index is None without windowing."""
+        if self._items is None:
+            if self.window_config.enabled:
+                self._items = [(idx, w) for idx in range(len(self.data)) for w in range(self._window_count(idx))]
+            else:
+                self._items = [(idx, None) for idx in range(len(self.data))]
+        return self._items
 
-    def __getitem__(self, idx):
+    def sample_hash(self, idx):
+        # Corpus views know every sample's hash without decoding the sample
+        entries = getattr(self.data, "entries", None)
+        if entries is not None:
+            return entries[idx]["hash"]
         item = self.data[idx]
+        return item.get("hash") or sample_hash(item["words"], item["boxes"])
+
+    def _cache_key(self, idx, window):
+        digest = self.sample_hash(idx)
+        if self.selection is not None:
+            digest = f"{digest}:{self.selection.tag}"
+        return digest if window is None else f"{digest}:{self.window_config.tag}:{window}"
+
+    def _document(self, idx):
+        item = self.data[idx]
+        if self.selection is None:
+            return item
+        budget = None if self.window_config.enabled else self.window_config.max_length - 2
+        return self.selection.apply(item, self.processor.tokenizer, budget)
+
+    def item_key(self, i):
+        """Stable key of item `i`: the sample hash, plus the window for windowed items."""
+        return self._cache_key(*self.items[i])
+
+    @property
+    def pixel_values(self):
+        # Every sample uses the same blank page, so its pixel_values are computed once
+        if self._pixel_values is None:
+            self._pixel_values = blank_pixel_values(self.processor)
+        return self._pixel_values
+
+    @property
+    def lengths(self):
+        """Token length of every item, used to bucket similar lengths together."""
+        if self._lengths is None:
+            self._lengths = [len(self.encode(i)["input_ids"]) for i in range(len(self))]
+        return self._lengths
 
-        encoding = self.processor(
-            images=dummy_image, 
-            text=item["words"],
-            boxes=item["boxes"],
+    def _tokenize(self, words, boxes):
+        # No padding here: DocumentCollator pads each batch to its longest sample
+        encoding = self.processor.tokenizer(
+            words,
+            boxes=boxes,
             truncation=True,
-            padding="max_length",
             max_length=512,
-            return_tensors="pt"
+            return_tensors="np"
         )
+        return {k: v[0] for k, v in encoding.items() if k in ("input_ids", "bbox", "attention_mask")}
 
-        encoding = {k: v.squeeze(0) for k, v in encoding.items()}
-        encoding["labels"] = torch.tensor(label2id[item["label"]])
+    def _encode_windows(self, idx):
+        item = self._document(idx)
+        spans = split_windows(self.processor.tokenizer, item["words"], item["boxes"], item.get("pages"), self.window_config)
+        encodings = [self._tokenize(item["words"][start:end], item["boxes"][start:end]) for start, end, _ in spans]
+        if self.feature_cache is not None:
+            self.feature_cache.put_many([(self._cache_key(idx, w), e) for w, e in enumerate(encodings)])
+        return encodings
+
+    def _window_count(self, idx):
+        # A sample's windows are cached together, so count them without re-tokenizing
+        if self.feature_cache is not None:
+            n = 0
+            while self._cache_key(idx, n) in self.feature_cache:
+                n += 1
+            if n:
+                return n
+        return len(self._encode_windows(idx))
+
+    def encode(self, i):
+        """Tokenized features of one item, from the feature cache when possible."""
+        idx, window = self.items[i]
+        if self.feature_cache is not None:
+            cached = self.feature_cache.get(self._cache_key(idx, window))
+            if cached is not None:
+                return cached
+
+        if window is not None:
+            return self._encode_windows(idx)[window]
+
+        item = self._document(idx)
+        encoding = self._tokenize(item["words"], item["boxes"])
+        if self.feature_cache is not None:
+            self.feature_cache.put(self._cache_key(idx, None), encoding)
+        return encoding
+
+    def label(self, i):
+        idx, _ = self.items[i]
+        entries = getattr(self.data, "entries", None)
+        return entries[idx]["label"] if entries is not None else self.data[idx]["label"]
+
+    def __getitem__(self, i):
+        encoding = dict(self.encode(i))
+        if self.include_pixel_values:
+            encoding["pixel_values"] = self.pixel_values
+        encoding["labels"] = torch.tensor(label2id[self.label(i)])
         return encoding
 
+class BucketTrainer(Trainer):
+    """
+    Trainer that batches documents of similar token length together.
+
+    With `eval_documents` (validation samples) evaluate() classifies whole documents
+    exactly as prediction does (predict_batch: length-sorted batches, windows pooled
+    per document) and reports eval_accuracy and eval_f1, which drive early stopping
+    and the choice of the best checkpoint. With an `eval_cascade` it also reports
+    eval_pipeline_f1 and eval_cascade_hit_rate (see evaluate_documents).
+    """
+
+    def __init__(self, *args, eval_documents=None, eval_processor=None, window_config=None, eval_cascade=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.eval_documents = eval_documents
+        self.eval_processor = eval_processor
+        self.window_config = window_config
+        self.eval_cascade = eval_cascade
+
+    def _get_train_sampler(self, *args, **kwargs):
+        return LengthBucketSampler(
+            self.train_dataset.lengths,
+            self.args.per_device_train_batch_size,
+            seed=self.args.seed
+        )
+
+    def evaluate(self, eval_dataset=None, ignore_keys=None, metric_key_prefix="eval"):
+        if not self.eval_documents:
+            return super().evaluate(eval_dataset, ignore_keys=ignore_keys, metric_key_prefix=metric_key_prefix)
+        start = time.perf_counter()
+        results = evaluate_documents(self.model, self.eval_processor, self.eval_documents, self.window_config, self.eval_cascade)
+        metrics = {f"{metric_key_prefix}_{k}": v for k, v in results.items()}
+        metrics[f"{metric_key_prefix}_runtime"] = time.perf_counter() - start
+        metrics["epoch"] = self.state.epoch
+        self.log(metrics)
+        self.control = self.callback_handler.on_evaluate(self.args, self.state, self.control, metrics)
+        return metrics
+
+# ----- Head-only training -----
+def document_embeddings(model, processor, dataset, cache, batch_size=EMBEDDING_BATCH_SIZE, cancel_check=None):
+    """
+    Pooled ([CLS]) encoder embedding of every dataset item, as the classification
+    head sees it. Only items missing from `cache` go through the encoder.
+    `cancel_check` is called before every batch and raises to stop.
+
+    Returns:
+        tuple: (len(dataset) x hidden_size float32 array, number of items computed)
+    """
+    keys = [dataset.item_key(i) for i in range(len(dataset))]
+    missing = [i for i, key in enumerate(keys) if key not in cache]
+    if missing:
+        print(f"🔹 Computing {len(missing)} embeddings ({len(keys) - len(missing)} cached)...")
+        collator = DocumentCollator(processor.tokenizer.pad_token_id)
+        model.eval()
+        cache_blank_page_embedding(model, processor)
+        with torch.no_grad():
+            for batch in bucket_batches([dataset.lengths[i] for i in missing], batch_size):
+                if cancel_check is not None:
+                    cancel_check()
+                items = [missing[j] for j in batch]
+                inputs = add_blank_pixel_values(collator([dataset.encode(i) for i in items]), processor, model)
+                hidden = model.base_model(**inputs).last_hidden_state[:, 0, :]
+                cache.put_many(zip([keys[i] for i in items], hidden.numpy()))
+    return cache.get_many(keys), len(missing)
+
+
+def train_classifier_head(model, processor, dataset, epochs=HEAD_EPOCHS, learning_rate=HEAD_LEARNING_RATE, batch_size=32, seed=42,
+                          cancel_check=None):
+    """
+    Train only `model.classifier` on cached encoder embeddings; the encoder is frozen.
+
+    Embeddings are cached per item key and backbone fingerprint (EmbeddingCache), so
+    after new uploads only the new samples are encoded and the head trains in seconds.
+
+    Returns:
+        dict: Training metrics (loss, accuracy, runtime, embedding counts).
+    """
+    start = time.perf_counter()
+    backbone = backbone_fingerprint(model)
+    cache = EmbeddingCache(backbone, processor, model.config.hidden_size)
+    embeddings, computed = document_embeddings(model, processor, dataset, cache, cancel_check=cancel_check)
+    embedding_seconds = time.perf_counter() - start
+
+    x = torch.from_numpy(embeddings)
+    y = torch.tensor([label2id[dataset.label(i)] for i in range(len(dataset))])
+    head = model.classifier
+    head.train()
+    optimizer = torch.optim.AdamW(head.parameters(), lr=learning_rate)
+    generator = torch.Generator().manual_seed(seed)
+
+    for epoch in range(epochs):
+        if cancel_check is not None:
+            cancel_check()
+        total_loss = 0.0
+        for batch in torch.randperm(len(y), generator=generator).split(batch_size):
+            loss = F.cross_entropy(head(x[batch]), y[batch])
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            total_loss += loss.item() * len(batch)
+    head.eval()
+    model.eval()
+
+    with torch.no_grad():
+        accuracy = (head(x).argmax(-1) == y).float().mean().item()
+    metrics = {
+        "train_loss": total_loss / len(y),
+        "train_accuracy": accuracy,
+        "epoch": float(epochs),
+        "embeddings_computed": computed,
+        "embeddings_cached": len(y) - computed,
+        "embedding_seconds": embedding_seconds,
+        "train_runtime": time.perf_counter() - start,
+        "backbone": backbone
+    }
+    print(f"🔹 Classifier head trained: {metrics}")
+    return metrics
+
 # ----- Metrics -----
-def compute_metrics(pred):
-    preds = pred.predictions.argmax(-1)
-    labels = pred.label_ids
+def classification_metrics(labels, preds):
     return {
-        "accuracy": accuracy_score(labels, preds),
-        "f1": f1_score(labels, preds, average="weighted")
+        "accuracy": float(accuracy_score(labels, preds)),
+        "f1": float(f1_score(labels, preds, average="weighted"))
     }
 
+def compute_metrics(pred):
+    return classification_metrics(pred.label_ids, pred.predictions.argmax(-1))
+
+def evaluate_documents(model, processor, documents, window_config=None, cascade=None):
+    """
+    Document-level accuracy and weighted F1 of `model` on labeled `documents`,
+    classified through predict_batch like at serving time (with TRAIN_SELECTION).
+
+    With the `cascade` served in front of the model, also "pipeline_f1", the F1 of
+    what is served (the cascade's answer where it is confident, the model's
+    elsewhere), and "cascade_hit_rate", from the same forward passes.
+    """
+    # Imported here: importjson pulls in the serving-side modules training doesn't otherwise need
+    from importjson import predict_batch
+
+    was_training = model.training
+    model.eval()
+    try:
+        results = predict_batch(documents, window_config or TRAIN_WINDOWS, processor=processor, model=model, selection=TRAIN_SELECTION)
+    finally:
+        model.train(was_training)
+    expected = [label2id[doc["label"]] for doc in documents]
+    metrics = classification_metrics(expected, [label2id[result["label"]] for result in results])
+    if cascade is not None:
+        decisions = cascade.decide(documents)
+        served = [decision or result for decision, result in zip(decisions, results)]
+        metrics["pipeline_f1"] = classification_metrics(expected, [label2id[result["label"]] for result in served])["f1"]
+        metrics["cascade_hit_rate"] = sum(decision is not None for decision in decisions) / len(documents)
+    return metrics
+
+
+def pipeline_metrics(metrics):
+    """
+    The validation F1 of the version as it is served (cascade first) and the
+    cascade's hit rate, from evaluate_documents' "eval_"-prefixed metrics.
+    """
+    if "eval_f1" not in metrics:
+        return {}
+    pipeline = {
+        "pipeline_eval_f1": metrics.get("eval_pipeline_f1", metrics["eval_f1"]),
+        "cascade_hit_rate": metrics.get("eval_cascade_hit_rate", 0.0)
+    }
+    print(f"🔹 Validation as served: f1 {pipeline['pipeline_eval_f1']:.3f}, {pipeline['cascade_hit_rate']:.0%} answered by the cascade")
+    return pipeline
+
 #import os
 #import json
 #import shutil
 #from transformers import AutoProcessor, AutoModelForSequenceClassification, TrainingArguments, Trainer
 
-def train():
-    print("🔹 Loading processor and model...")
+def load_corpus(jsonl_dir="train_data"):
+    """
+    Open the sharded training corpus, importing any legacy .jsonl files into it first
+    (duplicates are skipped, so this is safe to repeat). Samples whose label is not
+    in LABELS are left out.
+    """
+    corpus = CorpusStore(os.path.join(jsonl_dir, "corpus"))
+
+    if os.path.isdir(jsonl_dir):
+        for name in sorted(os.listdir(jsonl_dir)):
+            if name.endswith(".jsonl"):
+                added = corpus.import_jsonl(os.path.join(jsonl_dir, name))
+                if added:
+                    print(f"🔹 Imported {added} samples from {name} into the corpus")
+
+    summary = corpus.summary()
+    if not summary["samples"]:
+        print(f"❌ No training samples found in '{corpus.root}'!")
+        return None
+
+    unknown = {label: n for label, n in summary["label_counts"].items() if label not in label2id}
+    if unknown:
+        print(f"⚠️ Skipping samples with labels not in {LABELS}: {unknown}")
+
+    data = corpus.view(lambda entry: entry["label"] in label2id)
+    print(f"🔹 Loaded {len(data)} samples from {len(summary['shards'])} shard(s) in {corpus.root}: {summary['label_counts']}")
+    return data if len(data) else None
+
+def split_train_validation(data, fraction=VALIDATION_FRACTION, trained=None, pinned=None):
+    """
+    Stratified train/validation split of a corpus view.
+
+    Per label, round(fraction * n) samples (at least one when the label has two or
+    more) go to validation. Samples are taken in hash order, so the split is stable
+    across runs. Labels with a single sample stay in training.
+
+    Parameters:
+        trained (set): Hashes of the samples the starting checkpoint was trained on;
+            they never go to validation, however the corpus has grown since.
+        pinned (set): Validation hashes recorded by an earlier version; when given,
+            exactly those samples (still in the corpus, not in `trained`) are validation.
+
+    Returns:
+        tuple: (train CorpusView, validation CorpusView)
+    """
+    trained = trained or set()
+    if pinned is not None:
+        validation = {e["hash"] for e in data.entries if e["hash"] in pinned and e["hash"] not in trained}
+        train_entries = [e for e in data.entries if e["hash"] not in validation]
+        validation_entries = [e for e in data.entries if e["hash"] in validation]
+        return CorpusView(data.store, train_entries), CorpusView(data.store, validation_entries)
+
+    by_label = {}
+    for entry in data.entries:
+        by_label.setdefault(entry["label"], []).append(entry)
+
+    validation = set()
+    if fraction > 0:
+        for entries in by_label.values():
+            if len(entries) < 2:
+                continue
+            count = min(max(1, round(fraction * len(entries))), len(entries) - 1)
+            candidates = [e for e in entries if e["hash"] not in trained]
+            validation.update(e["hash"] for e in sorted(candidates, key=lambda e: e["hash"])[:count])
+
+    train_entries = [e for e in data.entries if e["hash"] not in validation]
+    validation_entries = [e for e in data.entries if e["hash"] in validation]
+    return CorpusView(data.store, train_entries), CorpusView(data.store, validation_entries)
+
+def replay_sample(entries, size, seed=42):
+    """
+    Class-balanced sample of up to `size` corpus entries: labels take turns, each
+    drawing from its own entries in a seeded random order, so rare labels are
+    replayed as often as common ones until they run out.
+    """
+    rng = random.Random(seed)
+    by_label = {}
+    for entry in sorted(entries, key=lambda e: e["hash"]):
+        by_label.setdefault(entry["label"], []).append(entry)
+    queues = []
+    for label in sorted(by_label):
+        rng.shuffle(by_label[label])
+        queues.append(by_label[label])
+
+    picked = []
+    while len(picked) < size and any(queues):
+        for queue in queues:
+            if queue and len(picked) < size:
+                picked.append(queue.pop())
+    return picked
+
+def stratified_sample(data, size):
+    """
+    About `size` samples of a corpus view, each label in its corpus proportion (at
+    least one sample per label), taken in hash order so the sample is stable across runs.
+    """
+    if len(data) <= size:
+        return data
+    by_label = {}
+    for entry in sorted(data.entries, key=lambda e: e["hash"]):
+        by_label.setdefault(entry["label"], []).append(entry)
+    picked = []
+    for entries in by_label.values():
+        picked.extend(entries[:max(1, round(size * len(entries) / len(data)))])
+    return CorpusView(data.store, picked)
+
+def reference_metrics(model, processor, validation, metrics):
+    """
+    The validation F1 later incremental runs measure drift against. It is taken on
+    the sample of the validation set those runs evaluate (stratified_sample of
+    INCREMENTAL_EVAL_SAMPLES), recorded by its fingerprint, so both F1s are computed
+    on the same documents.
+    """
+    if validation is None or not len(validation):
+        return {"reference_f1": None}
+    reference = stratified_sample(validation, INCREMENTAL_EVAL_SAMPLES)
+    if len(reference) == len(validation):
+        f1 = metrics.get("eval_f1")
+    else:
+        f1 = evaluate_documents(model, processor, list(reference))["f1"]
+    return {"reference_f1": f1, "reference_data_hash": reference.fingerprint()}
+
+def plan_incremental(model, processor, train_data, eval_data, registry=None):
+    """
+    Decide what an incremental run trains on.
+
+    Falls back to a full run when the active version didn't record its samples, was
+    trained with another word selection than TRAIN_SELECTION, or its validation F1
+    dropped by more than DRIFT_THRESHOLD since the last full (or head) training, the
+    reference carried over by incremental versions. Both F1s are taken on `eval_data`;
+    when the reference was measured on other samples (reference_data_hash), the run
+    is full too.
+
+    Returns:
+        dict: "mode" ("incremental", "full", or None when there are no new samples),
+        "reason", and for incremental runs "base_version", "seen", "new", "replay",
+        "reference_f1" and "drift".
+    """
+    registry = registry or ModelRegistry()
+    base_version = registry.active_version()
+    seen = registry.seen_samples(base_version) if base_version else None
+    if seen is None:
+        return {"mode": "full", "reason": "the active model didn't record which samples it was trained on"}
+
+    # Versions from before word selection saw their words as given, like the default selection
+    base_selection = WordSelection.load(registry.version_dir(base_version)) or WordSelection()
+    if base_selection.tag != TRAIN_SELECTION.tag:
+        return {"mode": "full", "reason": f"word selection changed from {base_selection.tag} to {TRAIN_SELECTION.tag}"}
+
+    new = [e for e in train_data.entries if e["hash"] not in seen]
+    if not new:
+        return {"mode": None, "reason": f"no new samples since version {base_version}"}
+
+    base = registry.metadata(base_version)
+    reference_f1 = base.get("reference_f1")
+    drift = None
+    if len(eval_data) and reference_f1 is not None:
+        if base.get("reference_data_hash") != eval_data.fingerprint():
+            return {"mode": "full", "reason": f"the reference F1 of version {base_version} was measured on other validation samples"}
+        current_f1 = evaluate_documents(model, processor, list(eval_data))["f1"]
+        drift = reference_f1 - current_f1
+        print(f"🔹 Validation F1 of version {base_version}: {current_f1:.3f} (reference {reference_f1:.3f})")
+        if drift > DRIFT_THRESHOLD:
+            return {"mode": "full", "reason": f"validation F1 drifted by {drift:.3f} (threshold {DRIFT_THRESHOLD})"}
+
+    size = min(int(math.ceil(REPLAY_RATIO * len(new))), REPLAY_MAX_SAMPLES)
+    replay = replay_sample([e for e in train_data.entries if e["hash"] in seen], size, seed=len(seen))
+    return {
+        "mode": "incremental",
+        "reason": f"{len(new)} new samples",
+        "base_version": base_version,
+        "seen": seen,
+        "new": new,
+        "replay": replay,
+        "reference_f1": reference_f1,
+        "reference_data_hash": base.get("reference_data_hash"),
+        "drift": drift
+    }
+
+def publish_model(model, processor, registry=None, data=None, train_metrics=None, metadata=None, validation=None, cascade=None, seen=None,
+                  cancel_check=None, run_data=None):
+    """
+    Save the trained model as a new, immutable version in the model registry and make
+    it the active one. The checkpoint is written to a staging directory first, so the
+    predictor never sees a half-written model and a failed save keeps the old one.
+
+    The int8/onnx backends (EXPORT_BACKENDS) are exported from the staged checkpoint and
+    checked against it on the held-out `validation` samples (or `data` when there are
+    none) before activation, so a predictor picking up the new version finds its
+    artifacts already in place.
+
+    Parameters:
+        model: The trained model.
+        processor: The processor to save alongside it.
+        registry (ModelRegistry): Defaults to the registry on MODEL_VOLUME_PATH.
+        data (CorpusView): Every sample the model reflects, recorded in the version's metadata.
+        train_metrics (dict): Metrics reported by the training run, including validation metrics.
+        metadata (dict): Extra metadata to record, e.g. the training mode.
+        validation (CorpusView): The held-out validation samples, if any.
+        cascade (CascadeClassifier): The pre-classifier to serve in front of the model, if any.
+        seen (set): Hashes of every sample the model was trained on; defaults to those of `data`.
+        cancel_check (callable): Called after the export, before the version is committed; raises to discard it.
+        run_data (CorpusView): The samples this run trained on, when only part of `data` (incremental runs).
+
+    Returns:
+        str: The new model version.
+    """
+    registry = registry or ModelRegistry()
+    run_data = run_data if run_data is not None else data
+    staging_dir = registry.staging_dir()
+    version = registry.new_version()
+
+    try:
+        model.save_pretrained(staging_dir)
+        processor.save_pretrained(staging_dir)
+        if cascade is not None and cascade.model is not None:
+            cascade.save(staging_dir)
+        TRAIN_SELECTION.save(staging_dir)
+
+        parity_data = validation if validation is not None and len(validation) else data
+        if EXPORT_BACKENDS and parity_data is not None:
+            try:
+                build_backends(staging_dir, staging_dir, version, parity_documents(parity_data))
+            except Exception as e:
+                # The fp32 checkpoint is still published; the predictor falls back to it
+                print(f"⚠️ Exporting inference backends failed: {e}")
+
+        # Last chance to cancel: once committed, the version is activated
+        if cancel_check is not None:
+            cancel_check()
+
+        label_counts = {}
+        for entry in (data.entries if data is not None else []):
+            label_counts[entry["label"]] = label_counts.get(entry["label"], 0) + 1
+        registry.commit(staging_dir, version, {
+            "labels": LABELS,
+            "label2id": label2id,
+            "id2label": {str(i): label for i, label in id2label.items()},
+            "training_samples": len(data) if data is not None else 0,
+            "label_counts": label_counts,
+            "training_data_hash": data.fingerprint() if data is not None else None,
+            "run_samples": len(run_data) if run_data is not None else 0,
+            "run_data_hash": run_data.fingerprint() if run_data is not None else None,
+            "validation_samples": len(validation) if validation is not None else 0,
+            "validation_data_hash": validation.fingerprint() if validation is not None else None,
+            "metrics": train_metrics or {},
+            "text_only": TEXT_ONLY,
+            "windows": TRAIN_WINDOWS.tag,
+            "word_selection": TRAIN_SELECTION.to_dict(),
+            **(metadata or {})
+        }, seen=seen if seen is not None else [e["hash"] for e in (data.entries if data is not None else [])],
+           validation=[e["hash"] for e in validation.entries] if validation is not None else None)
+    except Exception:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+
+    registry.activate(version, reason="train")
+    registry.prune()
+    print(f"🔹 Published model version {version}")
+    return version
+
+def train(callbacks=None, mode=None, cancel_check=None):
+    """
+    Fine-tune on the corpus and publish the model. Returns the published model
+    version, or None when there is nothing to train on.
+
+    `mode` (default TRAIN_MODE) is "full" to fine-tune the whole model, "head" to
+    train only the classification head on cached embeddings of the current
+    backbone, or "incremental" to fine-tune the active model for a bounded number of
+    steps on the samples it hasn't seen plus a replay of ones it has (see
+    plan_incremental). The Trainer `callbacks` only apply to full and incremental
+    training. `cancel_check` is called between phases (and per batch or epoch where
+    no Trainer runs) and raises to stop the run; nothing is published after it does.
+
+    Only one training runs at a time per model volume, even across processes.
+    """
+    mode = mode or TRAIN_MODE
+    if mode not in TRAIN_MODES:
+        raise ValueError(f"Unknown training mode '{mode}', expected one of {TRAIN_MODES}.")
+    os.makedirs(MODEL_VOLUME_PATH, exist_ok=True)
+    with locked(MODEL_VOLUME_PATH):
+        return _train(callbacks, mode, cancel_check or (lambda: None))
+
+def _train(callbacks=None, mode="full", cancel_check=lambda: None):
+    print(f"🔹 Loading processor and model ({mode} training)...")
 
     #volume_path = "/app/model_volume"
-    volume_path="/train_model_dsk"
-    model_dir = os.path.join(volume_path, "fine_tuned_layoutlmv3")
+    volume_path = MODEL_VOLUME_PATH
+    model_dir = MODEL_DIR
+
+    # Text+layout-only mode drops the visual patch embedding from the model entirely
+    model_kwargs = {"visual_embed": False} if TEXT_ONLY else {}
 
     if os.path.exists(model_dir):
         print(f"🔹 Found existing model in Docker volume at '{model_dir}', loading it...")
@@ -72,7 +674,8 @@ def train():
             model_dir,
             num_labels=len(LABELS),
             id2label=id2label,
-            label2id=label2id
+            label2id=label2id,
+            **model_kwargs
         )
     else:
         print("🔹 No existing model in volume, loading base model...")
@@ -81,52 +684,180 @@ def train():
             "microsoft/layoutlmv3-base",
             num_labels=len(LABELS),
             id2label=id2label,
-            label2id=label2id
+            label2id=label2id,
+            **model_kwargs
         )
+    if not uses_visual_tokens(model):
+        print("🔹 Training in text+layout-only mode (no visual tokens)")
 
     # Load dataset
-    jsonl_dir = "train_data"
-    jsonl_files = [f for f in os.listdir(jsonl_dir) if f.endswith(".jsonl")]
-
-    if not jsonl_files:
-        print("❌ No .jsonl files found in 'train_data' directory!")
+    data = load_corpus()
+    if data is None:
         return
+    cancel_check()
+    # Validation never holds samples the starting checkpoint was trained on, and incremental runs
+    # keep the active version's validation set, so it doesn't move as the corpus grows
+    registry = ModelRegistry()
+    base_version = registry.active_version() if os.path.exists(model_dir) else None
+    trained = registry.seen_samples(base_version) if base_version else None
+    pinned = registry.validation_samples(base_version) if base_version and mode == "incremental" else None
+    train_data, validation = split_train_validation(data, trained=trained, pinned=pinned)
+    # Validation documents are classified whole, like at prediction time; incremental runs
+    # only read a fixed-size sample of them
+    eval_data = stratified_sample(validation, INCREMENTAL_EVAL_SAMPLES) if mode == "incremental" else validation
+    eval_documents = list(eval_data)
+    if eval_documents:
+        print(f"🔹 Holding out {len(validation)} samples for validation, evaluating on {len(eval_documents)}")
+    else:
+        print(f"⚠️ Too few samples per label for a validation split, training for {TRAIN_EPOCHS} epochs without early stopping")
 
-    jsonl_path = os.path.join(jsonl_dir, jsonl_files[0])
-    print(f"🔹 Loading dataset from {jsonl_path}...")
+    # Incremental runs fine-tune the active model on what it hasn't seen plus a class-balanced
+    # replay of what it has; they turn into full runs when there is no baseline or it drifted
+    plan = {"mode": mode}
+    if mode == "incremental":
+        if os.path.exists(model_dir):
+            plan = plan_incremental(model, processor, train_data, eval_data)
+        else:
+            plan = {"mode": "full", "reason": "there is no trained model yet"}
+        if plan["mode"] is None:
+            print(f"ℹ️ Nothing to train: {plan['reason']}")
+            return None
+        if plan["mode"] == "full":
+            print(f"⚠️ Retraining fully: {plan['reason']}")
+            if len(eval_data) < len(validation):
+                eval_data = validation
+                eval_documents = list(validation)
+        else:
+            print(f"🔹 Incremental training on {len(plan['new'])} new and {len(plan['replay'])} replayed samples "
+                  f"(base version {plan['base_version']})")
+        mode = plan["mode"]
+    run_data = CorpusView(data.store, plan["new"] + plan["replay"]) if mode == "incremental" else train_data
+    cancel_check()
+
+    # The cheap pre-classifier is calibrated on its own out-of-fold predictions over the
+    # training split; validation stays held out for the cascade too. Refitting it reads every
+    # training sample, so incremental runs keep the active version's until the next full run.
+    cascade, cascade_metrics = None, None
+    if CASCADE_ENABLED and mode == "incremental":
+        cascade = CascadeClassifier.load(registry.version_dir(plan["base_version"]))
+        base_metrics = registry.metadata(plan["base_version"]).get("cascade") or {}
+        cascade_metrics = dict(base_metrics, fitted_in=base_metrics.get("fitted_in", plan["base_version"]))
+    elif CASCADE_ENABLED:
+        cascade, cascade_metrics = train_cascade(train_data, [e["label"] for e in train_data.entries], LABELS)
+        cancel_check()
+
+    # Tokenized features are cached on disk per (sample, processor, max_length) across epochs and runs.
+    # Long documents are windowed and their words selected the same way as at prediction time
+    # (WINDOW_MODE, SELECTION_POLICY, ...).
+    dataset = DocumentDataset(
+        run_data,
+        processor,
+        feature_cache=FeatureCache(processor, max_length=512),
+        window_config=TRAIN_WINDOWS,
+        include_pixel_values=uses_visual_tokens(model),
+        selection=TRAIN_SELECTION
+    )
 
-    with open(jsonl_path, "r") as f:
-        data = [json.loads(line) for line in f]
+    if mode == "head":
+        print("🚀 Training the classification head on frozen encoder embeddings...")
+        metrics = train_classifier_head(model, processor, dataset, cancel_check=cancel_check)
+        backbone = metrics.pop("backbone")
+        if eval_documents:
+            metrics.update({f"eval_{k}": v for k, v in evaluate_documents(model, processor, eval_documents, cascade=cascade).items()})
+            print(f"🔹 Validation: accuracy {metrics['eval_accuracy']:.3f}, f1 {metrics['eval_f1']:.3f}")
+        pipeline = pipeline_metrics(metrics)
+        reference = reference_metrics(model, processor, validation, metrics)
+        cancel_check()
+        print("💾 Saving model to Docker volume...")
+        version = publish_model(model, processor, data=train_data, validation=validation, train_metrics=metrics,
+                                metadata={"training_mode": "head", "backbone": backbone, "cascade": cascade_metrics,
+                                          **reference, **pipeline},
+                                cascade=cascade, cancel_check=cancel_check)
+        print(f"✅ Model saved to volume at '{model_dir}'")
+        return version
 
-    dataset = DocumentDataset(data, processor)
+    callbacks = list(callbacks or [])
+    eval_args = {}
+    if mode == "incremental":
+        # A fixed step budget, evaluated once at the end (no per-epoch checkpoints to choose from)
+        eval_args = {
+            "max_steps": min(INCREMENTAL_MAX_STEPS, math.ceil(len(dataset) / 2) * INCREMENTAL_EPOCHS),
+            "learning_rate": INCREMENTAL_LEARNING_RATE
+        }
+    elif eval_documents:
+        # Evaluate and checkpoint every epoch, stop once weighted F1 stops improving
+        # and end on the best epoch's weights
+        strategy_arg = "eval_strategy" if "eval_strategy" in TrainingArguments.__dataclass_fields__ else "evaluation_strategy"
+        eval_args = {
+            strategy_arg: "epoch",
+            "save_strategy": "epoch",
+            "save_total_limit": 1,
+            "load_best_model_at_end": True,
+            "metric_for_best_model": "f1",
+            "greater_is_better": True
+        }
+        callbacks.append(EarlyStoppingCallback(early_stopping_patience=EARLY_STOPPING_PATIENCE))
 
     args = TrainingArguments(
         output_dir="./model_output",
         per_device_train_batch_size=2,
-        num_train_epochs=3,
+        num_train_epochs=MAX_TRAIN_EPOCHS if eval_documents else TRAIN_EPOCHS,
         logging_dir="./logs",
-        logging_steps=5
+        logging_steps=5,
+        **eval_args
     )
 
-    trainer = Trainer(
+    trainer = BucketTrainer(
         model=model,
         args=args,
         train_dataset=dataset,
-        compute_metrics=compute_metrics
+        data_collator=DocumentCollator(processor.tokenizer.pad_token_id),
+        compute_metrics=compute_metrics,
+        callbacks=callbacks,
+        eval_documents=eval_documents,
+        eval_processor=processor,
+        window_config=TRAIN_WINDOWS,
+        eval_cascade=cascade
     )
 
     print("🚀 Starting training...")
-    trainer.train()
+    train_result = trainer.train()
+    metrics = dict(train_result.metrics)
+    if eval_documents:
+        # The best checkpoint is loaded by now; these are the numbers of the published model
+        metrics.update(trainer.evaluate())
+        print(f"🔹 Validation (best epoch): accuracy {metrics['eval_accuracy']:.3f}, f1 {metrics['eval_f1']:.3f}")
 
-    print("💾 Saving model to Docker volume...")
-    if os.path.exists(model_dir):
-        shutil.rmtree(model_dir)  # Clean old model
+    metadata = {"training_mode": mode, "cascade": cascade_metrics, **pipeline_metrics(metrics)}
+    seen = None
+    trained_data = run_data
+    if mode == "incremental":
+        # Drift keeps being measured against the last full training, not against this run
+        metadata.update(
+            base_version=plan["base_version"],
+            new_samples=len(plan["new"]),
+            replay_samples=len(plan["replay"]),
+            reference_f1=plan["reference_f1"],
+            reference_data_hash=plan["reference_data_hash"],
+            drift=plan["drift"],
+            eval_samples=len(eval_documents)
+        )
+        seen = plan["seen"] | {e["hash"] for e in plan["new"]}
+        # The model reflects every sample it was ever trained on, not only this run's
+        trained_data = CorpusView(data.store, [e for e in data.entries if e["hash"] in seen])
+    else:
+        metadata.update(reference_metrics(trainer.model, processor, validation, metrics))
+        if plan.get("reason"):
+            metadata["full_retrain_reason"] = plan["reason"]
 
-    trainer.save_model(model_dir)
-    processor.save_pretrained(model_dir)
+    cancel_check()
+    print("💾 Saving model to Docker volume...")
+    version = publish_model(trainer.model, processor, data=trained_data, validation=validation, train_metrics=metrics,
+                            metadata=metadata, cascade=cascade, seen=seen, cancel_check=cancel_check, run_data=run_data)
 
     print(f"✅ Model saved to volume at '{model_dir}'")
     print("✅ Training complete!")
+    return version
 
 if __name__ == "__main__":
     train()
@@ -0,0 +1,135 @@
+# windowing.py
+import os
+
+import numpy as np
+import torch
+
+WINDOW_MODES = ("none", "tokens", "pages")
+POOLING_MODES = ("mean", "max", "first_page")
+
+
+class WindowConfig:
+    """
+    How documents longer than one forward pass are split and pooled.
+
+    mode:
+        "none"   - truncate at max_length (the original behavior)
+        "tokens" - overlapping windows of at most max_length tokens, `stride` tokens of overlap
+        "pages"  - one window per Textract page, long pages split like "tokens"
+    pooling:
+        "mean", "max" or "first_page" (mean with page-1 windows weighted by first_page_weight)
+    max_windows caps the windows per document (evenly spaced, always keeping the
+    first and last), so the cost per document stays predictable.
+    """
+
+    def __init__(self, mode="none", stride=128, max_windows=8, pooling="mean", first_page_weight=2.0, max_length=512):
+        if mode not in WINDOW_MODES:
+            raise ValueError(f"Unknown window mode '{mode}', expected one of {WINDOW_MODES}.")
+        if pooling not in POOLING_MODES:
+            raise ValueError(f"Unknown pooling '{pooling}', expected one of {POOLING_MODES}.")
+        self.mode = mode
+        self.stride = stride
+        self.max_windows = max_windows
+        self.pooling = pooling
+        self.first_page_weight = first_page_weight
+        self.max_length = max_length
+
+    @classmethod
+    def from_env(cls, prefix="WINDOW"):
+        return cls(
+            mode=os.environ.get(f"{prefix}_MODE", "none"),
+            stride=int(os.environ.get(f"{prefix}_STRIDE", "128")),
+            max_windows=int(os.environ.get(f"{prefix}_MAX_WINDOWS", "8")),
+            pooling=os.environ.get(f"{prefix}_POOLING", "mean"),
+            first_page_weight=float(os.environ.get(f"{prefix}_FIRST_PAGE_WEIGHT", "2.0"))
+        )
+
+    @property
+    def enabled(self):
+        return self.mode != "none"
+
+    @property
+    def tag(self):
+        """Identifies the split (not the pooling), e.g. for caching window features."""
+        return f"{self.mode}-{self.max_length}-{self.stride}-{self.max_windows}"
+
+
+def word_token_counts(tokenizer, words, boxes):
+    """Number of subword tokens of every word, without special tokens."""
+    if not words:
+        return np.zeros(0, dtype=np.int64)
+    encoding = tokenizer(words, boxes=boxes, add_special_tokens=False, truncation=False)
+    word_ids = [w for w in encoding.word_ids() if w is not None]
+    return np.bincount(np.asarray(word_ids, dtype=np.int64), minlength=len(words))
+
+
+def _token_windows(counts, start, end, budget, stride):
+    """(start, end) word spans over words[start:end], each within `budget` tokens."""
+    spans = []
+    cumsum = np.concatenate([[0], np.cumsum(counts[start:end])])
+    s = 0
+    n = end - start
+    while True:
+        # Furthest end whose tokens fit; a single over-long word still gets its own window
+        e = max(int(np.searchsorted(cumsum, cumsum[s] + budget, side="right")) - 1, s + 1)
+        e = min(e, n)
+        spans.append((start + s, start + e))
+        if e >= n:
+            return spans
+        # Next window starts so that at most `stride` tokens overlap with this one
+        next_s = int(np.searchsorted(cumsum, cumsum[e] - stride, side="left"))
+        s = min(max(next_s, s + 1), e)
+
+
+def split_windows(tokenizer, words, boxes, pages=None, config=None):
+    """
+    Split a document into windows.
+
+    Returns:
+        list: (start, end, page) word spans; `page` is the page the window starts on.
+    """
+    config = config or WindowConfig()
+    n = len(words)
+    if pages is None or len(pages) != n:
+        pages = [1] * n
+    if not config.enabled or n == 0:
+        return [(0, n, pages[0] if n else 1)]
+
+    counts = word_token_counts(tokenizer, words, boxes)
+    budget = config.max_length - 2  # <s> and </s>
+
+    if config.mode == "pages":
+        sections = []
+        start = 0
+        for i in range(1, n + 1):
+            if i == n or pages[i] != pages[start]:
+                sections.append((start, i))
+                start = i
+    else:
+        sections = [(0, n)]
+
+    spans = []
+    for start, end in sections:
+        spans.extend(_token_windows(counts, start, end, budget, config.stride))
+
+    if len(spans) > config.max_windows:
+        keep = np.unique(np.linspace(0, len(spans) - 1, config.max_windows).round().astype(int))
+        spans = [spans[i] for i in keep]
+    return [(s, e, pages[s]) for s, e in spans]
+
+
+def pool_logits(logits, window_pages, config=None):
+    """Aggregate the logits of one document's windows into a single row of logits."""
+    config = config or WindowConfig()
+    if logits.shape[0] == 1:
+        return logits[0]
+    if config.pooling == "max":
+        return logits.max(dim=0).values
+    if config.pooling == "first_page":
+        first_page = min(window_pages)
+        weights = torch.tensor(
+            [config.first_page_weight if p == first_page else 1.0 for p in window_pages],
+            dtype=logits.dtype
+        )
+        return (logits * weights[:, None]).sum(dim=0) / weights.sum()
+    return logits.mean(dim=0)
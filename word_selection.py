@@ -0,0 +1,231 @@
+# word_selection.py
+import json
+import os
+import re
+
+import numpy as np
+
+from metrics import Counter, REGISTRY
+from windowing import word_token_counts
+
+SELECTION_POLICIES = ("first", "per_page", "informative", "key_value")
+SELECTION_FILE = "word_selection.json"
+_DIGITS = re.compile(r"\d+")
+
+DROPPED_WORDS = REGISTRY.register(Counter(
+    "layoutlm_selection_dropped_words_total",
+    "Words left out before tokenization, by reason (margin or budget).",
+    labelnames=("reason",)
+))
+
+
+class WordSelection:
+    """
+    Preprocessing of a document's words before they are tokenized, shared by
+    training (DocumentDataset) and prediction (encode_for_prediction).
+
+    Boxes are always clipped to the 0-1000 range LayoutLMv3 accepts. Then:
+
+    reading_order:
+        words are sorted per page into lines (top to bottom) and left to right within a line
+    dedup_margins:
+        lines in the top or bottom `margin` (0-1000 scale) repeated on several pages
+        (running headers and footers, page numbers ignored) are kept on their first page only
+    policy:
+        which words fill the token budget of a single forward pass:
+        "first"       - the first words in reading order (plain truncation)
+        "per_page"    - the first words of every page, the budget shared evenly between pages
+        "informative" - words that are rare within the document first (boilerplate last)
+        "key_value"   - words of Textract key-value pairs first, then the rest in reading order
+    The selected words are always encoded in reading order. The budget only applies
+    without windowing: windowed documents keep every word.
+
+    A model version is trained and served with the same selection: it is saved with
+    the checkpoint (save/load). Versions from before word selection have none and
+    see their words as given.
+    """
+
+    def __init__(self, policy="first", reading_order=False, dedup_margins=False, margin=100, line_tolerance=0.5):
+        if policy not in SELECTION_POLICIES:
+            raise ValueError(f"Unknown selection policy '{policy}', expected one of {SELECTION_POLICIES}.")
+        self.policy = policy
+        self.reading_order = reading_order
+        self.dedup_margins = dedup_margins
+        self.margin = margin
+        self.line_tolerance = line_tolerance
+
+    @classmethod
+    def from_env(cls, prefix="SELECTION"):
+        return cls(
+            policy=os.environ.get(f"{prefix}_POLICY", "first"),
+            reading_order=os.environ.get(f"{prefix}_READING_ORDER", "0") == "1",
+            dedup_margins=os.environ.get(f"{prefix}_DEDUP_MARGINS", "0") == "1",
+            margin=int(os.environ.get(f"{prefix}_MARGIN", "100")),
+            line_tolerance=float(os.environ.get(f"{prefix}_LINE_TOLERANCE", "0.5"))
+        )
+
+    @classmethod
+    def load(cls, model_dir):
+        """The selection saved with a model version, or None."""
+        path = os.path.join(model_dir, SELECTION_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return cls(**json.load(f))
+
+    def save(self, model_dir):
+        with open(os.path.join(model_dir, SELECTION_FILE), "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def to_dict(self):
+        return {
+            "policy": self.policy,
+            "reading_order": self.reading_order,
+            "dedup_margins": self.dedup_margins,
+            "margin": self.margin,
+            "line_tolerance": self.line_tolerance
+        }
+
+    @property
+    def tag(self):
+        """Identifies the selected words, e.g. for caching their features."""
+        return f"{self.policy}-{int(self.reading_order)}{int(self.dedup_margins)}-{self.margin}-{self.line_tolerance}"
+
+    def apply(self, doc, tokenizer=None, budget=None):
+        """
+        Returns:
+            dict: `doc` with "words", "boxes", "pages" (and "key_value") reduced to the
+            selected words, in reading order, with valid boxes. `budget` is the number
+            of tokens available (None keeps every word); counting them needs `tokenizer`.
+        """
+        words = list(doc["words"])
+        boxes = clip_boxes(doc["boxes"])
+        if len(words) != len(boxes):
+            raise ValueError(f"{len(words)} words but {len(boxes)} boxes.")
+        pages = np.asarray(doc.get("pages") or [1] * len(words), dtype=np.int64)
+        if len(pages) != len(words):
+            pages = np.ones(len(words), dtype=np.int64)
+        key_value = doc.get("key_value")
+        key_value = np.asarray(key_value, dtype=bool) if key_value is not None and len(key_value) == len(words) else None
+
+        # Words with no text have no token; they only shift the others' positions
+        keep = np.fromiter((bool(str(w).strip()) for w in words), dtype=bool, count=len(words))
+        order = np.nonzero(keep)[0]
+        if self.reading_order or self.dedup_margins:
+            lines = line_ids(boxes[order], pages[order], self.line_tolerance)
+            if self.dedup_margins:
+                repeated = repeated_margin_lines([words[i] for i in order], boxes[order], pages[order], lines, self.margin)
+                DROPPED_WORDS.inc(int(repeated.sum()), reason="margin")
+                order, lines = order[~repeated], lines[~repeated]
+            if self.reading_order:
+                order = order[np.lexsort((boxes[order, 0], lines))]
+
+        if budget is not None and self.policy != "first" and len(order):
+            counts = word_token_counts(tokenizer, [words[i] for i in order], boxes[order].tolist())
+            if counts.sum() > budget:
+                order_key_value = key_value[order] if key_value is not None else None
+                selected = self._fill(counts, pages[order], order_key_value, [words[i] for i in order], budget)
+                DROPPED_WORDS.inc(len(order) - len(selected), reason="budget")
+                order = order[selected]
+
+        selected_doc = dict(doc, words=[words[i] for i in order], boxes=boxes[order].tolist(), pages=pages[order].tolist())
+        if key_value is not None:
+            selected_doc["key_value"] = key_value[order].tolist()
+        return selected_doc
+
+    def _fill(self, counts, pages, key_value, words, budget):
+        # Indices (in reading order) of the words picked by the policy within `budget` tokens
+        n = len(counts)
+        if self.policy == "per_page":
+            return per_page_selection(counts, pages, budget)
+        if self.policy == "informative":
+            _, inverse, frequency = np.unique([str(w).lower() for w in words], return_inverse=True, return_counts=True)
+            has_alnum = np.fromiter((any(c.isalnum() for c in str(w)) for w in words), dtype=bool, count=n)
+            priority = np.lexsort((np.arange(n), ~has_alnum, frequency[inverse.reshape(-1)]))
+        elif self.policy == "key_value" and key_value is not None:
+            priority = np.lexsort((np.arange(n), ~key_value))
+        else:
+            priority = np.arange(n)
+        fits = np.cumsum(counts[priority]) <= budget
+        return np.sort(priority[fits])
+
+
+def clip_boxes(boxes):
+    """Boxes as an n x 4 int array, clipped to 0-1000 with x0 <= x1 and y0 <= y1."""
+    boxes = np.clip(np.asarray(boxes, dtype=np.float64).reshape(-1, 4), 0, 1000)
+    boxes = np.nan_to_num(boxes).astype(np.int64)
+    x0, x1 = np.minimum(boxes[:, 0], boxes[:, 2]), np.maximum(boxes[:, 0], boxes[:, 2])
+    y0, y1 = np.minimum(boxes[:, 1], boxes[:, 3]), np.maximum(boxes[:, 1], boxes[:, 3])
+    return np.stack([x0, y0, x1, y1], axis=1)
+
+
+def line_ids(boxes, pages, tolerance=0.5):
+    """
+    Line number of every word, increasing with page and then top to bottom: words
+    whose vertical centers are within `tolerance` x the median word height of the
+    previous word (sorted by page and center) share a line.
+    """
+    if not len(boxes):
+        return np.zeros(0, dtype=np.int64)
+    center = (boxes[:, 1] + boxes[:, 3]) / 2
+    heights = boxes[:, 3] - boxes[:, 1]
+    gap = tolerance * (np.median(heights[heights > 0]) if (heights > 0).any() else 10)
+    order = np.lexsort((center, pages))
+    new_line = np.concatenate([[True], (np.diff(pages[order]) != 0) | (np.diff(center[order]) > gap)])
+    lines = np.empty(len(boxes), dtype=np.int64)
+    lines[order] = np.cumsum(new_line) - 1
+    return lines
+
+
+def repeated_margin_lines(words, boxes, pages, lines, margin=100):
+    """
+    Mask of the words on lines within `margin` of the top or bottom edge whose text
+    (digits ignored, so "Page 2 of 5" matches) already appeared in the same margin of
+    an earlier page.
+    """
+    repeated = np.zeros(len(words), dtype=bool)
+    if len(np.unique(pages)) < 2:
+        return repeated
+    center = (boxes[:, 1] + boxes[:, 3]) / 2
+    in_margin = np.nonzero((center < margin) | (center > 1000 - margin))[0]
+    if not len(in_margin):
+        return repeated
+
+    # Only the (few) margin words are handled in Python
+    in_margin = in_margin[np.lexsort((boxes[in_margin, 0], lines[in_margin]))]
+    line_words = {}
+    for i in in_margin:
+        line_words.setdefault(int(lines[i]), []).append(i)
+    first_page = {}
+    for line, members in line_words.items():
+        edge = "top" if center[members[0]] < margin else "bottom"
+        key = (edge, _DIGITS.sub("#", " ".join(str(words[i]) for i in members).lower()))
+        page = int(pages[members[0]])
+        if first_page.setdefault(key, page) != page:
+            repeated[members] = True
+    return repeated
+
+
+def per_page_selection(counts, pages, budget):
+    """
+    The first words of every page, with one token cap for all pages chosen as high
+    as the budget allows (pages shorter than the cap keep every word and leave
+    their share to the others).
+    """
+    page_index = np.unique(pages, return_inverse=True)[1].reshape(-1)
+    totals = np.bincount(page_index, weights=counts)
+    low, high = 0, int(totals.max())
+    while low < high:
+        cap = (low + high + 1) // 2
+        if np.minimum(totals, cap).sum() <= budget:
+            low = cap
+        else:
+            high = cap - 1
+
+    # Tokens used on each word's page up to and including that word
+    by_page = np.argsort(page_index, kind="stable")
+    cumsum = np.cumsum(counts[by_page])
+    page_start = np.concatenate([[0], np.cumsum(totals)[:-1]])
+    within_page = np.empty(len(counts), dtype=np.int64)
+    within_page[by_page] = cumsum - page_start[page_index[by_page]]
+    return np.nonzero(within_page <= low)[0]